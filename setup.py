@@ -93,6 +93,15 @@ setup(
         "receiver": [
             "pathlib2; python_version<'3.4'",
         ],
+        # optional, to use the msgpack metadata format
+        "msgpack": [
+            "msgpack"
+        ],
+        # optional, to compress the data with lz4 or zstd
+        "compression": [
+            "lz4",
+            "zstandard"
+        ],
         "control_client": []
     },
     entry_points={
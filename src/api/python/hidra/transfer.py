@@ -31,6 +31,7 @@ from __future__ import unicode_literals
 # requires dependency on future
 from builtins import super  # pylint: disable=redefined-builtin
 
+from collections import deque
 import copy
 from distutils.version import LooseVersion
 import errno
@@ -66,7 +67,11 @@ from .utils import (
     LoggingFunction,
     Base,
     get_logger,
-    open_tempfile
+    open_tempfile,
+    deserialize_metadata,
+    decompress,
+    get_compression_codecs,
+    get_metadata_formats
 )
 from .control import Control
 
@@ -268,6 +273,8 @@ class Transfer(Base):
         self.all_close_recvd = False
 
         self.file_descriptors = dict()
+        # chunks received as part of a batch but not returned yet
+        self.pending_chunks = deque()
 
         self.file_opened = False
         self.callback_params = None
@@ -278,6 +285,8 @@ class Transfer(Base):
         self.stopped_everything = False
         self.generate_target_filepath = None
         self._remote_version = None
+        # the optional signals the sender announced to understand
+        self._remote_signals = []
 
         self.init_args = {
             "signal_host": signal_host,
@@ -473,6 +482,8 @@ class Transfer(Base):
         # the receiver should be shut down
         if message and message[0].startswith(signal):
             self.log.info("Received signal confirmation ...")
+            # older senders do not announce any signals
+            self._remote_signals = message[2:]
             return message[1]
         else:
             self.log.error("Invalid confirmation received...")
@@ -567,6 +578,85 @@ class Transfer(Base):
 
         self._remote_version = self.get_remote_version()
 
+        self._set_metadata_format()
+        if signal in [b"START_STREAM", b"START_QUERY_NEXT"]:
+            self._set_compression()
+            self._set_batching()
+
+    def _set_metadata_format(self):
+        """Tell the sender which metadata formats can be decoded.
+
+        Older senders do not know about this signal and always send JSON
+        encoded metadata.
+        """
+
+        signal = b"SET_METADATA_FORMAT"
+        if signal not in self._remote_signals:
+            self.log.debug("Sender does not support negotiating the "
+                           "metadata format")
+            return
+
+        formats = get_metadata_formats()
+        # [[<host:port>, <prio>, <regex>, [<format>, ...]], ...]
+        targets = [target + [formats] for target in self.targets]
+
+        message = self._send_signal(signal, targets=targets)
+
+        if message and message[0].startswith(signal):
+            self.log.info("Metadata format negotiated (supported formats: "
+                          "%s)", formats)
+        else:
+            # data is still received, only JSON encoded
+            self.log.warning("Negotiating the metadata format failed")
+            self.log.debug("message=%s", message)
+
+    def _set_compression(self):
+        """Tell the sender which compression codecs can be decompressed.
+
+        The sender decides per target if and how the data chunks are
+        compressed. Older senders do not know about compression and always
+        send uncompressed data.
+        """
+
+        signal = b"SET_COMPRESSION"
+        if signal not in self._remote_signals:
+            self.log.debug("Sender does not support compression")
+            return
+
+        codecs = get_compression_codecs()
+        # [[<host:port>, <prio>, <regex>, [<codec>, ...]], ...]
+        targets = [target + [codecs] for target in self.targets]
+
+        message = self._send_signal(signal, targets=targets)
+
+        if message and message[0].startswith(signal):
+            self.log.info("Compression negotiated (supported codecs: %s)",
+                          codecs)
+        else:
+            # data is still received, only uncompressed
+            self.log.warning("Negotiating compression failed")
+            self.log.debug("message=%s", message)
+
+    def _set_batching(self):
+        """Tell the sender that batches of small files can be received.
+
+        Without this the sender sends each file in its own message.
+        """
+
+        signal = b"SET_BATCHING"
+        if signal not in self._remote_signals:
+            self.log.debug("Sender does not support batches")
+            return
+
+        message = self._send_signal(signal)
+
+        if message and message[0].startswith(signal):
+            self.log.info("Batches of files enabled")
+        else:
+            # data is still received, only file by file
+            self.log.warning("Enabling batches of files failed")
+            self.log.debug("message=%s", message)
+
     def _create_signal_socket(self):
         """Create socket to exchange signals with sender.
 
@@ -649,11 +739,14 @@ class Transfer(Base):
                     self.log.debug("targets=%s", targets)
                     raise FormatError("Argument 'targets' is of wrong format.")
 
-    def _send_signal(self, signal):
+    def _send_signal(self, signal, targets=None):
 
         if not signal:
             return
 
+        if targets is None:
+            targets = self.targets
+
         # Send the signal that the communication infrastructure should be
         # established
         self.log.info("Sending Signal")
@@ -662,7 +755,7 @@ class Transfer(Base):
                         self.appid.encode('utf-8'),
                         signal]
 
-        trg = json.dumps(self.targets).encode('utf-8')
+        trg = json.dumps(targets).encode('utf-8')
         send_message.append(trg)
 
         self.log.debug("Signal: %s", send_message)
@@ -1363,31 +1456,43 @@ class Transfer(Base):
                               self.recvd_close_from, self.number_of_streams)
 
         else:
-            # extract multipart message
-            try:
-                metadata = json.loads(multipart_message[0].decode("utf-8"))
-            except Exception:
-                # json.dumps of None results in 'null'
-                if multipart_message[0] != 'null':
-                    self.log.error("Could not extract metadata from the "
-                                   "multipart-message.", exc_info=True)
-                    self.log.debug("multipartmessage[0] = %s",
-                                   multipart_message[0], exc_info=True)
-                metadata = None
+            # batches of small files are of the form
+            # [<metadata>, <data>, <metadata>, <data>, ...]
+            for i in range(0, max(len(multipart_message) - 1, 1), 2):
+                self._react_on_chunk(multipart_message[i:i + 2])
 
-            # TODO validate multipart_message
-            # (like correct dict-values for metadata)
+        return True
 
-            try:
-                payload = multipart_message[1]
-            except Exception:
-                self.log.warning("An empty file was received within the "
-                                 "multipart-message", exc_info=True)
-                payload = None
+    def _react_on_chunk(self, frames):
+        """Hand a received chunk to the read callback.
+
+        Args:
+            frames: The metadata frame and the data frame.
+        """
 
-            self.read_callback(self.callback_params, [metadata, payload])
+        # extract multipart message
+        try:
+            metadata = deserialize_metadata(frames[0])
+        except Exception:
+            # json.dumps of None results in 'null'
+            if frames[0] != 'null':
+                self.log.error("Could not extract metadata from the "
+                               "multipart-message.", exc_info=True)
+                self.log.debug("multipartmessage[0] = %s",
+                               frames[0], exc_info=True)
+            metadata = None
 
-        return True
+        # TODO validate multipart_message
+        # (like correct dict-values for metadata)
+
+        try:
+            payload = self._decompress(metadata, frames[1])
+        except IndexError:
+            self.log.warning("An empty file was received within the "
+                             "multipart-message", exc_info=True)
+            payload = None
+
+        self.read_callback(self.callback_params, [metadata, payload])
 
     def get_chunk(self, timeout=None):
         """
@@ -1415,6 +1520,10 @@ class Transfer(Base):
                            "initialized.")
             return None, None
 
+        # the rest of a batch received before
+        if self.pending_chunks:
+            return self.pending_chunks.popleft()
+
         if "QUERY_NEXT" in self.started_connections:
 
             send_message = [b"NEXT",
@@ -1488,21 +1597,15 @@ class Transfer(Base):
                                    multipart_message[:100])
                     return [None, None]
 
-                # extract multipart message
-                try:
-                    metadata = json.loads(multipart_message[0].decode("utf-8"))
-                except Exception:
-                    self.log.error("Could not extract metadata from the "
-                                   "multipart-message.", exc_info=True)
-                    metadata = None
-
-                # TODO validate multipart_message
-                # (like correct dict-values for metadata)
-
-                # this does not fail because length was already checked
-                payload = multipart_message[1]
+                # batches of small files are of the form
+                # [<metadata>, <data>, <metadata>, <data>, ...]
+                chunks = [
+                    self._unpack_chunk(multipart_message[i:i + 2])
+                    for i in range(0, len(multipart_message) - 1, 2)
+                ]
+                self.pending_chunks.extend(chunks[1:])
 
-                return [metadata, payload]
+                return chunks[0]
 
             # no response was received
             else:
@@ -1519,6 +1622,63 @@ class Transfer(Base):
 
                 return [None, None]
 
+    def _unpack_chunk(self, frames):
+        """Extract metadata and data of a chunk.
+
+        Args:
+            frames: The metadata frame and the data frame.
+
+        Returns:
+            A list [<metadata>, <payload>].
+        """
+
+        # extract multipart message
+        try:
+            metadata = deserialize_metadata(frames[0])
+        except Exception:
+            self.log.error("Could not extract metadata from the "
+                           "multipart-message.", exc_info=True)
+            metadata = None
+
+        # TODO validate multipart_message
+        # (like correct dict-values for metadata)
+
+        # this does not fail because length was already checked
+        payload = self._decompress(metadata, frames[1])
+
+        return [metadata, payload]
+
+    def _decompress(self, metadata, payload):
+        """Decompress the payload if the sender compressed it.
+
+        The compression entry is removed from the metadata afterwards because
+        it does not apply to the returned data anymore.
+
+        Args:
+            metadata: The metadata of the chunk (modified in place).
+            payload: The data of the chunk.
+
+        Returns:
+            The uncompressed data.
+        """
+
+        try:
+            codec = metadata.pop("compression")
+        except (KeyError, AttributeError):
+            # not compressed or no metadata
+            return payload
+
+        if codec is None:
+            return payload
+
+        try:
+            return decompress(payload, codec)
+        except Exception:
+            self.log.error("Could not decompress chunk %s of %s (codec %s)",
+                           metadata.get("chunk_number"),
+                           metadata.get("filename"), codec, exc_info=True)
+            raise
+
     def check_file_closed(self, metadata, payload):
         """Checks if all chunks were received.
 
@@ -1978,6 +2138,10 @@ class Transfer(Base):
                 pass
             del self.file_descriptors[target]
 
+        if self.pending_chunks:
+            self.log.warning("Not all files of a batch were fetched")
+            self.pending_chunks.clear()
+
         # Send signal that the application is quitting
         if self.signal_socket and self.signal_exchanged:
             self.log.info("Sending close signal")
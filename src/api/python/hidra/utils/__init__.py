@@ -110,6 +110,27 @@ from .utils_network import (
     stop_socket,
 )
 
+from .utils_serialization import (
+    JSON,
+    MSGPACK,
+    get_metadata_formats,
+    negotiate_metadata_format,
+    serialize_metadata,
+    deserialize_metadata,
+    ChunkMetadata,
+    MetadataTemplate
+)
+
+from .utils_compression import (
+    ZLIB,
+    LZ4,
+    ZSTD,
+    get_compression_codecs,
+    negotiate_compression,
+    compress,
+    decompress
+)
+
 from .utils_api import Base
 
 __all__ = [
@@ -186,5 +207,22 @@ __all__ = [
     "set_endpoints",
     "start_socket",
     "stop_socket",
+    # utils_serialization
+    "JSON",
+    "MSGPACK",
+    "get_metadata_formats",
+    "negotiate_metadata_format",
+    "serialize_metadata",
+    "deserialize_metadata",
+    "ChunkMetadata",
+    "MetadataTemplate",
+    # utils_compression
+    "ZLIB",
+    "LZ4",
+    "ZSTD",
+    "get_compression_codecs",
+    "negotiate_compression",
+    "compress",
+    "decompress",
     "Base"
 ]
@@ -0,0 +1,153 @@
+# Copyright (C) 2015  DESY, Manuela Kuhn, Notkestr. 85, D-22607 Hamburg
+#
+# HiDRA is a generic tool set for high performance data multiplexing with
+# different qualities of service and based on Python and ZeroMQ.
+#
+# This software is free: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Manuela Kuhn <manuela.kuhn@desy.de>
+#
+
+"""
+This module provides the compression of the data chunks.
+
+The codec used for a chunk is recorded in its metadata ("compression"). A
+chunk without this entry is not compressed. Which codecs can be used is
+negotiated between sender and receiver (see SET_COMPRESSION signal).
+"""
+
+from __future__ import (absolute_import,
+                        division,
+                        print_function,
+                        unicode_literals)
+
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    # optional dependency
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    # optional dependency
+    zstandard = None
+
+from .utils_datatypes import NotSupported
+
+ZLIB = "zlib"
+LZ4 = "lz4"
+ZSTD = "zstd"
+
+
+def get_compression_codecs():
+    """The codecs supported in this environment (fastest first).
+    """
+
+    codecs = []
+    if lz4 is not None:
+        codecs.append(LZ4)
+    if zstandard is not None:
+        codecs.append(ZSTD)
+    codecs.append(ZLIB)
+
+    return codecs
+
+
+def negotiate_compression(remote_codecs, codec):
+    """Determine the codec to use for a remote side.
+
+    Args:
+        remote_codecs: The codecs the remote side supports.
+        codec: The codec configured on this side (None if compression is
+            disabled).
+
+    Returns:
+        The codec to use or None if the chunks are sent uncompressed.
+    """
+
+    if (codec is None
+            or codec not in remote_codecs
+            or codec not in get_compression_codecs()):
+        return None
+
+    return codec
+
+
+def compress(data, codec, level=None):
+    """Compress a chunk.
+
+    Args:
+        data: The data to compress (bytes-like).
+        codec: The codec to use.
+        level (optional): The compression level (codec specific, None
+            for the default).
+
+    Returns:
+        The compressed data as bytes.
+
+    Raises:
+        NotSupported: The codec is not available.
+    """
+
+    if codec == LZ4 and lz4 is not None:
+        if level is None:
+            return lz4.frame.compress(data)
+        return lz4.frame.compress(data, compression_level=level)
+
+    if codec == ZSTD and zstandard is not None:
+        if level is None:
+            compressor = zstandard.ZstdCompressor()
+        else:
+            compressor = zstandard.ZstdCompressor(level=level)
+        return compressor.compress(data)
+
+    if codec == ZLIB:
+        if level is None:
+            # favour speed, the data is only compressed for the transfer
+            level = 1
+        return zlib.compress(data, level)
+
+    raise NotSupported("Compression codec {} is not available"
+                       .format(codec))
+
+
+def decompress(data, codec):
+    """Decompress a chunk.
+
+    Args:
+        data: The compressed data.
+        codec: The codec the data was compressed with.
+
+    Returns:
+        The decompressed data as bytes.
+
+    Raises:
+        NotSupported: The codec is not available.
+    """
+
+    if codec == LZ4 and lz4 is not None:
+        return lz4.frame.decompress(data)
+
+    if codec == ZSTD and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompress(data)
+
+    if codec == ZLIB:
+        return zlib.decompress(data)
+
+    raise NotSupported("Compression codec {} is not available"
+                       .format(codec))
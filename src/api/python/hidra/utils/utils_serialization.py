@@ -0,0 +1,230 @@
+# Copyright (C) 2015  DESY, Manuela Kuhn, Notkestr. 85, D-22607 Hamburg
+#
+# HiDRA is a generic tool set for high performance data multiplexing with
+# different qualities of service and based on Python and ZeroMQ.
+#
+# This software is free: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Manuela Kuhn <manuela.kuhn@desy.de>
+#
+
+"""
+This module provides the (de)serialization of the metadata sent along with
+the data.
+
+The metadata is encoded as JSON or, if both sides support it, as msgpack.
+The receiving side detects the format from the first byte: JSON is ASCII
+text while msgpack encoded dictionaries start with a byte >= 0x80.
+"""
+
+from __future__ import (absolute_import,
+                        division,
+                        print_function,
+                        unicode_literals)
+
+from collections import namedtuple, OrderedDict
+import json
+
+try:
+    import msgpack
+except ImportError:
+    # optional dependency
+    msgpack = None
+
+from .utils_datatypes import NotSupported
+
+JSON = "json"
+MSGPACK = "msgpack"
+
+
+def get_metadata_formats():
+    """The metadata formats supported in this environment.
+    """
+
+    if msgpack is None:
+        return [JSON]
+    return [JSON, MSGPACK]
+
+
+def negotiate_metadata_format(remote_formats, preferred_format=MSGPACK):
+    """Determine the metadata format to use for a remote side.
+
+    Every remote side understands JSON, older ones do not announce their
+    formats at all.
+
+    Args:
+        remote_formats: The metadata formats the remote side supports (None
+            if unknown).
+        preferred_format (optional): The format to use if supported by both
+            sides.
+
+    Returns:
+        The metadata format to use.
+    """
+
+    if (preferred_format in get_metadata_formats()
+            and preferred_format in (remote_formats or [])):
+        return preferred_format
+
+    return JSON
+
+
+def serialize_metadata(metadata, metadata_format=JSON):
+    """Encode the metadata in the given format.
+
+    Args:
+        metadata: The metadata dictionary or a ChunkMetadata.
+        metadata_format (optional): The format to use (json or msgpack).
+
+    Returns:
+        The encoded metadata as bytes.
+    """
+
+    if isinstance(metadata, ChunkMetadata):
+        return metadata.template.serialize(metadata.chunk_number,
+                                           metadata_format)
+
+    if metadata_format == MSGPACK:
+        if msgpack is None:
+            raise NotSupported("Metadata format msgpack requires the msgpack "
+                               "module to be installed")
+        return msgpack.packb(metadata, use_bin_type=True)
+
+    return json.dumps(metadata).encode("utf-8")
+
+
+class ChunkMetadata(namedtuple("ChunkMetadata",
+                                ["template", "chunk_number"])):
+    """The metadata of one chunk, serialized on demand by its template.
+    """
+
+    __slots__ = ()
+
+    def to_dict(self):
+        """The metadata as dictionary.
+        """
+        return self.template.to_dict(self.chunk_number)
+
+
+class MetadataTemplate(object):
+    """The metadata of a file with a placeholder for the chunk number.
+
+    The metadata of the chunks of a file only differ in the chunk number.
+    Thus the metadata is serialized once per format into a prefix and a
+    suffix, and only the chunk number is encoded for each chunk.
+    """
+
+    key = "chunk_number"
+
+    def __init__(self, metadata):
+        """
+        Args:
+            metadata: The metadata dictionary of the file. Later changes to
+                it are not taken into account.
+        """
+
+        # the chunk number has to be the last entry to be spliced in
+        self.metadata = OrderedDict(
+            (key, value) for key, value in metadata.items()
+            if key != self.key
+        )
+        self.metadata[self.key] = 0
+
+        # entries are of the form <format>: (<prefix>, <suffix>)
+        self._templates = {}
+
+    def chunk(self, chunk_number):
+        """The metadata for a chunk.
+
+        Args:
+            chunk_number: The number of the chunk.
+
+        Returns:
+            A ChunkMetadata which can be passed to serialize_metadata.
+        """
+        return ChunkMetadata(self, chunk_number)
+
+    def to_dict(self, chunk_number):
+        """The metadata of a chunk as dictionary.
+        """
+
+        metadata = dict(self.metadata)
+        metadata[self.key] = chunk_number
+        return metadata
+
+    def _get_template(self, metadata_format):
+        try:
+            return self._templates[metadata_format]
+        except KeyError:
+            pass
+
+        encoded = serialize_metadata(self.metadata, metadata_format)
+
+        # the placeholder 0 is encoded as a single byte in both formats
+        if metadata_format == MSGPACK:
+            suffix = b""
+            placeholder = msgpack.packb(0)
+        else:
+            suffix = b"}"
+            placeholder = b"0"
+
+        if not encoded.endswith(placeholder + suffix):
+            raise NotSupported("Unable to create a metadata template for "
+                               "format {}".format(metadata_format))
+
+        template = (encoded[:-len(placeholder + suffix)], suffix)
+        self._templates[metadata_format] = template
+
+        return template
+
+    def serialize(self, chunk_number, metadata_format=JSON):
+        """Encode the metadata of a chunk.
+
+        Args:
+            chunk_number: The number of the chunk.
+            metadata_format (optional): The format to use (json or msgpack).
+
+        Returns:
+            The encoded metadata as bytes, the same as
+            serialize_metadata(self.to_dict(chunk_number)) would return.
+        """
+
+        prefix, suffix = self._get_template(metadata_format)
+
+        if metadata_format == MSGPACK:
+            value = msgpack.packb(chunk_number)
+        else:
+            value = str(chunk_number).encode("ascii")
+
+        return prefix + value + suffix
+
+
+def deserialize_metadata(message):
+    """Decode metadata independent of the format used.
+
+    Args:
+        message: The encoded metadata (bytes).
+
+    Returns:
+        The metadata dictionary.
+    """
+
+    if message and bytearray(message[:1])[0] >= 0x80:
+        if msgpack is None:
+            raise NotSupported("Received msgpack encoded metadata but the "
+                               "msgpack module is not installed")
+        return msgpack.unpackb(message, raw=False)
+
+    return json.loads(message.decode("utf-8"))
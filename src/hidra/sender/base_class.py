@@ -66,6 +66,8 @@ class Base(object):
 
         self.stats_collect_socket = None
         self.control_socket = None
+        # to tell the DataManager that the sockets are set up
+        self.ready_queue = None
 
         self.stopped = None
 
@@ -334,6 +336,22 @@ class Base(object):
         elif message[0] == b"WAKEUP":
             self.log.debug("Received %s signal without sleeping", message[0])
             self._react_to_wakeup_signal(message)
+
+        elif message[0] == b"DRAIN":
+            self.log.debug("Received %s signal", message[0])
+            self._react_to_drain_signal(message)
+
+        elif message[0] == b"METADATA_FORMAT":
+            self.log.debug("Received %s signal", message[0])
+            self._react_to_metadata_format_signal(message)
+
+        elif message[0] == b"COMPRESSION":
+            self.log.debug("Received %s signal", message[0])
+            self._react_to_compression_signal(message)
+
+        elif message[0] == b"BATCHING":
+            self.log.debug("Received %s signal", message[0])
+            self._react_to_batching_signal(message)
         else:
             self.log.error("Unhandled control signal received: %s",
                            message)
@@ -410,6 +428,30 @@ class Base(object):
                 self._react_to_close_sockets_signal(message)
                 continue
 
+            elif message[0] == b"DRAIN":
+                self.log.debug("Received %s signal while sleeping",
+                               message[0])
+                self._react_to_drain_signal(message)
+                continue
+
+            elif message[0] == b"METADATA_FORMAT":
+                self.log.debug("Received %s signal while sleeping",
+                               message[0])
+                self._react_to_metadata_format_signal(message)
+                continue
+
+            elif message[0] == b"COMPRESSION":
+                self.log.debug("Received %s signal while sleeping",
+                               message[0])
+                self._react_to_compression_signal(message)
+                continue
+
+            elif message[0] == b"BATCHING":
+                self.log.debug("Received %s signal while sleeping",
+                               message[0])
+                self._react_to_batching_signal(message)
+                continue
+
             else:
                 self.log.error("Unhandled control signal received: %s",
                                message)
@@ -424,6 +466,38 @@ class Base(object):
         """
         pass
 
+    def _react_to_drain_signal(self, message):
+        """Action to take place when a data dispatcher should be drained.
+
+        For some child classes action has to take place when a data dispatcher
+        is removed. (They override this method then)
+        """
+        pass
+
+    def _react_to_metadata_format_signal(self, message):
+        """Action to take place when the metadata format of targets changed.
+
+        For some child classes action has to take place when new targets
+        are registered. (They override this method then)
+        """
+        pass
+
+    def _react_to_compression_signal(self, message):
+        """Action to take place when the compression of targets changed.
+
+        For some child classes action has to take place when new targets
+        negotiated the compression. (They override this method then)
+        """
+        pass
+
+    def _react_to_batching_signal(self, message):
+        """Action to take place when targets can receive batches.
+
+        For some child classes action has to take place when new targets
+        negotiated batching. (They override this method then)
+        """
+        pass
+
     def _react_to_exit_signal(self):
         """Action to take place when exit signal received.
 
@@ -432,6 +506,18 @@ class Base(object):
         """
         pass
 
+    def report_ready(self, name):
+        """Tell the DataManager that all sockets are set up.
+
+        Args:
+            name: The name the DataManager knows the process by.
+        """
+
+        if self.ready_queue is None:
+            return
+
+        self.ready_queue.put(name)
+
     def cleanup_base(self):
         """Stop sockets and clean up.
         """
@@ -0,0 +1,166 @@
+# Copyright (C) 2015  DESY, Manuela Kuhn, Notkestr. 85, D-22607 Hamburg
+#
+# HiDRA is a generic tool set for high performance data multiplexing with
+# different qualities of service and based on Python and ZeroMQ.
+#
+# This software is free: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Manuela Kuhn <manuela.kuhn@desy.de>
+#
+
+"""
+This module implements the collection of small files into batches which are
+sent as one message.
+
+A batch is a multipart message consisting of metadata and data frames in
+turns: [<metadata 1>, <data 1>, <metadata 2>, <data 2>, ...]
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import time
+
+__author__ = 'Manuela Kuhn <manuela.kuhn@desy.de>'
+
+
+class Batch(object):
+    """The files collected for one set of targets.
+    """
+
+    def __init__(self, targets, created):
+        self.targets = targets
+        self.created = created
+        self.entries = []
+        self.n_bytes = 0
+
+
+class BatchCollector(object):
+    """Collects files per set of targets until a limit is reached.
+
+    A batch is complete if it contains max_files files or max_bytes bytes or
+    if its first file waits for max_delay seconds.
+    """
+
+    def __init__(self, max_files=100, max_bytes=1048576, max_delay=0.1):
+        """
+        Args:
+            max_files (optional): The maximal number of files per batch.
+            max_bytes (optional): The maximal size of a batch (in bytes).
+            max_delay (optional): How long a file waits for others at most
+                (in s).
+        """
+
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+
+        # entries are of the form <target key>: <batch>
+        self.batches = {}
+
+    @staticmethod
+    def get_key(targets):
+        """The key identifying a set of targets.
+
+        Args:
+            targets: A list of targets of the form
+                [[<host:port>, <prio>, <send_type>], ...]
+        """
+        return tuple((target[0], target[1]) for target in targets)
+
+    def fits(self, n_bytes):
+        """Check if a file of the given size can be batched at all.
+        """
+        return 0 < n_bytes <= self.max_bytes
+
+    def add(self, targets, entry, n_bytes, now=None):
+        """Add a file to the batch of its targets.
+
+        Args:
+            targets: The data targets of the file.
+            entry: The file to add.
+            n_bytes: The size of the file.
+            now (optional): The current time (in s).
+
+        Returns:
+            A list of the batches completed by adding this file.
+        """
+
+        if now is None:
+            now = time.time()
+
+        key = self.get_key(targets)
+        complete = []
+
+        # do not exceed the size limit
+        batch = self.batches.get(key)
+        if batch is not None and batch.n_bytes + n_bytes > self.max_bytes:
+            complete.append(self.batches.pop(key))
+
+        try:
+            batch = self.batches[key]
+        except KeyError:
+            batch = Batch(targets, now)
+            self.batches[key] = batch
+
+        batch.entries.append(entry)
+        batch.n_bytes += n_bytes
+
+        if (len(batch.entries) >= self.max_files
+                or batch.n_bytes >= self.max_bytes):
+            complete.append(self.batches.pop(key))
+
+        return complete
+
+    def pop_expired(self, now=None):
+        """Get the batches waiting for longer than max_delay.
+
+        Args:
+            now (optional): The current time (in s).
+        """
+
+        if now is None:
+            now = time.time()
+
+        expired = [key for key, batch in self.batches.items()
+                   if now - batch.created >= self.max_delay]
+
+        return [self.batches.pop(key) for key in expired]
+
+    def pop_all(self):
+        """Get all batches independent of their state.
+        """
+
+        batches = list(self.batches.values())
+        self.batches = {}
+        return batches
+
+    def get_timeout(self, now=None):
+        """The time until the next batch expires (in s).
+
+        Returns:
+            The time in seconds or None if there are no batches waiting.
+        """
+
+        if not self.batches:
+            return None
+
+        if now is None:
+            now = time.time()
+
+        oldest = min(batch.created for batch in self.batches.values())
+        return max(0, oldest + self.max_delay - now)
@@ -0,0 +1,136 @@
+# Copyright (C) 2015  DESY, Manuela Kuhn, Notkestr. 85, D-22607 Hamburg
+#
+# HiDRA is a generic tool set for high performance data multiplexing with
+# different qualities of service and based on Python and ZeroMQ.
+#
+# This software is free: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Manuela Kuhn <manuela.kuhn@desy.de>
+#
+
+"""
+This module implements a pool of read buffers which are reused as soon as
+ZMQ does not need them anymore.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import deque
+import threading
+
+__author__ = 'Manuela Kuhn <manuela.kuhn@desy.de>'
+
+
+class BufferPool(object):
+    """Recycles the buffers the file chunks are read into.
+
+    Messages sent with copy=False reference the buffer until ZMQ has sent
+    them. Thus a buffer is handed out again only after all trackers of the
+    messages sent from it are done. If all buffers are still in use a new one
+    is allocated. Buffers which exceed the pool size are not recycled but left
+    to ZMQ and the garbage collector.
+    """
+
+    def __init__(self, max_buffers=4):
+        """
+        Args:
+            max_buffers (optional): How many buffers to keep for reuse.
+        """
+
+        self.max_buffers = max_buffers
+
+        self.free = []
+        # entries are of the form (<buffer>, [<tracker>, ...])
+        # the oldest buffer is first
+        self.in_use = deque()
+
+        self.n_allocated = 0
+        self.n_reused = 0
+
+        # buffers are read into from the read ahead thread
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _is_done(trackers):
+        return all(tracker.done for tracker in trackers)
+
+    def _collect(self):
+        # buffers are usually sent in order, stop at the first one in use
+        while self.in_use and self._is_done(self.in_use[0][1]):
+            buf, _ = self.in_use.popleft()
+            self.free.append(buf)
+
+    def get(self, size):
+        """Get a buffer which can be written to.
+
+        Args:
+            size: The minimal size of the buffer (in bytes).
+
+        Returns:
+            A bytearray of at least the requested size.
+        """
+
+        with self.lock:
+            self._collect()
+
+            while self.free:
+                buf = self.free.pop()
+                # buffers of the wrong size are dropped, e.g. the chunk size
+                # changed
+                if len(buf) >= size:
+                    self.n_reused += 1
+                    return buf
+
+            self.n_allocated += 1
+
+        return bytearray(size)
+
+    def put(self, buf, trackers=None):
+        """Give back a buffer.
+
+        Args:
+            buf: A buffer got from get.
+            trackers (optional): The trackers of the messages still
+                referencing the buffer.
+        """
+
+        trackers = [t for t in trackers or [] if t is not None]
+
+        with self.lock:
+            if not trackers:
+                if len(self.free) + len(self.in_use) < self.max_buffers:
+                    self.free.append(buf)
+                return
+
+            self.in_use.append((buf, trackers))
+
+            # do not keep track of too many buffers, ZMQ keeps the unsent
+            # ones alive on its own
+            while len(self.free) + len(self.in_use) > self.max_buffers:
+                if self.free:
+                    self.free.pop()
+                else:
+                    self.in_use.popleft()
+
+    def clear(self):
+        """Release all buffers.
+        """
+
+        with self.lock:
+            self.free = []
+            self.in_use.clear()
@@ -0,0 +1,180 @@
+# Copyright (C) 2015  DESY, Manuela Kuhn, Notkestr. 85, D-22607 Hamburg
+#
+# HiDRA is a generic tool set for high performance data multiplexing with
+# different qualities of service and based on Python and ZeroMQ.
+#
+# This software is free: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Manuela Kuhn <manuela.kuhn@desy.de>
+#
+
+"""
+This module implements reading a file in chunks, optionally ahead of time.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import queue
+import sys
+import threading
+
+__author__ = 'Manuela Kuhn <manuela.kuhn@desy.de>'
+
+
+class ChunkReader(object):
+    """Reads a file chunk by chunk.
+
+    With read ahead enabled a background thread reads the next chunks while
+    the current one is sent, so that disk and network are busy at the same
+    time. This only pays off for files consisting of multiple chunks, smaller
+    ones are read directly.
+    """
+
+    # how often to check if reading was stopped (in s)
+    poll_interval = 0.1
+
+    def __init__(self,
+                 file_descriptor,
+                 chunksize,
+                 buffer_pool=None,
+                 read_ahead=0,
+                 filesize=None):
+        """
+        Args:
+            file_descriptor: The file opened in binary mode.
+            chunksize: The size of the chunks to read (in bytes).
+            buffer_pool (optional): A BufferPool to read the chunks into.
+                Without one a new bytes object is created for each chunk.
+            read_ahead (optional): How many chunks to keep ready (0 disables
+                reading ahead).
+            filesize (optional): The size of the file if known.
+        """
+
+        self.file_descriptor = file_descriptor
+        self.chunksize = chunksize
+        self.buffer_pool = buffer_pool
+
+        self.queue = None
+        self.thread = None
+        self.stop_reading = threading.Event()
+
+        if filesize is not None and filesize <= chunksize:
+            read_ahead = 0
+
+        if read_ahead > 0:
+            self._advise_sequential()
+
+            self.queue = queue.Queue(maxsize=read_ahead)
+            self.thread = threading.Thread(target=self._read_ahead)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _advise_sequential(self):
+        # lets the kernel read ahead more aggressively
+        try:
+            os.posix_fadvise(self.file_descriptor.fileno(), 0, 0,
+                             os.POSIX_FADV_SEQUENTIAL)
+        except (AttributeError, OSError):
+            # not available on this platform or filesystem
+            pass
+
+    def _read_chunk(self):
+        if self.buffer_pool is None:
+            return None, self.file_descriptor.read(self.chunksize)
+
+        buf = self.buffer_pool.get(self.chunksize)
+        n_bytes = self.file_descriptor.readinto(
+            memoryview(buf)[:self.chunksize]
+        )
+
+        return buf, memoryview(buf)[:n_bytes]
+
+    def _put(self, item):
+        while not self.stop_reading.is_set():
+            try:
+                self.queue.put(item, timeout=self.poll_interval)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _read_ahead(self):
+        while not self.stop_reading.is_set():
+            try:
+                buf, chunk = self._read_chunk()
+            except Exception:
+                self._put((None, None, sys.exc_info()[1]))
+                return
+
+            if not self._put((buf, chunk, None)):
+                self._give_back(buf)
+                return
+
+            # end of file
+            if not chunk:
+                return
+
+    def _give_back(self, buf):
+        if buf is not None and self.buffer_pool is not None:
+            self.buffer_pool.put(buf)
+
+    def read(self):
+        """Get the next chunk.
+
+        Returns:
+            A tuple (<buffer>, <chunk>) where buffer has to be given back to
+            the buffer pool (None if not used) and chunk is the data read. At
+            the end of the file the chunk is empty.
+        """
+
+        if self.queue is None:
+            return self._read_chunk()
+
+        buf, chunk, excp = self.queue.get()
+        if excp is not None:
+            raise excp
+
+        return buf, chunk
+
+    def close(self):
+        """Stop reading ahead.
+
+        Has to be called before the file is closed.
+        """
+
+        if self.thread is None:
+            return
+
+        self.stop_reading.set()
+
+        # unblock the reader and give back the chunks read too much
+        while self.thread.is_alive():
+            self._drain()
+            self.thread.join(self.poll_interval)
+        self._drain()
+
+        self.thread = None
+
+    def _drain(self):
+        while True:
+            try:
+                buf, _, _ = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            self._give_back(buf)
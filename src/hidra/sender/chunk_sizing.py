@@ -0,0 +1,185 @@
+# Copyright (C) 2015  DESY, Manuela Kuhn, Notkestr. 85, D-22607 Hamburg
+#
+# HiDRA is a generic tool set for high performance data multiplexing with
+# different qualities of service and based on Python and ZeroMQ.
+#
+# This software is free: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Manuela Kuhn <manuela.kuhn@desy.de>
+#
+
+"""
+This module implements choosing the chunk size per file.
+
+The chunk size is recorded in the metadata of each file, thus the receiver
+detects the last chunk independent of the size chosen.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+__author__ = 'Manuela Kuhn <manuela.kuhn@desy.de>'
+
+
+def _round_up_to_power_of_two(value):
+    # keeps the number of different buffer sizes small so that they can be
+    # reused
+    return 1 << max(int(value) - 1, 0).bit_length()
+
+
+class ChunkSizer(object):
+    """Chooses the chunk size from the file size and the throughput.
+
+    A chunk should take about chunk_duration seconds to be sent to the
+    slowest target of the file, so that fast targets get few large messages
+    and slow ones get smaller messages which do not block others for long.
+    Files smaller than this are sent in one chunk only as large as needed.
+    The throughput is estimated per target from the files sent before. As
+    long as no estimate exists the default chunk size is used.
+    """
+
+    # weight of the newest measurement in the throughput estimate
+    smoothing = 0.2
+
+    def __init__(self,
+                 chunksize,
+                 min_chunksize=65536,
+                 max_chunksize=67108864,
+                 chunk_duration=0.1):
+        """
+        Args:
+            chunksize: The chunk size to use as long as the throughput is
+                unknown (in bytes).
+            min_chunksize (optional): The smallest chunk size to use
+                (in bytes).
+            max_chunksize (optional): The largest chunk size to use
+                (in bytes).
+            chunk_duration (optional): How long sending a chunk should take
+                (in s).
+        """
+
+        self.chunksize = chunksize
+        self.min_chunksize = min_chunksize
+        self.max_chunksize = max_chunksize
+        self.chunk_duration = chunk_duration
+
+        # entries are of the form <host:port>: <bytes/s>
+        self.throughput = {}
+
+    def _clamp(self, chunksize):
+        return int(max(self.min_chunksize, min(chunksize, self.max_chunksize)))
+
+    def get_throughput(self, targets):
+        """The throughput of the slowest target.
+
+        Args:
+            targets: A list of targets of the form
+                [[<host:port>, <prio>, <send_type>], ...]
+
+        Returns:
+            The throughput in bytes/s or None if unknown for all targets.
+        """
+
+        rates = [self.throughput[target[0]] for target in targets
+                 if target[0] in self.throughput]
+
+        if not rates:
+            return None
+        return min(rates)
+
+    def get_chunksize(self, filesize, targets):
+        """Choose the chunk size for a file.
+
+        Args:
+            filesize: The size of the file (in bytes).
+            targets: The data targets of the file.
+
+        Returns:
+            The chunk size (in bytes).
+        """
+
+        throughput = self.get_throughput(targets)
+        if throughput is None:
+            chunksize = self.chunksize
+        else:
+            chunksize = _round_up_to_power_of_two(
+                throughput * self.chunk_duration
+            )
+
+        chunksize = self._clamp(chunksize)
+
+        if filesize is not None and filesize < chunksize:
+            chunksize = self._clamp(_round_up_to_power_of_two(filesize))
+
+        return chunksize
+
+    def record(self, targets, n_bytes, duration):
+        """Update the throughput estimate of the targets.
+
+        Files smaller than min_chunksize are ignored because their sending
+        time is dominated by the per message overhead.
+
+        Args:
+            targets: The targets the data was sent to.
+            n_bytes: The amount of data sent.
+            duration: How long it took (in s).
+        """
+
+        if n_bytes < self.min_chunksize or duration <= 0:
+            return
+
+        rate = n_bytes / duration
+
+        for target in targets:
+            try:
+                self.throughput[target[0]] += (
+                    self.smoothing * (rate - self.throughput[target[0]])
+                )
+            except KeyError:
+                self.throughput[target[0]] = rate
+
+
+class ChunksizeStats(object):
+    """Collects which chunk sizes were chosen.
+    """
+
+    def __init__(self):
+        self.sizes = {}
+
+    def add(self, chunksize, filesize):
+        """Add a file.
+
+        Args:
+            chunksize: The chunk size chosen for the file.
+            filesize: The size of the file.
+        """
+
+        # keys have to be strings to be exposed as JSON
+        key = str(chunksize)
+        try:
+            stats = self.sizes[key]
+        except KeyError:
+            stats = {"files": 0, "bytes": 0}
+            self.sizes[key] = stats
+
+        stats["files"] += 1
+        stats["bytes"] += filesize
+
+    def summary(self):
+        """The number of files and bytes per chunk size.
+        """
+        return dict((key, dict(stats)) for key, stats in self.sizes.items())
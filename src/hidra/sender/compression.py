@@ -0,0 +1,206 @@
+# Copyright (C) 2015  DESY, Manuela Kuhn, Notkestr. 85, D-22607 Hamburg
+#
+# HiDRA is a generic tool set for high performance data multiplexing with
+# different qualities of service and based on Python and ZeroMQ.
+#
+# This software is free: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Manuela Kuhn <manuela.kuhn@desy.de>
+#
+
+"""
+This module implements the compression of the data chunks in the sender.
+
+The chunks are compressed in worker threads so that the next chunk is
+compressed while the current one is sent. Compressing is skipped for files
+which do not get smaller, either known from their suffix (e.g. CBF files are
+compressed already) or from the ratio measured for earlier files.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # python 2 without the futures backport
+    ThreadPoolExecutor = None
+
+import hidra.utils as utils
+
+__author__ = 'Manuela Kuhn <manuela.kuhn@desy.de>'
+
+# file types which are compressed already
+DEFAULT_SKIP_SUFFIXES = [".cbf", ".gz", ".bz2", ".xz", ".zip", ".lz4",
+                         ".zst", ".jpg", ".jpeg", ".png"]
+
+
+class CompressionPolicy(object):
+    """Decides which files are worth compressing.
+
+    The ratio (compressed size / original size) is tracked per file suffix.
+    Suffixes not compressing below min_ratio are skipped, but probed again
+    every probe_interval files in case the data changed.
+    """
+
+    def __init__(self,
+                 skip_suffixes=None,
+                 min_ratio=0.9,
+                 probe_interval=100):
+        """
+        Args:
+            skip_suffixes (optional): The suffixes of the files never to
+                compress (None for the default list).
+            min_ratio (optional): The ratio a chunk has to be compressed to
+                at least to send it compressed.
+            probe_interval (optional): After how many skipped files to try
+                compressing a suffix again.
+        """
+
+        if skip_suffixes is None:
+            skip_suffixes = DEFAULT_SKIP_SUFFIXES
+
+        self.skip_suffixes = set(suffix.lower() for suffix in skip_suffixes)
+        self.min_ratio = min_ratio
+        self.probe_interval = probe_interval
+
+        # entries are of the form <suffix>: <number of files skipped>
+        self.incompressible = {}
+
+    @staticmethod
+    def get_suffix(filename):
+        """The suffix identifying the file type.
+        """
+        return os.path.splitext(filename)[1].lower()
+
+    def pays_off(self, n_bytes, n_compressed):
+        """Check if the compressed chunk is worth sending.
+
+        Args:
+            n_bytes: The size of the original chunk.
+            n_compressed: The size of the compressed chunk.
+        """
+        return n_compressed <= n_bytes * self.min_ratio
+
+    def should_compress(self, filename):
+        """Check if a file should be compressed.
+
+        Args:
+            filename: The name of the file.
+        """
+
+        suffix = self.get_suffix(filename)
+
+        if suffix in self.skip_suffixes:
+            return False
+
+        try:
+            self.incompressible[suffix] += 1
+        except KeyError:
+            return True
+
+        if self.incompressible[suffix] > self.probe_interval:
+            # try again
+            del self.incompressible[suffix]
+            return True
+
+        return False
+
+    def record(self, filename, n_bytes, n_compressed):
+        """Remember how well a file was compressed.
+
+        Args:
+            filename: The name of the file.
+            n_bytes: The size of the original data.
+            n_compressed: The size of the compressed data.
+        """
+
+        suffix = self.get_suffix(filename)
+
+        if self.pays_off(n_bytes, n_compressed):
+            self.incompressible.pop(suffix, None)
+        else:
+            self.incompressible.setdefault(suffix, 0)
+
+
+class ChunkCompressor(object):
+    """Compresses chunks in the background.
+    """
+
+    def __init__(self, codec, level=None, threads=1):
+        """
+        Args:
+            codec: The codec to compress with.
+            level (optional): The compression level (None for the default of
+                the codec).
+            threads (optional): How many chunks to compress in parallel (0
+                compresses in the calling thread).
+        """
+
+        self.codec = codec
+        self.level = level
+        self.executor = None
+
+        if threads > 0 and ThreadPoolExecutor is not None:
+            self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    def _compress(self, chunk):
+        return utils.compress(chunk, self.codec, self.level)
+
+    def submit(self, chunk):
+        """Start compressing a chunk.
+
+        The chunk must not be modified until the compression is done.
+
+        Args:
+            chunk: The data to compress.
+
+        Returns:
+            A future whose result is the compressed chunk.
+        """
+
+        if self.executor is None:
+            try:
+                return _Done(result=self._compress(chunk))
+            except Exception as excp:
+                return _Done(exception=excp)
+
+        return self.executor.submit(self._compress, chunk)
+
+    def stop(self):
+        """Stop the worker threads.
+        """
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+
+class _Done(object):
+    """A result which is available already (mimics a future).
+    """
+
+    def __init__(self, result=None, exception=None):
+        self._result = result
+        self._exception = exception
+
+    def result(self):
+        if self._exception is not None:
+            raise self._exception
+        return self._result
@@ -0,0 +1,313 @@
+# Copyright (C) 2015  DESY, Manuela Kuhn, Notkestr. 85, D-22607 Hamburg
+#
+# HiDRA is a generic tool set for high performance data multiplexing with
+# different qualities of service and based on Python and ZeroMQ.
+#
+# This software is free: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Manuela Kuhn <manuela.kuhn@desy.de>
+#
+
+"""
+This module implements copying and moving files with the fastest method
+available.
+
+The data is copied inside of the kernel if possible instead of reading it
+into Python and writing it out again:
+- reflink: the target shares the data blocks with the source (e.g. XFS,
+  btrfs), nothing is copied at all
+- copy_file_range: the filesystem copies the data (server-side copy on some
+  network filesystems)
+- sendfile: the kernel copies the data between the page caches
+- userspace: the data is copied by Python (shutil)
+
+A method not supported by the target filesystem is not tried again for it.
+Moving a file is a rename if source and target are on the same filesystem.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import errno
+import os
+import shutil
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows
+    fcntl = None
+
+__author__ = 'Manuela Kuhn <manuela.kuhn@desy.de>'
+
+
+REFLINK = "reflink"
+COPY_FILE_RANGE = "copy_file_range"
+SENDFILE = "sendfile"
+USERSPACE = "userspace"
+RENAME = "rename"
+
+# in the order they are tried
+COPY_METHODS = [REFLINK, COPY_FILE_RANGE, SENDFILE]
+
+# from linux/fs.h
+FICLONE = 0x40049409
+
+# the method is not supported for this combination of files
+UNSUPPORTED_ERRNOS = set([
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+    getattr(errno, "ENOTSUP", errno.EOPNOTSUPP),
+    errno.EBADF,
+])
+
+# copy_file_range and sendfile are limited to ~2 GiB per call on some
+# systems
+MAX_COPY_SIZE = 2**30
+
+
+class MethodNotSupported(Exception):
+    """The copy method cannot be used for these files.
+    """
+    pass
+
+
+def _reflink(source_fd, target_fd, size):
+    if fcntl is None:
+        raise MethodNotSupported()
+
+    try:
+        fcntl.ioctl(target_fd, FICLONE, source_fd)
+    except (IOError, OSError) as excp:
+        if excp.errno in UNSUPPORTED_ERRNOS:
+            raise MethodNotSupported()
+        raise
+
+
+def _copy_file_range(source_fd, target_fd, size):
+    if not hasattr(os, "copy_file_range"):
+        raise MethodNotSupported()
+
+    copied = 0
+    while copied < size:
+        try:
+            n_bytes = os.copy_file_range(
+                source_fd, target_fd, min(size - copied, MAX_COPY_SIZE)
+            )
+        except OSError as excp:
+            if excp.errno in UNSUPPORTED_ERRNOS and copied == 0:
+                raise MethodNotSupported()
+            raise
+
+        if n_bytes == 0:
+            # the file was truncated in the meantime
+            break
+        copied += n_bytes
+
+
+def _sendfile(source_fd, target_fd, size):
+    if not hasattr(os, "sendfile"):
+        raise MethodNotSupported()
+
+    copied = 0
+    while copied < size:
+        try:
+            n_bytes = os.sendfile(target_fd, source_fd, copied,
+                                  min(size - copied, MAX_COPY_SIZE))
+        except OSError as excp:
+            if excp.errno in UNSUPPORTED_ERRNOS and copied == 0:
+                raise MethodNotSupported()
+            raise
+
+        if n_bytes == 0:
+            break
+        copied += n_bytes
+
+
+_COPY_FUNCTIONS = {
+    REFLINK: _reflink,
+    COPY_FILE_RANGE: _copy_file_range,
+    SENDFILE: _sendfile,
+}
+
+
+class CopyEngine(object):
+    """Copies and moves files with the fastest method available.
+
+    The methods used are recorded, see pop_records.
+    """
+
+    def __init__(self, methods=None):
+        """
+        Args:
+            methods (optional): The kernel copy methods to try in this order
+                (default: all). If none work the file is copied in userspace.
+        """
+
+        if methods is None:
+            methods = COPY_METHODS
+
+        for method in methods:
+            if method not in _COPY_FUNCTIONS:
+                raise ValueError("Copy method {} is not supported"
+                                 .format(method))
+
+        self.methods = list(methods)
+
+        # the methods known to fail per (<source device>, <target device>)
+        self.unsupported = {}
+
+        # entries are of the form (<method>, <bytes>, <duration in s>)
+        self.records = []
+
+    def _copy_data(self, source, target):
+        with open(source, "rb") as source_fd:
+            source_stat = os.fstat(source_fd.fileno())
+            size = source_stat.st_size
+
+            with open(target, "wb") as target_fd:
+                devices = (source_stat.st_dev,
+                           os.fstat(target_fd.fileno()).st_dev)
+                unsupported = self.unsupported.setdefault(devices, set())
+
+                for method in self.methods:
+                    if method in unsupported:
+                        continue
+
+                    try:
+                        _COPY_FUNCTIONS[method](source_fd.fileno(),
+                                                target_fd.fileno(),
+                                                size)
+                        return method, size
+                    except MethodNotSupported:
+                        unsupported.add(method)
+                        # start again, e.g. for a partly written target
+                        source_fd.seek(0)
+                        target_fd.seek(0)
+                        target_fd.truncate()
+
+                shutil.copyfileobj(source_fd, target_fd)
+
+        return USERSPACE, size
+
+    def copy(self, source, target):
+        """Copy the file and its permission bits (like shutil.copy).
+
+        Args:
+            source: The path of the file to copy.
+            target: The path of the copy (not a directory).
+
+        Returns:
+            The method used.
+        """
+
+        start = time.time()
+
+        method, size = self._copy_data(source, target)
+        shutil.copymode(source, target)
+
+        self.records.append((method, size, time.time() - start))
+        return method
+
+    def move(self, source, target):
+        """Move the file (like shutil.move).
+
+        A rename if on the same filesystem, otherwise the file is copied with
+        its metadata and removed afterwards.
+
+        Args:
+            source: The path of the file to move.
+            target: The new path of the file (not a directory).
+
+        Returns:
+            The method used.
+        """
+
+        start = time.time()
+
+        try:
+            os.rename(source, target)
+            self.records.append((RENAME, 0, time.time() - start))
+            return RENAME
+        except OSError:
+            # e.g. on different filesystems, as in shutil.move the copy
+            # raises the error if it is a real problem
+            pass
+
+        method, size = self._copy_data(source, target)
+        shutil.copystat(source, target)
+        os.unlink(source)
+
+        self.records.append((method, size, time.time() - start))
+        return method
+
+    def pop_records(self):
+        """The copies done since the last call.
+
+        Returns:
+            A list of (<method>, <bytes>, <duration in s>) entries.
+        """
+
+        records = self.records
+        self.records = []
+        return records
+
+
+class CopyStats(object):
+    """Collects how much data was copied with which method.
+    """
+
+    def __init__(self):
+        self.methods = {}
+
+    def add(self, method, n_bytes, duration):
+        """Add a copied file.
+
+        Args:
+            method: The method used.
+            n_bytes: The size of the file.
+            duration: How long the copy took (in s).
+        """
+
+        try:
+            stats = self.methods[method]
+        except KeyError:
+            stats = {"files": 0, "bytes": 0, "seconds": 0.0}
+            self.methods[method] = stats
+
+        stats["files"] += 1
+        stats["bytes"] += n_bytes
+        stats["seconds"] += duration
+
+    def summary(self):
+        """The totals and the throughput (in bytes/s) per method.
+        """
+
+        summary = {}
+        for method, stats in self.methods.items():
+            summary[method] = dict(stats)
+            if stats["seconds"] > 0:
+                summary[method]["throughput"] = (stats["bytes"]
+                                                 / stats["seconds"])
+            else:
+                summary[method]["throughput"] = None
+
+        return summary
@@ -41,12 +41,63 @@ import time
 import zmq
 
 from base_class import Base
+import latency_tracing
 import hidra.utils as utils
 from hidra import __version__
 
 __author__ = 'Manuela Kuhn <manuela.kuhn@desy.de>'
 
 
+class ByteBudget(object):
+    """
+    Limits the number of bytes the data handlers of one data dispatcher have
+    in flight at the same time.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes_in_flight = 0
+        self.files_in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size, stop_request, timeout=1):
+        """Wait till the file fits into the budget.
+
+        A file larger than the whole budget is accepted if no other file is
+        in flight, otherwise it would never be sent.
+
+        Args:
+            size: The size of the file in bytes.
+            stop_request: A threading event to abort the waiting.
+            timeout (optional): How often to check for the stop request
+                (in s).
+
+        Returns:
+            True if the budget was acquired, False if it was stopped.
+        """
+
+        with self.condition:
+            while (self.files_in_flight
+                   and self.bytes_in_flight + size > self.max_bytes):
+                if stop_request.is_set():
+                    return False
+                self.condition.wait(timeout)
+
+            self.bytes_in_flight += size
+            self.files_in_flight += 1
+
+        return True
+
+    def release(self, size):
+        """Return the budget of a finished file.
+        """
+
+        with self.condition:
+            self.bytes_in_flight -= size
+            self.files_in_flight -= 1
+            self.condition.notify_all()
+
+
 class DataHandler(Base):
     """
     Reads the data using the configured module type and send it to the targets.
@@ -62,11 +113,19 @@ class DataHandler(Base):
                  log_queue,
                  log_level,
                  context,
-                 stop_request):
+                 stop_request,
+                 handler_id=None,
+                 byte_budget=None):
 
         super().__init__()
 
         self.dispatcher_id = dispatcher_id
+        # to distinguish multiple data handlers of the same dispatcher
+        if handler_id is None:
+            self.handler_id = dispatcher_id
+        else:
+            self.handler_id = "{}-{}".format(dispatcher_id, handler_id)
+        self.byte_budget = byte_budget
         self.endpoints = endpoints
         self.fixed_stream_addr = fixed_stream_addr
         self.config_all = config
@@ -87,11 +146,15 @@ class DataHandler(Base):
         self.control_socket = None
         self.router_socket = None
 
+        self.use_credit_dispatch = None
+        # the task provider requested to stop this data handler only
+        self.drained = False
+
     def _setup(self):
         """Initializes parameters and creates sockets.
         """
 
-        log_name = "DataHandler-{}".format(self.dispatcher_id)
+        log_name = "DataHandler-{}".format(self.handler_id)
         self.log = utils.get_logger(log_name,
                                     queue=self.log_queue,
                                     log_level=self.log_level)
@@ -111,7 +174,7 @@ class DataHandler(Base):
         datafetcher_base_config = {
             "config": self.config_all,
             "log_queue": self.log_queue,
-            "fetcher_id": self.dispatcher_id,
+            "fetcher_id": self.handler_id,
             "context": self.context,
             "lock": self.lock,
             "stop_request": self.stop_request,
@@ -120,6 +183,14 @@ class DataHandler(Base):
 
         self.datafetcher = datafetcher_m.DataFetcher(datafetcher_base_config)
 
+        try:
+            self.use_credit_dispatch = self.config_df["use_credit_dispatch"]
+        except KeyError:
+            self.use_credit_dispatch = False
+
+        if self.config.get("use_statserver", False):
+            self.setup_stats_collection()
+
         try:
             self.create_sockets()
         except Exception:
@@ -142,12 +213,38 @@ class DataHandler(Base):
         self.control_socket.setsockopt_string(zmq.SUBSCRIBE, "signal")
 
         # socket to get new workloads from
-        self.router_socket = self.start_socket(
-            name="router_socket",
-            sock_type=zmq.PULL,
-            sock_con="connect",
-            endpoint=self.endpoints.router_con
-        )
+        if self.use_credit_dispatch:
+            self.router_socket = self.start_socket(
+                name="router_socket",
+                sock_type=zmq.DEALER,
+                sock_con="connect",
+                endpoint=self.endpoints.router_con,
+                socket_options=[
+                    [zmq.IDENTITY, self.handler_id.encode("utf-8")]
+                ]
+            )
+
+            # announce how much work the dispatcher can take, the capacity
+            # is shared by all its data handlers
+            try:
+                capacity_bytes = self.config_df["dispatcher_capacity"]
+            except KeyError:
+                capacity_bytes = 1073741824  # 1 GiB
+            try:
+                capacity_jobs = self.config_df["dispatcher_files_in_flight"]
+            except KeyError:
+                capacity_jobs = 1
+            capacity = {"bytes": capacity_bytes, "jobs": capacity_jobs}
+            self.router_socket.send_multipart(
+                [b"READY", json.dumps(capacity).encode("utf-8")]
+            )
+        else:
+            self.router_socket = self.start_socket(
+                name="router_socket",
+                sock_type=zmq.PULL,
+                sock_con="connect",
+                endpoint=self.endpoints.router_con
+            )
 
         self.poller = zmq.Poller()
         self.poller.register(self.control_socket, zmq.POLLIN)
@@ -182,7 +279,9 @@ class DataHandler(Base):
         try:
             self._run()
         finally:
-            self.stop()
+            # when drained the other parts of hidra continue running
+            if not self.drained:
+                self.stop()
             self.cleanup()
 
     def _run(self):
@@ -193,8 +292,15 @@ class DataHandler(Base):
 
         while not self.stop_request.is_set():
             self.log.debug("Waiting for new job")
+
+            # data held back by the data fetcher has to be sent in time
+            timeout = self.datafetcher.get_flush_timeout()
+            if timeout is not None:
+                # in ms
+                timeout = timeout * 1000
+
             try:
-                socks = dict(self.poller.poll())
+                socks = dict(self.poller.poll(timeout))
             except zmq.ZMQError:
                 # when stop is called without a control signal
                 # -> suppress error message
@@ -215,70 +321,24 @@ class DataHandler(Base):
                                    exc_info=True)
                     continue
 
-                metadata = json.loads(message[0].decode("utf-8"))
-
-                # add fixed streaming address to targets
-                if len(message) >= 2:
-
-                    targets = json.loads(message[1].decode("utf-8"))
-
-                    if self.fixed_stream_addr:
-                        targets.insert(0, fixed_stream_addr)
-                        self.log.debug("Added fixed_stream_addr %s to targets "
-                                       "%s", fixed_stream_addr, targets)
-
-                    # sort the target list by the priority
-                    targets = sorted(targets, key=lambda target: target[1])
-
-                else:
-                    if (isinstance(metadata, list)
-                            and metadata[0] == b"CLOSE_FILE"):
+                job_id = None
+                if self.use_credit_dispatch:
+                    if message == [b"STOP"]:
+                        self.log.info("Requested to stop by the task "
+                                      "provider.")
+                        self.drained = True
+                        break
 
-                        self._react_to_close_file_message(message)
-                        continue
+                    # the jobs are of the form [<job id>, <metadata>, ...]
+                    job_id = message.pop(0)
 
-                    elif self.fixed_stream_addr:
-                        targets = [fixed_stream_addr]
-                        self.log.debug("Added fixed_stream_addr to targets "
-                                       "%s.", targets)
-
-                    else:
-                        targets = []
-
-                metadata["version"] = __version__
-
-                # get metadata and paths of the file
                 try:
-                    self.log.debug("Getting file paths and metadata")
-                    # additional information is stored in the metadata dict
-                    self.datafetcher.get_metadata(targets, metadata)
+                    stop_flag = self._handle_job(message, fixed_stream_addr)
+                finally:
+                    self._release_credit(job_id)
 
-                except KeyboardInterrupt:
+                if stop_flag:
                     break
-                except Exception:
-                    self.log.error("Building of metadata dictionary failed "
-                                   "for metadata: %s", metadata,
-                                   exc_info=True)
-                    # skip all further instructions and
-                    # continue with next iteration
-                    continue
-
-                # send data
-                try:
-                    self.datafetcher.send_data(targets, metadata,
-                                               self.open_connections)
-                except Exception:
-                    self.log.error("Passing new file to data stream...failed",
-                                   exc_info=True)
-
-                # finish data handling
-                try:
-                    self.datafetcher.finish(targets, metadata,
-                                            self.open_connections)
-                except Exception:
-                    # datafetcher/datahandler was not stopped in the meantime
-                    if self.datafetcher is not None:
-                        self.log.error("Finishing file failed.", exc_info=True)
 
             # ----------------------------------------------------------------
             # control commands
@@ -290,6 +350,148 @@ class DataHandler(Base):
                 if self.check_control_signal():
                     break
 
+            try:
+                self.datafetcher.flush(self.open_connections)
+            except Exception:
+                self.log.error("Flushing data fetcher failed", exc_info=True)
+
+    def _handle_job(self, message, fixed_stream_addr):
+        """Get the metadata of a file, send it and finish it.
+
+        Args:
+            message: The job as received from the task provider.
+            fixed_stream_addr: The target of the data stream (if enabled).
+
+        Returns:
+            A boolean indicating if the data handler should be stopped
+            (True means stop).
+        """
+
+        metadata = json.loads(message[0].decode("utf-8"))
+        latency_tracing.mark(metadata, "dispatched")
+
+        # add fixed streaming address to targets
+        if len(message) >= 2:
+
+            targets = json.loads(message[1].decode("utf-8"))
+
+            if self.fixed_stream_addr:
+                targets.insert(0, fixed_stream_addr)
+                self.log.debug("Added fixed_stream_addr %s to targets "
+                               "%s", fixed_stream_addr, targets)
+
+            # sort the target list by the priority
+            targets = sorted(targets, key=lambda target: target[1])
+
+        else:
+            if (isinstance(metadata, list)
+                    and metadata[0] == b"CLOSE_FILE"):
+
+                self._react_to_close_file_message(message)
+                return False
+
+            elif self.fixed_stream_addr:
+                targets = [fixed_stream_addr]
+                self.log.debug("Added fixed_stream_addr to targets "
+                               "%s.", targets)
+
+            else:
+                targets = []
+
+        metadata["version"] = __version__
+
+        # get metadata and paths of the file
+        try:
+            self.log.debug("Getting file paths and metadata")
+            # additional information is stored in the metadata dict
+            self.datafetcher.get_metadata(targets, metadata)
+
+        except KeyboardInterrupt:
+            return True
+        except Exception:
+            self.log.error("Building of metadata dictionary failed "
+                           "for metadata: %s", metadata,
+                           exc_info=True)
+            # skip all further instructions and
+            # continue with next iteration
+            return False
+        latency_tracing.mark(metadata, "metadata")
+
+        if self.byte_budget is not None:
+            size = metadata.get("filesize") or 0
+            if not self.byte_budget.acquire(size, self.stop_request):
+                return True
+
+        try:
+            self._send_and_finish(targets, metadata)
+        finally:
+            if self.byte_budget is not None:
+                self.byte_budget.release(size)
+
+        trace = latency_tracing.get_trace(metadata)
+        if trace is not None:
+            self.update_stats("latency", latency_tracing.get_latencies(trace))
+
+        # datafetcher/datahandler was not stopped in the meantime
+        if self.datafetcher is not None:
+            for name, value in self.datafetcher.pop_stats():
+                self.update_stats(name, value)
+
+        return False
+
+    def _send_and_finish(self, targets, metadata):
+        """Send the file to the targets and finish it.
+        """
+
+        # send data
+        try:
+            self.datafetcher.send_data(targets, metadata,
+                                       self.open_connections)
+        except Exception:
+            self.log.error("Passing new file to data stream...failed",
+                           exc_info=True)
+
+        # the file must not be removed before the data stream got all of it
+        try:
+            self.datafetcher.wait_for_in_flight()
+        except Exception:
+            self.log.error("Waiting for the data to be sent failed",
+                           exc_info=True)
+
+        # finish data handling
+        try:
+            self.datafetcher.finish(targets, metadata,
+                                    self.open_connections)
+        except Exception:
+            # datafetcher/datahandler was not stopped in the meantime
+            if self.datafetcher is not None:
+                self.log.error("Finishing file failed.", exc_info=True)
+
+    def _release_credit(self, job_id):
+        """Notify the task provider that a job was finished.
+
+        Args:
+            job_id: The id the task provider assigned the job with.
+        """
+
+        if not self.use_credit_dispatch:
+            return
+
+        try:
+            self.router_socket.send_multipart([b"DONE", job_id])
+        except Exception:
+            self.log.error("Could not release credit", exc_info=True)
+
+    def stats_config(self):
+        """Extend the stats_config function of the Base class
+        """
+        conf = super().stats_config()
+        conf["latency"] = "latency"
+        conf["copy"] = "copy"
+        conf["chunksize"] = "chunksize"
+
+        return conf
+
     def _react_to_close_file_message(self, metadata):
         """ this is experimental for the nexus receiver """
 
@@ -391,10 +593,76 @@ class DataHandler(Base):
                                      socket=self.open_connections[socket_id])
                     del self.open_connections[socket_id]
 
+                self.datafetcher.metadata_formats.pop(socket_id, None)
+                self.datafetcher.compression.pop(socket_id, None)
+                self.datafetcher.batching.discard(socket_id)
+                self.datafetcher.in_flight.pop(socket_id, None)
+
         except Exception:
             self.log.error("Request for closing sockets of wrong format",
                            exc_info=True)
 
+    def _react_to_metadata_format_signal(self, message):
+        """Overwrite the base class reaction method to metadata_format signal.
+
+        Remember which targets get the metadata in a format other than JSON.
+
+        Args:
+            message: JSON encoded message of the form:
+                     [[<socket id>, <metadata format>], ...]
+        """
+
+        try:
+            formats = json.loads(message[1].decode("utf-8"))
+            for socket_id, metadata_format in formats:
+                if metadata_format == utils.JSON:
+                    self.datafetcher.metadata_formats.pop(socket_id, None)
+                else:
+                    self.datafetcher.metadata_formats[socket_id] = (
+                        metadata_format
+                    )
+        except Exception:
+            self.log.error("Request for setting the metadata format of wrong "
+                           "format", exc_info=True)
+
+    def _react_to_compression_signal(self, message):
+        """Overwrite the base class reaction method to compression signal.
+
+        Remember which targets get compressed data.
+
+        Args:
+            message: JSON encoded message of the form:
+                     [[<socket id>, <codec or None>], ...]
+        """
+
+        try:
+            codecs = json.loads(message[1].decode("utf-8"))
+            for socket_id, codec in codecs:
+                if codec is None:
+                    self.datafetcher.compression.pop(socket_id, None)
+                else:
+                    self.datafetcher.compression[socket_id] = codec
+        except Exception:
+            self.log.error("Request for setting the compression of wrong "
+                           "format", exc_info=True)
+
+    def _react_to_batching_signal(self, message):
+        """Overwrite the base class reaction method to batching signal.
+
+        Remember which targets can receive batches of files.
+
+        Args:
+            message: JSON encoded message of the form:
+                     [<socket id>, ...]
+        """
+
+        try:
+            targets = json.loads(message[1].decode("utf-8"))
+            self.datafetcher.batching.update(targets)
+        except Exception:
+            self.log.error("Request for setting the batching of wrong "
+                           "format", exc_info=True)
+
     def stop(self):
         """Stopping, closing sockets and clean up.
         """
@@ -406,7 +674,16 @@ class DataHandler(Base):
         self.cleanup_base()
 
         if self.datafetcher is not None:
-            self.datafetcher.stop()
+            # send what is still held back
+            try:
+                self.datafetcher.flush(self.open_connections, force=True)
+            except Exception:
+                self.log.error("Flushing data fetcher failed", exc_info=True)
+
+            if self.drained:
+                self.datafetcher.drain()
+            else:
+                self.datafetcher.stop()
             self.datafetcher = None
 
         self.stop_socket(name="router_socket")
@@ -433,7 +710,8 @@ class DataDispatcher(Base):
                  config,
                  log_queue,
                  log_level,
-                 stop_request):
+                 stop_request,
+                 ready_queue=None):
 
         super().__init__()
 
@@ -444,12 +722,15 @@ class DataDispatcher(Base):
         self.log_queue = log_queue
         self.log_level = log_level
         self.stop_request = stop_request
+        self.ready_queue = ready_queue
 
         self.context = None
         self.poller = None
         self.control_socket = None
-        self.datahandler = None
+        self.datahandlers = []
         self.stopped = None
+        # all data handlers were stopped by the task provider
+        self.drained = False
 
     def _setup(self):
         """Initializes parameters and creates sockets.
@@ -479,9 +760,24 @@ class DataDispatcher(Base):
             self.log.error("Cannot create sockets", ext_info=True)
             self.stop()
 
-        self.datahandler = threading.Thread(
-            target=run_datahandler,
-            kwargs=dict(
+        # how many files are handled at the same time
+        config_df = self.config["datafetcher"]
+        try:
+            n_handlers = config_df["dispatcher_files_in_flight"]
+        except KeyError:
+            n_handlers = 1
+
+        if n_handlers > 1:
+            try:
+                max_bytes = config_df["dispatcher_capacity"]
+            except KeyError:
+                max_bytes = 1073741824  # 1 GiB
+            byte_budget = ByteBudget(max_bytes)
+            self.log.info("Handling up to %s files (%s bytes) at the same "
+                          "time", n_handlers, max_bytes)
+
+        for i in range(n_handlers):
+            kwargs = dict(
                 dispatcher_id=self.dispatcher_id,
                 endpoints=self.endpoints,
                 fixed_stream_addr=self.fixed_stream_addr,
@@ -491,8 +787,14 @@ class DataDispatcher(Base):
                 context=self.context,
                 stop_request=self.stop_request
             )
-        )
-        self.datahandler.start()
+            if n_handlers > 1:
+                kwargs["handler_id"] = i
+                kwargs["byte_budget"] = byte_budget
+
+            datahandler = threading.Thread(target=run_datahandler,
+                                           kwargs=kwargs)
+            datahandler.start()
+            self.datahandlers.append(datahandler)
 
     def create_sockets(self):
         """Create ZMQ sockets.
@@ -523,6 +825,8 @@ class DataDispatcher(Base):
             self.stop()
             raise
 
+        self.report_ready("DataDispatcher-{}".format(self.dispatcher_id))
+
         try:
             self.stopped = False
             self._run()
@@ -535,7 +839,9 @@ class DataDispatcher(Base):
                            "error condition.", self.dispatcher_id,
                            exc_info=True)
         finally:
-            self.set_stop_request()
+            # when drained the other parts of hidra continue running
+            if not self.drained:
+                self.set_stop_request()
             # ensure that the stop method always knows that the run method
             # actually stopped.
             self.stopped = True
@@ -559,17 +865,25 @@ class DataDispatcher(Base):
                 if self.check_control_signal():
                     break
 
+            if not any(datahandler.is_alive()
+                       for datahandler in self.datahandlers):
+                if not self.stop_request.is_set():
+                    self.log.info("All data handlers were drained.")
+                    self.drained = True
+                break
+
     def _forward_control_signal(self, message):
         """
         Overwrite the base class method and forward the control signal to the
         data handler.
         """
         self.log.debug("Setting control signal for data handler.")
-        try:
-            self.datahandler.set_control_signal(message)
-        except AttributeError:
-            # if data handler is not initialized or already stopped
-            pass
+        for datahandler in self.datahandlers:
+            try:
+                datahandler.set_control_signal(message)
+            except AttributeError:
+                # if data handler is not initialized or already stopped
+                pass
 
     def _react_to_sleep_signal(self, message):
         """Overwrite the base class reaction method to sleep signal.
@@ -589,17 +903,18 @@ class DataDispatcher(Base):
     def stop(self):
         """Stopping, closing sockets and clean up.
         """
-        self.set_stop_request()
+        if not self.drained:
+            self.set_stop_request()
         self.wait_for_stopped()
 
         super().cleanup_base()
         self.stop_socket(name="control_socket")
 
-        if self.datahandler is not None:
+        for datahandler in self.datahandlers:
             self.log.debug("Waiting for datahandler to join.")
-            self.datahandler.join()
+            datahandler.join()
             self.log.debug("DataHandler joined.")
-            self.datahandler = None
+        self.datahandlers = []
 
         if self.context is not None:
             self.log.info("Destroying context")
@@ -35,12 +35,17 @@ from __future__ import unicode_literals
 from builtins import super  # pylint: disable=redefined-builtin
 
 import abc
+from collections import OrderedDict
+import json
 import os
 import sys
+import time
 import zmq
 
 import hidra.utils as utils
 from base_class import Base
+import latency_tracing
+from removal import Remover
 
 # source:
 # pylint: disable=line-too-long
@@ -53,12 +58,104 @@ else:
 __author__ = 'Manuela Kuhn <manuela.kuhn@desy.de>'
 
 
+class _Entry(object):
+    """The tracking state of one file.
+    """
+
+    __slots__ = ["base_path", "n_chunks", "bitmap", "n_received",
+                 "legacy", "last_update"]
+
+    def __init__(self, now):
+        self.base_path = None
+        # None as long as no job was received for the file
+        self.n_chunks = None
+        # one bit per confirmed chunk
+        self.bitmap = bytearray()
+        # the number of different chunks confirmed with a number smaller than
+        # n_chunks (all of them as long as n_chunks is unknown)
+        self.n_received = 0
+        # confirmation without chunk number (versions <= 4.0.7) received
+        self.legacy = False
+        self.last_update = now
+
+    def reset_chunks(self):
+        """Forget the confirmed chunks.
+        """
+        self.bitmap = bytearray()
+        self.n_received = 0
+        self.legacy = False
+
+    def add_chunk(self, chunk_number):
+        """Mark a chunk as confirmed.
+
+        Returns:
+            False if the chunk was confirmed already, True otherwise.
+        """
+
+        index = chunk_number >> 3
+        mask = 1 << (chunk_number & 7)
+
+        if index >= len(self.bitmap):
+            self.bitmap.extend(bytearray(index + 1 - len(self.bitmap)))
+        elif self.bitmap[index] & mask:
+            return False
+
+        self.bitmap[index] |= mask
+        if self.n_chunks is None or chunk_number < self.n_chunks:
+            self.n_received += 1
+        return True
+
+    def set_n_chunks(self, n_chunks):
+        """Set the number of chunks once the job is known.
+        """
+
+        self.n_chunks = n_chunks
+
+        if not self.bitmap:
+            # the usual case: the job arrives before the confirmations
+            return
+
+        # confirmations for chunks not belonging to the file do not count
+        n_full, n_rest = divmod(n_chunks, 8)
+        self.n_received = sum(bin(byte).count("1")
+                              for byte in self.bitmap[:n_full])
+        if n_rest and n_full < len(self.bitmap):
+            self.n_received += bin(
+                self.bitmap[n_full] & ((1 << n_rest) - 1)
+            ).count("1")
+
+    def is_complete(self):
+        """Check if all chunks of the file were confirmed.
+        """
+        return self.n_chunks is not None and (
+            self.n_received >= self.n_chunks
+            # backward compatibility with versions <= 4.0.7
+            or self.legacy
+        )
+
+
 class ConfirmationTracking(object):
-    """ Handles tracking of jobs and confirmations. """
+    """ Handles tracking of jobs and confirmations.
 
-    def __init__(self, log_queue, log_level):
-        self.confirmations = {}
-        self.jobs = {}
+    The confirmed chunks are kept as a bitmap per file, thus updating and
+    checking for completeness takes constant time. Entries which were not
+    updated for max_age seconds are evicted (e.g. confirmations for which no
+    job is received or jobs whose confirmations got lost), the oldest
+    entries are evicted as well if there are more than max_entries.
+    """
+
+    def __init__(self, log_queue, log_level, max_age=3600,
+                 max_entries=100000):
+        # ordered by the time of the last update, the oldest entry first
+        self.entries = OrderedDict()
+
+        self.max_age = max_age
+        self.max_entries = max_entries
+
+        # the number of entries for which the job was received
+        self.n_jobs = 0
+        self.n_evicted_jobs = 0
+        self.n_evicted_confirmations = 0
 
         self.log = utils.get_logger(self.__class__.__name__,
                                     queue=log_queue,
@@ -76,6 +173,33 @@ class ConfirmationTracking(object):
 
         return topic, file_id, chunk_number
 
+    def _get_entry(self, file_id):
+        now = time.time()
+
+        # remove and add again to move it to the end of the order
+        try:
+            entry = self.entries.pop(file_id)
+            entry.last_update = now
+        except KeyError:
+            entry = _Entry(now)
+            if len(self.entries) >= self.max_entries:
+                self._evict(*self.entries.popitem(last=False))
+
+        self.entries[file_id] = entry
+        return entry
+
+    def _evict(self, file_id, entry):
+        if entry.n_chunks is None:
+            self.n_evicted_confirmations += 1
+            self.log.debug("Evicted confirmations without job for file %s",
+                           file_id)
+        else:
+            self.n_jobs -= 1
+            self.n_evicted_jobs += 1
+            self.log.warning("Evicted job for file %s: only %s of %s chunks "
+                             "confirmed, the file is not removed.",
+                             file_id, entry.n_received, entry.n_chunks)
+
     def process_confirmation(self, file_id, chunk_number):
         """ A new confirmation was received
 
@@ -85,48 +209,25 @@ class ConfirmationTracking(object):
             None otherwise.
         """
 
-        if file_id in self.confirmations and chunk_number != 0:
-            self.confirmations[file_id]["count"] += 1
-            self.confirmations[file_id]["chunks"].append(chunk_number)
-        else:
-            # either new confirmation or
-            # file transfer was aborted and restarted -> reset chunks
-            self.confirmations[file_id] = {
-                "count": 1,
-                "chunks": [chunk_number]
-            }
-
-        # self.log.debug("jobs=%s", jobs)
-        # self.log.debug("confirmations={}".format(confirmations))
-
-        if file_id in self.jobs:
-            this_confirm = self.confirmations[file_id]
-            this_job = self.jobs[file_id]
-
-            if this_confirm["count"] >= this_job["n_chunks"]:
-
-                # check that all chunks were received:
-                received_chunks = list(set(this_confirm["chunks"]))
-                if (len(received_chunks) == this_job["n_chunks"]
-                        # backward compatibility with versions <= 4.0.7
-                        or received_chunks == [None]):
-                    return this_job["base_path"]
-                    # self.remove_element(this_job["base_path"], file_id)
-                    # del self.confirmations[file_id]
-                    # del self.jobs[file_id]
-                else:
-                    # correct count
-                    self.log.info("More confirmations received than "
-                                  "chunks sent for file %s.", file_id)
-                    self.log.debug("chunks received=%s",
-                                   this_confirm["chunks"])
-
-                    this_confirm["count"] = len(received_chunks)
-                    this_confirm["chunks"] = received_chunks
+        entry = self._get_entry(file_id)
+
+        if chunk_number is None:
+            # backward compatibility with versions <= 4.0.7
+            entry.legacy = True
         else:
-            # self.log.debug("confirmations without job notification "
-            #                "received: %s", file_id)
-            pass
+            if chunk_number == 0 and entry.n_received:
+                # file transfer was aborted and restarted -> reset chunks
+                entry.reset_chunks()
+
+            if not entry.add_chunk(chunk_number):
+                self.log.info("More confirmations received than "
+                              "chunks sent for file %s.", file_id)
+                self.log.debug("chunk received twice=%s", chunk_number)
+
+        if entry.is_complete():
+            return entry.base_path
+
+        return None
 
     def process_job(self, base_path, file_id, n_chunks):
         """ Checks the job for matching confirmations
@@ -136,41 +237,54 @@ class ConfirmationTracking(object):
             None otherwise.
         """
 
-        if (file_id in self.confirmations
-                and self.confirmations[file_id]["count"] >= n_chunks):
-
-            this_confirm = self.confirmations[file_id]
+        entry = self._get_entry(file_id)
+        if entry.n_chunks is None:
+            self.n_jobs += 1
+        entry.base_path = base_path
+        entry.set_n_chunks(n_chunks)
 
-            # check that all chunks were received:
-            received_chunks = list(set(this_confirm["chunks"]))
-            if (len(received_chunks) == n_chunks
-                    # backward compatibility with versions <= 4.0.7
-                    or received_chunks == [None]):
-                return True
-                # self.remove_element(base_path, file_id)
-                # del self.confirmations[file_id]
-            else:
-                # correct count
-                self.log.info("More confirmations received than "
-                              "chunks sent for file %s.", file_id)
-                self.log.debug("chunks received=%s",
-                               this_confirm["chunks"])
+        if entry.is_complete():
+            return True
 
-                this_confirm["count"] = len(received_chunks)
-                this_confirm["chunks"] = received_chunks
-        else:
-            self.jobs[file_id] = {
-                "base_path": base_path,
-                "n_chunks": n_chunks
-            }
+        return None
 
     def remove_entry(self, file_id):
         """ Clean up the tracking after the file is removed """
         try:
-            del self.confirmations[file_id]
-            del self.jobs[file_id]
+            entry = self.entries.pop(file_id)
         except KeyError:
-            pass
+            return
+
+        if entry.n_chunks is not None:
+            self.n_jobs -= 1
+
+    def remove_stale(self):
+        """Evict the entries which were not updated for max_age seconds.
+        """
+
+        if not self.max_age:
+            return
+
+        limit = time.time() - self.max_age
+
+        while self.entries:
+            file_id = next(iter(self.entries))
+            if self.entries[file_id].last_update > limit:
+                break
+            self._evict(file_id, self.entries.pop(file_id))
+
+    def get_stats(self):
+        """The number of tracked and evicted files.
+        """
+
+        return {
+            # jobs waiting for confirmations
+            "pending": self.n_jobs,
+            # confirmations waiting for a job
+            "orphaned": len(self.entries) - self.n_jobs,
+            "evicted_jobs": self.n_evicted_jobs,
+            "evicted_confirmations": self.n_evicted_confirmations,
+        }
 
 
 class CleanerBase(Base, ABC):
@@ -184,7 +298,8 @@ class CleanerBase(Base, ABC):
                  log_level,
                  endpoints,
                  stop_request,
-                 context=None):
+                 context=None,
+                 ready_queue=None):
 
         super().__init__()
 
@@ -195,8 +310,11 @@ class CleanerBase(Base, ABC):
                       self.__class__.__name__, os.getpid())
 
         self.config = config
+        # needed to initialize base_class
+        self.config_all = config
         self.endpoints = endpoints
         self.stop_request = stop_request
+        self.ready_queue = ready_queue
         self.stopped = None
 
         self.job_socket = None
@@ -206,8 +324,37 @@ class CleanerBase(Base, ABC):
         self.confirm_topic = None
         self.poller = None
 
-        self.tracker = ConfirmationTracking(log_queue=log_queue,
-                                            log_level=log_level)
+        try:
+            config_df = self.config["datafetcher"]
+        except KeyError:
+            config_df = {}
+
+        self.tracker = ConfirmationTracking(
+            log_queue=log_queue,
+            log_level=log_level,
+            max_age=config_df.get("confirmation_max_age", 3600),
+            max_entries=config_df.get("confirmation_max_entries", 100000)
+        )
+        # how often to check for stale entries (in s)
+        self.eviction_interval = 10
+        if self.tracker.max_age:
+            self.eviction_interval = min(self.eviction_interval,
+                                         self.tracker.max_age)
+        self.last_eviction = time.time()
+        # how often to check for finished removals (in s)
+        self.removal_poll_interval = 0.05
+
+        self.remover = Remover(
+            remove=self.remove_element,
+            log=self.log,
+            threads=config_df.get("removal_threads", 4),
+            max_backlog=config_df.get("removal_max_backlog", 1000),
+            retries=config_df.get("removal_retries", 3),
+            retry_delay=config_df.get("removal_retry_delay", 0.1)
+        )
+
+        # latency traces of the sampled files (see latency_tracing)
+        self.traces = {}
 
         if context:
             self.context = context
@@ -216,6 +363,14 @@ class CleanerBase(Base, ABC):
             self.context = zmq.Context()
             self.ext_context = False
 
+        try:
+            use_statserver = self.config["general"]["use_statserver"]
+        except KeyError:
+            use_statserver = False
+
+        if use_statserver:
+            self.setup_stats_collection()
+
         self.create_sockets()
 
     def create_sockets(self):
@@ -264,6 +419,9 @@ class CleanerBase(Base, ABC):
         """Process jobs and confirmations.
         """
 
+        # the sockets are already created in the constructor
+        self.report_ready("Cleaner")
+
         self.stopped = False
         try:
             self._run()
@@ -281,7 +439,22 @@ class CleanerBase(Base, ABC):
         """
 
         while not self.stop_request.is_set():
-            socks = dict(self.poller.poll())
+            # wake up to evict stale entries and to finish the removals
+            if self.remover.backlog:
+                timeout = self.removal_poll_interval
+            else:
+                timeout = self.eviction_interval
+            socks = dict(self.poller.poll(timeout * 1000))
+
+            self._finish_removals()
+
+            now = time.time()
+            if now - self.last_eviction >= self.eviction_interval:
+                self.tracker.remove_stale()
+                self.update_stats("confirmation_tracking",
+                                  self.tracker.get_stats())
+                self.update_stats("removal", self.remover.get_stats())
+                self.last_eviction = now
 
             # ----------------------------------------------------------------
             # messages from receiver
@@ -309,8 +482,7 @@ class CleanerBase(Base, ABC):
                 )
 
                 if base_path:
-                    self.remove_element(base_path, file_id)
-                    self.tracker.remove_entry(file_id)
+                    self._remove_file(base_path, file_id)
 
             # ----------------------------------------------------------------
             # messages from DataFetcher
@@ -326,11 +498,23 @@ class CleanerBase(Base, ABC):
                 file_id = message[1].decode("utf-8")
                 n_chunks = int(message[2].decode("utf-8"))
 
+                # the file was re-created while the old one is still
+                # waiting for being removed
+                if self.remover.cancel(file_id):
+                    self.log.warning("New job received for file %s before "
+                                     "it was removed, not removing it.",
+                                     file_id)
+
+                # the file is traced
+                if len(message) > 3:
+                    self.traces[file_id] = json.loads(
+                        message[3].decode("utf-8")
+                    )
+
                 if self.tracker.process_job(base_path=base_path,
                                             file_id=file_id,
                                             n_chunks=n_chunks):
-                    self.remove_element(base_path, file_id)
-                    self.tracker.remove_entry(file_id)
+                    self._remove_file(base_path, file_id)
 
             # ----------------------------------------------------------------
             # control commands
@@ -342,6 +526,41 @@ class CleanerBase(Base, ABC):
                 if self.check_control_signal():
                     break
 
+    def _remove_file(self, base_path, file_id):
+        """Remove a file for which all confirmations were received.
+        """
+
+        trace = self.traces.pop(file_id, None)
+        if trace is not None:
+            trace["confirmed"] = time.time()
+
+        self.tracker.remove_entry(file_id)
+        self.remover.submit(base_path, file_id, context=trace)
+
+    def _finish_removals(self):
+        """Handle the files whose removal finished in the background.
+        """
+
+        for _, trace, success in self.remover.get_removed():
+            if success and trace is not None:
+                trace["removed"] = time.time()
+                self.update_stats(
+                    "latency",
+                    latency_tracing.get_latencies(
+                        trace, stages=["confirmed", "removed"]
+                    )
+                )
+
+    def stats_config(self):
+        """Extend the stats_config function of the Base class
+        """
+        conf = super().stats_config()
+        conf["latency"] = "latency"
+        conf["confirmation_tracking"] = "confirmation_tracking"
+        conf["removal"] = "removal"
+
+        return conf
+
     def _react_to_sleep_signal(self, message):
         """Overwrite the base class reaction method to sleep signal.
         """
@@ -378,6 +597,9 @@ class CleanerBase(Base, ABC):
     def remove_element(self, base_path, file_id):
         """How to remove a file from the source.
 
+        Called from the worker threads of the remover, thus it must not use
+        the zmq sockets. Raise an exception if the removal should be retried.
+
         Args:
             base_path:
             file_id:
@@ -391,6 +613,10 @@ class CleanerBase(Base, ABC):
         self.stop_request.set()
         self.wait_for_stopped()
 
+        self.remover.stop()
+        self._finish_removals()
+
+        self.cleanup_base()
         self.stop_socket(name="job_socket")
         self.stop_socket(name="confirmation_socket")
         self.stop_socket(name="control_socket")
@@ -35,6 +35,8 @@ from __future__ import unicode_literals
 from builtins import super  # pylint: disable=redefined-builtin
 
 import abc
+from collections import deque
+import functools
 import json
 import os
 import sys
@@ -48,6 +50,7 @@ except ImportError:
     from pathlib2 import Path
 
 from base_class import Base
+import latency_tracing
 import hidra.utils as utils
 
 # source:
@@ -61,6 +64,30 @@ else:
 __author__ = 'Manuela Kuhn <manuela.kuhn@desy.de>'
 
 
+class InFlightMessage(object):
+    """A message to a priority 0 target which might not be sent yet.
+    """
+
+    def __init__(self, tracker, resend, chunk_number):
+        """
+        Args:
+            tracker: The ZMQ message tracker.
+            resend: Function sending the message again and returning the new
+                tracker.
+            chunk_number: The chunk number of the message.
+        """
+
+        self.tracker = tracker
+        self.resend = resend
+        self.chunk_number = chunk_number
+
+    @property
+    def done(self):
+        """If the message was sent (as the trackers of ZMQ).
+        """
+        return self.tracker is None or self.tracker.done
+
+
 class DataFetcherBase(Base, ABC):
     """
     Implementation of the data fetcher base class.
@@ -99,6 +126,8 @@ class DataFetcherBase(Base, ABC):
         self.context = datafetcher_base_config["context"]
         self.lock = datafetcher_base_config["lock"]
         self.stop_request = datafetcher_base_config["stop_request"]
+        # set if only this data fetcher is stopped but not the whole sender
+        self.drained = False
         check_dep = datafetcher_base_config["check_dep"]
         logger_name = "{}-{}".format(name, self.fetcher_id)
 
@@ -141,6 +170,25 @@ class DataFetcherBase(Base, ABC):
 
         self.control_signal = None
 
+        # the metadata format of the targets not using JSON
+        # (filled by the data handler, see METADATA_FORMAT signal)
+        self.metadata_formats = {}
+        # the codec of the targets getting compressed data
+        # (filled by the data handler, see COMPRESSION signal)
+        self.compression = {}
+        # the targets able to receive batches of files
+        # (filled by the data handler, see BATCHING signal)
+        self.batching = set()
+
+        # how many messages to priority 0 targets may not be sent yet
+        try:
+            self.chunks_in_flight = max(1, self.config_df["chunks_in_flight"])
+        except KeyError:
+            self.chunks_in_flight = 4
+        # the messages not sent yet per priority 0 target, oldest first
+        # entries are of the form <target>: deque([<InFlightMessage>, ...])
+        self.in_flight = {}
+
         self.required_params = []
 
         self.base_setup()
@@ -212,7 +260,8 @@ class DataFetcherBase(Base, ABC):
                         metadata,
                         payload,
                         chunk_number,
-                        timeout=-1):
+                        timeout=-1,
+                        zero_copy=False):
         """Send the data to targets.
 
         Args:
@@ -229,20 +278,36 @@ class DataFetcherBase(Base, ABC):
                 send to a target already the socket is kept open till the
                 target disconnects.
             metadata: The metadata of this data block.
-            payload: The data block to be sent.
+            payload: The data block to be sent. Frames which are a
+                dictionary or a ChunkMetadata are encoded in the metadata
+                format of each target.
             chunk_number: The chunk number of the payload to be processed.
             timeout (optional): How long to wait for the message to be received
                 in s (default: -1, means wait forever)
+            zero_copy (optional): Send the payload without copying it to all
+                targets, not only to the ones with priority 0.
+
+        Returns:
+            The trackers of the messages sent without copying. The payload
+            must not be modified until all of them are done.
         """
         timeout = 1
         self._check_control_signal()
 
         zmq_options_prio = dict(copy=False, track=True)
-        zmp_options_non_prio = dict(flags=zmq.NOBLOCK)
+        if zero_copy:
+            zmp_options_non_prio = dict(flags=zmq.NOBLOCK, copy=False,
+                                        track=True)
+        else:
+            zmp_options_non_prio = dict(flags=zmq.NOBLOCK)
 
+        trackers = []
         sending_failed = False
+        # the metadata is only encoded once per format
+        encoded = {}
 
         for target, prio, send_type in targets:
+            metadata_format = self.metadata_formats.get(target, utils.JSON)
 
             # socket not known
             if target not in open_connections:
@@ -258,29 +323,35 @@ class DataFetcherBase(Base, ABC):
             if prio == 0:
                 # send data
                 try:
-                    # retry sending if anything goes wrong
-                    retry_sending = True
-                    while retry_sending:
-                        retry_sending = False
-
-                        tracker = self._send_data(
-                            send_type=send_type,
-                            connection=open_connections[target],
-                            metadata=metadata,
-                            payload=payload,
-                            zmq_options=zmq_options_prio,
-                            message_suffix=message_suffix
-                        )
-
-                        if tracker is None:
-                            continue
+                    resend = functools.partial(
+                        self._send_data,
+                        send_type=send_type,
+                        connection=open_connections[target],
+                        metadata=metadata,
+                        payload=payload,
+                        zmq_options=zmq_options_prio,
+                        message_suffix=message_suffix,
+                        metadata_format=metadata_format,
+                        encoded=encoded
+                    )
 
-                        retry_sending = self._check_tracker(
-                            tracker=tracker,
-                            chunk_number=chunk_number,
-                            timeout=timeout
+                    tracker = resend()
+                    if tracker is not None:
+                        message = InFlightMessage(tracker=tracker,
+                                                  resend=resend,
+                                                  chunk_number=chunk_number)
+                        trackers.append(message)
+                        self.in_flight.setdefault(target, deque()).append(
+                            message
                         )
 
+                    # only wait if too many messages are not sent yet
+                    self._wait_in_flight(
+                        target=target,
+                        max_in_flight=self.chunks_in_flight - 1,
+                        timeout=timeout
+                    )
+
                 except Exception:
                     self.log.debug("Raising DataHandling error", exc_info=True)
                     raise utils.DataError(
@@ -290,14 +361,18 @@ class DataFetcherBase(Base, ABC):
 
             else:
                 try:
-                    self._send_data(
+                    tracker = self._send_data(
                         send_type=send_type,
                         connection=open_connections[target],
                         metadata=metadata,
                         payload=payload,
                         zmq_options=zmp_options_non_prio,
-                        message_suffix=message_suffix
+                        message_suffix=message_suffix,
+                        metadata_format=metadata_format,
+                        encoded=encoded
                     )
+                    if zero_copy and tracker is not None:
+                        trackers.append(tracker)
                 except Exception:
                     # remember that there was an exception but keep sending
                     # to other targets
@@ -311,6 +386,8 @@ class DataFetcherBase(Base, ABC):
             raise utils.DataError("Sending (metadata of) message part failed "
                                   "for one of the targets.")
 
+        return trackers
+
     def _open_socket(self, endpoint):
         try:
             # start and register socket
@@ -333,16 +410,31 @@ class DataFetcherBase(Base, ABC):
                    metadata,
                    payload,
                    zmq_options,
-                   message_suffix):
+                   message_suffix,
+                   metadata_format=utils.JSON,
+                   encoded=None):
 
         if send_type == "data":
+            # batches contain multiple metadata frames
+            if encoded is None:
+                encoded = {}
+            payload = [
+                self._encode_metadata(frame,
+                                      metadata_format,
+                                      encoded.setdefault(i, {}))
+                if isinstance(frame, (dict, utils.ChunkMetadata))
+                else frame
+                for i, frame in enumerate(payload or [])
+            ]
             tracker = connection.send_multipart(payload, **zmq_options)
             self.log.info("Sending {}".format(message_suffix[0]),
                           *message_suffix[1:])
 
         elif send_type == "metadata":
             # json.dumps(None) is 'N.'
-            send_msg = [json.dumps(metadata).encode("utf-8"),
+            send_msg = [self._encode_metadata(metadata,
+                                              metadata_format,
+                                              encoded),
                         json.dumps(None).encode("utf-8")]
             tracker = connection.send_multipart(send_msg, **zmq_options)
             self.log.info("Sending metadata of {}".format(message_suffix[0]),
@@ -354,33 +446,88 @@ class DataFetcherBase(Base, ABC):
 
         return tracker
 
-    def _check_tracker(self, tracker, chunk_number, timeout):
-        retry_sending = False
+    @staticmethod
+    def _encode_metadata(metadata, metadata_format, encoded=None):
+        """Encode the metadata, reusing an already encoded version.
+
+        Args:
+            metadata: The metadata dictionary.
+            metadata_format: The format to encode the metadata in.
+            encoded (optional): A dictionary of the already encoded versions
+                per format, updated in place.
+        """
+
+        # the trace stays on the sender side
+        metadata = latency_tracing.without_trace(metadata)
 
-        if not tracker.done:
+        if encoded is None:
+            return utils.serialize_metadata(metadata, metadata_format)
+
+        try:
+            return encoded[metadata_format]
+        except KeyError:
+            encoded[metadata_format] = utils.serialize_metadata(
+                metadata, metadata_format
+            )
+            return encoded[metadata_format]
+
+    def _wait_in_flight(self, target, max_in_flight, timeout=1):
+        """Wait till few enough messages to a target are not sent yet.
+
+        If the data fetcher was put to sleep in the meantime, the messages
+        not sent yet are sent again after waking up.
+
+        Args:
+            target: The priority 0 target.
+            max_in_flight: How many messages may stay in flight.
+            timeout (optional): How often to check for control signals
+                (in s).
+        """
+
+        window = self.in_flight.get(target)
+        if not window:
+            return
+
+        while window and window[0].done:
+            window.popleft()
+
+        while (len(window) > max_in_flight
+               and not self.stop_request.is_set()):
+            message = window[0]
             self.log.debug("Message part %s from file '%s' has not been sent "
-                           "yet, waiting...", chunk_number, self.source_file)
+                           "yet, waiting...", message.chunk_number,
+                           self.source_file)
 
-            while (not tracker.done
-                   and not self.stop_request.is_set()):
-                try:
-                    tracker.wait(timeout)
-                except zmq.error.NotDone:
-                    pass
+            try:
+                message.tracker.wait(timeout)
+            except zmq.error.NotDone:
+                pass
+
+            # check for control signals set from outside
+            if self._check_control_signal():
+                for message in window:
+                    if message.done:
+                        continue
 
-                # check for control signals set from outside
-                if self._check_control_signal():
                     self.log.info("Retry sending message part %s from file "
-                                  "'%s'.", chunk_number, self.source_file)
-                    retry_sending = True
-                    return retry_sending
+                                  "'%s'.", message.chunk_number,
+                                  self.source_file)
+                    message.tracker = message.resend()
+
+            while window and window[0].done:
+                window.popleft()
+
+    def wait_for_in_flight(self):
+        """Wait till all messages to priority 0 targets are sent.
+
+        Has to be called before a file is finished, e.g. removed.
+        """
 
-            if not retry_sending:
-                self.log.debug("Message part %s from file '%s' has not been "
-                               "sent yet, waiting...done",
-                               chunk_number, self.source_file)
+        for target in list(self.in_flight):
+            self._wait_in_flight(target=target, max_in_flight=0)
 
-            return retry_sending
+            if not self.in_flight[target]:
+                del self.in_flight[target]
 
     def _check_control_signal(self):
         """Check for control signal and react accordingly.
@@ -395,7 +542,11 @@ class DataFetcherBase(Base, ABC):
             self.log.debug("Received %s signal.", self.control_signal[0])
             self.stop_request.set()
 
-        elif self.control_signal[0] == b"CLOSE_SOCKETS":
+        elif self.control_signal[0] in [b"CLOSE_SOCKETS",
+                                        b"DRAIN",
+                                        b"METADATA_FORMAT",
+                                        b"COMPRESSION",
+                                        b"BATCHING"]:
             # do nothing
             pass
 
@@ -466,6 +617,28 @@ class DataFetcherBase(Base, ABC):
             finally:
                 self.lock.release()
 
+    def send_cleaner_job(self, base_path, file_id, n_chunks, metadata):
+        """Notify the cleaner about a file to remove after confirmation.
+
+        Args:
+            base_path (str): The path the file is located in.
+            file_id (str): The file identifier.
+            n_chunks (int): How many chunks have to be confirmed.
+            metadata (dict): The dictionary with the metadata of the file.
+        """
+
+        message = [
+            base_path.encode("utf-8"),
+            file_id.encode("utf-8"),
+            str(n_chunks).encode("utf-8")
+        ]
+
+        trace = latency_tracing.get_trace(metadata)
+        if trace is not None:
+            message.append(json.dumps(trace).encode("utf-8"))
+
+        self.cleaner_job_socket.send_multipart(message)
+
     # pylint: disable=no-self-use
     def generate_file_id(self, metadata):
         """Generates a file id consisting of relative path and file name
@@ -489,6 +662,34 @@ class DataFetcherBase(Base, ABC):
         file_id = Path(file_id).as_posix()
         return file_id
 
+    # pylint: disable=no-self-use
+    def get_flush_timeout(self):
+        """How long the data fetcher can wait before flush has to be called.
+
+        Returns:
+            The time in seconds or None if nothing is waiting to be sent.
+        """
+        return None
+
+    def flush(self, open_connections, force=False):
+        """Send data which was held back, e.g. to combine it with others.
+
+        Args:
+            open_connections (dict): The dictionary containing all open zmq
+                                     connections.
+            force (optional): Send everything held back, not only what is due.
+        """
+        pass
+
+    # pylint: disable=no-self-use
+    def pop_stats(self):
+        """The statistics collected since the last call.
+
+        Returns:
+            A list of (<name>, <value>) tuples to be sent to the stats server.
+        """
+        return []
+
     @abc.abstractmethod
     def get_metadata(self, targets, metadata):
         """Extends the given metadata and generates paths
@@ -574,10 +775,21 @@ class DataFetcherBase(Base, ABC):
     def stop_base(self):
         """Stop datafetcher run loop and clean up sockets.
         """
-        self.stop_request.set()
+        # the stop request is shared with the rest of the sender
+        if not self.drained:
+            self.stop_request.set()
 
         self.close_socket()
 
+    def drain(self):
+        """Stop and clean up without stopping the rest of the sender.
+
+        Used if only the data dispatcher this data fetcher belongs to is
+        stopped (e.g. when scaling down).
+        """
+        self.drained = True
+        self.stop()
+
     @abc.abstractmethod
     def stop(self):
         """Stop and clean up.
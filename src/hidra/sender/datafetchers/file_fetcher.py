@@ -44,9 +44,7 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import errno
-import json
 import os
-import shutil
 import subprocess
 import time
 
@@ -59,6 +57,13 @@ from datafetcherbase import DataFetcherBase
 from cleanerbase import CleanerBase
 from hidra import generate_filepath, DataError
 import hidra.utils as utils
+from batching import BatchCollector
+from buffer_pool import BufferPool
+from chunk_reader import ChunkReader
+from chunk_sizing import ChunkSizer
+from compression import ChunkCompressor, CompressionPolicy
+from copy_engine import CopyEngine
+import latency_tracing
 
 __author__ = 'Manuela Kuhn <manuela.kuhn@desy.de>'
 
@@ -94,6 +99,18 @@ class DataFetcher(DataFetcherBase):
         self.finish = None
 
         self.windows_handle_path = None
+        self.buffer_pool = None
+        self.copy_engine = None
+        self.read_ahead = None
+        self.batch_collector = None
+        self.compressor = None
+        self.compression_policy = None
+        self.chunk_sizer = None
+        # the chunk sizes chosen since the stats were sent
+        self.chunksize_records = []
+        # the file currently handled was added to a batch
+        self.batched_file = False
+        self._finish_file = None
 
         self.required_params = ["fix_subdirs"]
 
@@ -118,11 +135,73 @@ class DataFetcher(DataFetcherBase):
 
         self.is_windows = utils.is_windows()
 
+        try:
+            use_zero_copy = self.config["use_zero_copy"]
+        except KeyError:
+            use_zero_copy = False
+
+        if use_zero_copy:
+            try:
+                read_buffers = self.config["read_buffers"]
+            except KeyError:
+                read_buffers = 8
+            self.buffer_pool = BufferPool(max_buffers=read_buffers)
+
+        try:
+            self.read_ahead = self.config["read_ahead"]
+        except KeyError:
+            self.read_ahead = 0
+
+        # None means all available
+        try:
+            copy_methods = self.config["copy_methods"]
+        except KeyError:
+            copy_methods = None
+        self.copy_engine = CopyEngine(methods=copy_methods)
+
+        if self.config.get("adaptive_chunksize", False):
+            self.chunk_sizer = ChunkSizer(
+                chunksize=self.config_df["chunksize"],
+                min_chunksize=self.config.get("min_chunksize", 65536),
+                max_chunksize=self.config.get("max_chunksize", 67108864),
+                chunk_duration=self.config.get("chunk_duration", 0.1)
+            )
+
+        # the codec is negotiated per target by the signal handler
+        try:
+            codec = self.config_df["compression"]
+        except KeyError:
+            codec = None
+
+        if codec is not None and codec in utils.get_compression_codecs():
+            self.compressor = ChunkCompressor(
+                codec=codec,
+                level=self.config_df.get("compression_level"),
+                threads=self.config.get("compression_threads", 1)
+            )
+            self.compression_policy = CompressionPolicy(
+                skip_suffixes=self.config.get("compression_skip_suffixes"),
+                min_ratio=self.config.get("compression_min_ratio", 0.9)
+            )
+
+        if self.config.get("batch_files", False):
+            self.batch_collector = BatchCollector(
+                max_files=self.config.get("batch_max_files", 100),
+                max_bytes=self.config.get("batch_max_bytes", 1048576),
+                max_delay=self.config.get("batch_max_delay", 0.1)
+            )
+
         if self.config_df["use_cleaner"]:
             self.log.debug("Set finish to finish_with_cleaner")
-            self.finish = self.finish_with_cleaner
+            self._finish_file = self.finish_with_cleaner
         else:
-            self.finish = self.finish_without_cleaner
+            self._finish_file = self.finish_without_cleaner
+
+        if self.batch_collector is None:
+            self.finish = self._finish_file
+        else:
+            # batched files are finished when the batch is sent
+            self.finish = self._finish_unless_batched
 
     def get_metadata(self, targets, metadata):
         """Implementation of the abstract method get_metadata.
@@ -171,7 +250,8 @@ class DataFetcher(DataFetcherBase):
                 metadata["filesize"] = filesize
                 metadata["file_mod_time"] = file_mod_time
                 metadata["file_create_time"] = file_create_time
-                metadata["chunksize"] = self.config_df["chunksize"]
+                metadata["chunksize"] = self._get_chunksize(targets,
+                                                            filesize)
                 if (self.config_df["use_cleaner"] and
                         self.config_df["remove_data"] == "with_confirmation"):
                     metadata["confirmation_required"] = (
@@ -185,6 +265,22 @@ class DataFetcher(DataFetcherBase):
                 self.log.error("Unable to assemble multi-part message.")
                 raise
 
+    def _get_chunksize(self, targets, filesize):
+        """The chunk size to send the current file with.
+        """
+
+        if self.chunk_sizer is None:
+            return self.config_df["chunksize"]
+
+        # targets are of the form [[<host:port>, <prio>, <metadata|data>], ...]
+        targets_data = [i for i in targets if i[2] == "data"]
+
+        chunksize = self.chunk_sizer.get_chunksize(filesize, targets_data)
+        self.log.debug("Using chunksize %s for file '%s'", chunksize,
+                       self.source_file)
+
+        return chunksize
+
     def send_data(self, targets, metadata, open_connections):
         """Implementation of the abstract method send_data.
 
@@ -213,9 +309,21 @@ class DataFetcher(DataFetcherBase):
         self.config["remove_flag"] = False
         chunksize = metadata["chunksize"]
 
+        if (self.batch_collector is not None
+                and self._add_to_batch(targets, targets_data, metadata,
+                                       open_connections)):
+            return
+
         chunk_number = 0
         send_error = False
 
+        # the metadata of the chunks only differs in the chunk number, thus
+        # it is only serialized once per file and format
+        metadata_template = utils.MetadataTemplate(
+            latency_tracing.without_trace(metadata)
+        )
+        compression = self._get_compression(targets_data, metadata)
+
         # reading source file into memory
         try:
             self.log.debug("Opening '%s'...", self.source_file)
@@ -225,52 +333,80 @@ class DataFetcher(DataFetcherBase):
                            self.source_file, exc_info=True)
             raise
 
+        reader = ChunkReader(file_descriptor=file_descriptor,
+                             chunksize=chunksize,
+                             buffer_pool=self.buffer_pool,
+                             read_ahead=self.read_ahead,
+                             filesize=metadata.get("filesize"))
+
+        # the chunk read before, sent after the compression of the current
+        # one was started
+        pending = None
+        n_bytes = 0
+        t_start = time.time()
+
         self.log.debug("Passing multipart-message for file '%s'...",
                        self.source_file)
         # sending data divided into chunks
         while not self.stop_request.is_set():
 
             # read next chunk from file
-            file_content = file_descriptor.read(chunksize)
+            buf, file_content = reader.read()
 
             # detect if end of file has been reached
             if not file_content:
+                if buf is not None:
+                    self.buffer_pool.put(buf)
                 if chunk_number == 0:
                     self.log.debug("File is empty. Skip sending to target.")
                 break
 
-            try:
-                # assemble metadata for zmq-message
-                chunk_metadata = metadata.copy()
-                chunk_metadata["chunk_number"] = chunk_number
+            future = None
+            if compression is not None:
+                future = self.compressor.submit(file_content)
+
+            if pending is not None:
+                send_error |= self._send_chunk(targets_data,
+                                               open_connections,
+                                               metadata,
+                                               metadata_template,
+                                               *pending)
+                pending = None
+
+            chunk = (compression, chunk_number, buf, file_content, future)
+            if future is None:
+                send_error |= self._send_chunk(targets_data,
+                                               open_connections,
+                                               metadata,
+                                               metadata_template,
+                                               *chunk)
+            else:
+                pending = chunk
 
-                chunk_payload = [json.dumps(chunk_metadata).encode("utf-8"),
-                                 file_content]
-            except Exception:
-                self.log.error("Unable to pack multipart-message for file "
-                               "'%s'", self.source_file, exc_info=True)
-                chunk_number += 1
-                continue
-
-            # send message to data targets
-            try:
-                self.send_to_targets(targets=targets_data,
-                                     open_connections=open_connections,
-                                     metadata=None,
-                                     payload=chunk_payload,
-                                     chunk_number=chunk_number)
-            except DataError:
-                self.log.error("Unable to send multipart-message for file "
-                               "'%s' (chunk %s)", self.source_file,
-                               chunk_number, exc_info=True)
-                send_error = True
-            except Exception:
-                self.log.error("Unable to send multipart-message for file "
-                               "'%s' (chunk %s)", self.source_file,
-                               chunk_number, exc_info=True)
+            # only continue compressing if it is worth it
+            if compression is not None and compression["skip"]:
+                compression = None
 
+            n_bytes += len(file_content)
             chunk_number += 1
 
+        if pending is not None:
+            send_error |= self._send_chunk(targets_data,
+                                           open_connections,
+                                           metadata,
+                                           metadata_template,
+                                           *pending)
+
+        if chunk_number > 0:
+            latency_tracing.mark(metadata, "last_chunk_sent")
+
+        if self.chunk_sizer is not None and n_bytes > 0:
+            self.chunk_sizer.record(targets_data, n_bytes,
+                                    time.time() - t_start)
+            self.chunksize_records.append([chunksize, n_bytes])
+
+        reader.close()
+
         # close file
         try:
             self.log.debug("Closing '%s'...", self.source_file)
@@ -290,6 +426,278 @@ class DataFetcher(DataFetcherBase):
         if not send_error:
             self.config["remove_flag"] = True
 
+    def _get_compression(self, targets_data, metadata):
+        """Determine how the chunks of the current file are compressed.
+
+        Returns:
+            None if the file is sent uncompressed, otherwise a dictionary
+            with the targets getting the file compressed and the metadata
+            template of compressed chunks.
+        """
+
+        if self.compressor is None:
+            return None
+
+        codec = self.compressor.codec
+        compressed_targets = [
+            target for target in targets_data
+            if self.compression.get(target[0]) == codec
+        ]
+
+        if (not compressed_targets
+                or not self.compression_policy.should_compress(
+                    self.source_file)):
+            return None
+
+        compressed_metadata = latency_tracing.without_trace(metadata).copy()
+        compressed_metadata["compression"] = codec
+
+        return {
+            "targets": compressed_targets,
+            "metadata_template": utils.MetadataTemplate(compressed_metadata),
+            # set if compressing the first chunk did not pay off
+            "skip": False
+        }
+
+    def _send_chunk(self,
+                    targets_data,
+                    open_connections,
+                    metadata,
+                    metadata_template,
+                    compression,
+                    chunk_number,
+                    buf,
+                    file_content,
+                    future):
+        """Send a chunk to the targets, compressed to the ones supporting it.
+
+        Args:
+            compression: The compression settings of the file (see
+                _get_compression) or None if the chunk is not compressed.
+            future: The compression of the chunk (None if not compressed).
+
+        Returns:
+            True if sending failed with a DataError, False otherwise.
+        """
+
+        compressed = None
+        if future is not None:
+            try:
+                compressed = future.result()
+            except Exception:
+                self.log.error("Unable to compress chunk %s of file '%s', "
+                               "sending it uncompressed", chunk_number,
+                               self.source_file, exc_info=True)
+
+        if compressed is not None and chunk_number == 0:
+            self.compression_policy.record(self.source_file,
+                                           len(file_content),
+                                           len(compressed))
+
+        if (compressed is not None
+                and not self.compression_policy.pays_off(len(file_content),
+                                                         len(compressed))):
+            self.log.debug("Compressing file '%s' does not pay off",
+                           self.source_file)
+            compression["skip"] = True
+            compressed = None
+
+        if compressed is None:
+            groups = [(targets_data, metadata_template, file_content)]
+        else:
+            raw_targets = [target for target in targets_data
+                           if target not in compression["targets"]]
+            groups = [(compression["targets"],
+                       compression["metadata_template"],
+                       compressed),
+                      (raw_targets, metadata_template, file_content)]
+
+        send_error = False
+        send_failed = False
+        raw_trackers = []
+        for targets, template, data in groups:
+            if not targets:
+                continue
+
+            # assemble metadata for zmq-message
+            # the metadata is encoded when sending it
+            chunk_payload = [template.chunk(chunk_number), data]
+
+            # send message to data targets
+            try:
+                trackers = self.send_to_targets(
+                    targets=targets,
+                    open_connections=open_connections,
+                    metadata=None,
+                    payload=chunk_payload,
+                    chunk_number=chunk_number,
+                    zero_copy=buf is not None
+                )
+
+                if data is file_content:
+                    raw_trackers = trackers
+            except DataError:
+                self.log.error("Unable to send multipart-message for file "
+                               "'%s' (chunk %s)", self.source_file,
+                               chunk_number, exc_info=True)
+                send_error = True
+                send_failed = True
+            except Exception:
+                self.log.error("Unable to send multipart-message for file "
+                               "'%s' (chunk %s)", self.source_file,
+                               chunk_number, exc_info=True)
+                send_failed = True
+
+        # if sending failed ZMQ might still reference the buffer, thus it is
+        # only reused on success
+        if buf is not None and not send_failed:
+            self.buffer_pool.put(buf, raw_trackers)
+
+        if chunk_number == 0:
+            latency_tracing.mark(metadata, "first_chunk_sent")
+
+        return send_error
+
+    def _add_to_batch(self, targets, targets_data, metadata,
+                      open_connections):
+        """Add a small file to the batch of its targets.
+
+        Returns:
+            True if the file was added, False if it has to be sent on its own.
+        """
+
+        # receivers not announcing to support batches only get the first file
+        if any(target[0] not in self.batching for target in targets_data):
+            return False
+
+        chunksize = metadata["chunksize"]
+        filesize = metadata.get("filesize")
+
+        if (filesize is None
+                or filesize > chunksize
+                or not self.batch_collector.fits(filesize)):
+            return False
+
+        try:
+            with open(str(self.source_file), "rb") as file_descriptor:
+                content = file_descriptor.read(chunksize + 1)
+        except Exception:
+            self.log.error("Unable to read source file '%s'",
+                           self.source_file, exc_info=True)
+            raise
+
+        # the file changed in the meantime
+        if not content or len(content) > chunksize:
+            return False
+
+        entry = {
+            "targets": targets,
+            "metadata": metadata,
+            "content": content,
+            "source_file": self.source_file,
+            "target_file": self.target_file
+        }
+        self.batched_file = True
+
+        for batch in self.batch_collector.add(targets_data, entry,
+                                              len(content)):
+            self._send_batch(batch, open_connections)
+
+        return True
+
+    def _send_batch(self, batch, open_connections):
+        """Send the files of a batch as one message and finish them.
+        """
+
+        payload = []
+        for entry in batch.entries:
+            chunk_metadata = entry["metadata"].copy()
+            chunk_metadata["chunk_number"] = 0
+            # the metadata is encoded when sending it
+            payload += [chunk_metadata, entry["content"]]
+
+        send_error = False
+        try:
+            self.send_to_targets(targets=batch.targets,
+                                 open_connections=open_connections,
+                                 metadata=None,
+                                 payload=payload,
+                                 chunk_number=0)
+            self.log.debug("Sent batch of %s files to %s",
+                           len(batch.entries), batch.targets)
+        except DataError:
+            self.log.error("Unable to send batch of %s files",
+                           len(batch.entries), exc_info=True)
+            send_error = True
+        except Exception:
+            self.log.error("Unable to send batch of %s files",
+                           len(batch.entries), exc_info=True)
+
+        # the files must not be removed before the data stream got them
+        self.wait_for_in_flight()
+
+        # finish uses the paths of the file currently handled
+        current_files = self.source_file, self.target_file
+
+        for entry in batch.entries:
+            metadata = entry["metadata"]
+            latency_tracing.mark(metadata, "first_chunk_sent")
+            latency_tracing.mark(metadata, "last_chunk_sent")
+
+            self.source_file = entry["source_file"]
+            self.target_file = entry["target_file"]
+            self.config["remove_flag"] = not send_error
+
+            try:
+                self._finish_file(entry["targets"], metadata,
+                                  open_connections)
+            except Exception:
+                self.log.error("Finishing file '%s' failed",
+                               self.source_file, exc_info=True)
+
+        self.source_file, self.target_file = current_files
+
+    def _finish_unless_batched(self, targets, metadata, open_connections):
+        if self.batched_file:
+            self.batched_file = False
+            return
+
+        self._finish_file(targets, metadata, open_connections)
+
+    def get_flush_timeout(self):
+        """Implementation of the method get_flush_timeout.
+        """
+
+        if self.batch_collector is None:
+            return None
+        return self.batch_collector.get_timeout()
+
+    def flush(self, open_connections, force=False):
+        """Implementation of the method flush.
+        """
+
+        if self.batch_collector is None:
+            return
+
+        if force:
+            batches = self.batch_collector.pop_all()
+        else:
+            batches = self.batch_collector.pop_expired()
+
+        for batch in batches:
+            self._send_batch(batch, open_connections)
+
+    def pop_stats(self):
+        """Implementation of the method pop_stats.
+        """
+
+        stats = [("copy", record)
+                 for record in self.copy_engine.pop_records()]
+        stats += [("chunksize", record) for record in self.chunksize_records]
+        self.chunksize_records = []
+
+        return stats
+
     def _datahandling(self, action_function, metadata):
         try:
             action_function(self.source_file, self.target_file)
@@ -382,7 +790,7 @@ class DataFetcher(DataFetcherBase):
         # (does not preserve file owner, group or ACLs)
         if self.config_df["store_data"]:
             try:
-                self._datahandling(shutil.copy, metadata)
+                self._datahandling(self.copy_engine.copy, metadata)
                 self.log.info("Copying file '%s' ...success.",
                               self.source_file)
             except Exception:
@@ -405,11 +813,10 @@ class DataFetcher(DataFetcherBase):
                 # round up the division result
                 n_chunks = -(-filesize // self.config_df["chunksize"])
 
-            self.cleaner_job_socket.send_multipart([
-                metadata["source_path"].encode("utf-8"),
-                file_id.encode("utf-8"),
-                str(n_chunks).encode("utf-8")
-            ])
+            self.send_cleaner_job(base_path=metadata["source_path"],
+                                  file_id=file_id,
+                                  n_chunks=n_chunks,
+                                  metadata=metadata)
             self.log.debug("Forwarded to cleaner %s", file_id)
 
         # send message to metadata targets
@@ -448,7 +855,7 @@ class DataFetcher(DataFetcherBase):
                 and self.config["remove_flag"]):
 
             try:
-                self._datahandling(shutil.move, metadata)
+                self._datahandling(self.copy_engine.move, metadata)
                 self.log.info("Moving file '%s' to '%s'...success.",
                               self.source_file, self.target_file)
             except Exception:
@@ -461,7 +868,7 @@ class DataFetcher(DataFetcherBase):
         # (does not preserve file owner, group or ACLs)
         elif self.config_df["store_data"]:
             try:
-                self._datahandling(shutil.copy, metadata)
+                self._datahandling(self.copy_engine.copy, metadata)
                 self.log.info("Copying file '%s' ...success.",
                               self.source_file)
             except Exception:
@@ -556,6 +963,12 @@ class DataFetcher(DataFetcherBase):
         # stop everything started in the base class
         self.stop_base()
 
+        if self.compressor is not None:
+            self.compressor.stop()
+
+        if self.buffer_pool is not None:
+            self.buffer_pool.clear()
+
         # close base class zmq sockets
         self.close_socket()
 
@@ -570,10 +983,12 @@ class Cleaner(CleanerBase):
         # generate file path
         source_file = Path(os.path.join(base_path, file_id)).as_posix()
 
-        # remove file
+        # remove file, errors other than a missing file are raised to retry
         try:
             os.remove(source_file)
             self.log.info("Removing file '%s' ...success", source_file)
-        except Exception:
+        except OSError as excp:
+            if excp.errno != errno.ENOENT:
+                raise
             self.log.error("Unable to remove file %s", source_file,
                            exc_info=True)
@@ -32,7 +32,6 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
-import json
 import time
 
 from datafetcherbase import DataFetcherBase
@@ -204,8 +203,8 @@ class DataFetcher(DataFetcherBase):
                        self.source_file)
 
         try:
-            chunk_payload = [json.dumps(self.metadata_r).encode("utf-8"),
-                             self.data_r]
+            # the metadata is encoded when sending it
+            chunk_payload = [self.metadata_r, self.data_r]
         except Exception:
             self.log.error("Unable to pack multipart-message for file "
                            "'%s'", self.source_file, exc_info=True)
@@ -44,21 +44,65 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
+from collections import deque
 import errno
-import json
 import os
+import threading
 import time
 
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # python 2 without the futures backport
+    ThreadPoolExecutor = None
+
 import requests
+from requests.compat import urlparse
 
 from cleanerbase import CleanerBase
 from datafetcherbase import DataFetcherBase
 from hidra import generate_filepath
 from hidra.utils import open_tempfile, UsageError
+import latency_tracing
 
 __author__ = ('Manuela Kuhn <manuela.kuhn@desy.de>',
               'Jan Garrevoet <jan.garrevoet@desy.de>')
 
+# limits the concurrent requests per detector for all data fetchers of the
+# process, entries are of the form <host:port>: <semaphore>
+_download_limits = {}
+_download_limits_lock = threading.Lock()
+
+
+def _get_download_limit(url, max_downloads):
+    host = urlparse(url).netloc
+
+    with _download_limits_lock:
+        try:
+            return _download_limits[host]
+        except KeyError:
+            limit = threading.BoundedSemaphore(max_downloads)
+            _download_limits[host] = limit
+            return limit
+
+
+def _get_filesize(response):
+    """The size of the file from the response to a range request.
+
+    Returns:
+        The file size or None if the range was not served.
+    """
+
+    if response.status_code != 206:
+        return None
+
+    # of the form "bytes <start>-<end>/<size>"
+    try:
+        size = response.headers["Content-Range"].rsplit("/", 1)[1]
+        return int(size)
+    except (KeyError, IndexError, ValueError):
+        return None
+
 
 class Filewriter(object):
     def __init__(self, file_id, target_file, config, config_df, log):
@@ -253,7 +297,32 @@ class DataFetcher(DataFetcherBase):
         Sets static configuration parameters and which finish method to use.
         """
 
+        try:
+            self.parallel_downloads = self.config["parallel_downloads"]
+        except KeyError:
+            self.parallel_downloads = 1
+
+        try:
+            self.max_downloads = self.config["max_downloads"]
+        except KeyError:
+            self.max_downloads = 4
+
+        if ThreadPoolExecutor is None:
+            self.parallel_downloads = 1
+
+        self.download_executor = None
+        if self.parallel_downloads > 1:
+            self.download_executor = ThreadPoolExecutor(
+                max_workers=self.parallel_downloads
+            )
+
+        # keep enough connections open to be reused by all downloads
+        adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=self.parallel_downloads + 1
+        )
         self.config["session"] = requests.session()
+        self.config["session"].mount("http://", adapter)
+        self.config["session"].mount("https://", adapter)
         self.config["remove_flag"] = False
 
         if self.config_df["use_cleaner"]:
@@ -323,9 +392,14 @@ class DataFetcher(DataFetcherBase):
         sending_failed = False
         self.config["remove_flag"] = False
 
-        response = self.config["session"].get(self.source_file, stream=True)
         try:
-            response.raise_for_status()
+            chunksize = metadata["chunksize"]
+        except Exception:
+            self.log.error("Unable to get chunksize", exc_info=True)
+            raise
+
+        try:
+            chunks = self._start_download(chunksize)
             self.log.debug("Initiating http get for file '%s' succeeded.",
                            self.source_file)
         except Exception:
@@ -333,12 +407,6 @@ class DataFetcher(DataFetcherBase):
                            self.source_file, exc_info=True)
             return
 
-        try:
-            chunksize = metadata["chunksize"]
-        except Exception:
-            self.log.error("Unable to get chunksize", exc_info=True)
-            raise
-
         writer = Filewriter(file_id=self.source_file,
                             target_file=self.target_file,
                             config=self.config,
@@ -355,7 +423,7 @@ class DataFetcher(DataFetcherBase):
         self.log.debug("Getting data for file '%s'...", self.source_file)
         # reading source file into memory
         try:
-            for data in response.iter_content(chunk_size=chunksize):
+            for data in chunks:
 
                 # the datadispatcher asked to stop
                 if self.stop_request.is_set():
@@ -383,12 +451,20 @@ class DataFetcher(DataFetcherBase):
                     payload=payload,
                     chunk_number=chunk_number
                 )
+                if chunk_number == 0:
+                    latency_tracing.mark(metadata, "first_chunk_sent")
                 chunk_number += 1
         finally:
+            # stops the downloads still running
+            chunks.close()
+
             # to make sure that the files are not corrupted even when hidra
             # is stopped
             writer.close()
 
+        if chunk_number > 0:
+            latency_tracing.mark(metadata, "last_chunk_sent")
+
         if self.config_df["store_data"]:
             # send message to metadata targets
             self._send_to_targets(targets=targets_metadata,
@@ -402,6 +478,94 @@ class DataFetcher(DataFetcherBase):
         else:
             self.config["remove_flag"] = not sending_failed
 
+    def _start_download(self, chunksize):
+        """Request the file from the detector.
+
+        With parallel downloads enabled, the first chunk is requested as a
+        range to learn the file size. If the detector does not serve ranges
+        the whole file is streamed.
+
+        Returns:
+            An iterator over the chunks of the file.
+        """
+
+        url = self.source_file
+
+        if self.download_executor is None:
+            response = self.config["session"].get(url, stream=True)
+            response.raise_for_status()
+            return response.iter_content(chunk_size=chunksize)
+
+        with _get_download_limit(url, self.max_downloads):
+            response = self.config["session"].get(
+                url,
+                headers={"Range": "bytes=0-{}".format(chunksize - 1)},
+                stream=True
+            )
+
+            # no range of an empty file can be satisfied
+            if response.status_code == 416:
+                response.close()
+                self.log.debug("File '%s' is empty", url)
+                return self._iter_ranges(url, chunksize, 0, b"")
+
+            response.raise_for_status()
+
+            filesize = _get_filesize(response)
+            if filesize is not None:
+                first_chunk = response.content
+
+        if filesize is not None:
+            return self._iter_ranges(url, chunksize, filesize, first_chunk)
+
+        if response.status_code == 206:
+            # only a part of the file was sent but its size is unknown
+            response.close()
+            self.log.debug("Size of file '%s' unknown, requesting the whole "
+                           "file", url)
+            response = self.config["session"].get(url, stream=True)
+            response.raise_for_status()
+        else:
+            self.log.debug("Range requests not served for file '%s'", url)
+
+        return response.iter_content(chunk_size=chunksize)
+
+    def _get_range(self, url, start, end):
+        with _get_download_limit(url, self.max_downloads):
+            response = self.config["session"].get(
+                url, headers={"Range": "bytes={}-{}".format(start, end)}
+            )
+
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise Exception("Range request for file '{}' not served"
+                            .format(url))
+
+        return response.content
+
+    def _iter_ranges(self, url, chunksize, filesize, first_chunk):
+        """Download the chunks in parallel and return them in order.
+        """
+
+        yield first_chunk
+
+        pending = deque()
+        try:
+            for start in range(chunksize, filesize, chunksize):
+                end = min(start + chunksize, filesize) - 1
+                pending.append(self.download_executor.submit(
+                    self._get_range, url, start, end
+                ))
+
+                if len(pending) >= self.parallel_downloads:
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
     def _get_prep_data(self, metadata, chunk_number, data):
         try:
             self.log.debug("Packing multipart-message for file '%s'...",
@@ -411,7 +575,8 @@ class DataFetcher(DataFetcherBase):
             metadata_extended = metadata.copy()
             metadata_extended["chunk_number"] = chunk_number
 
-            payload = [json.dumps(metadata_extended).encode("utf-8"), data]
+            # the metadata is encoded when sending it
+            payload = [metadata_extended, data]
         except Exception:
             self.log.error("Unable to pack multipart-message for file '%s'",
                            self.source_file, exc_info=True)
@@ -478,11 +643,10 @@ class DataFetcher(DataFetcherBase):
         file_id = self.generate_file_id(metadata)
         n_chunks = 1
 
-        self.cleaner_job_socket.send_multipart([
-            metadata["source_path"].encode("utf-8"),
-            file_id.encode("utf-8"),
-            str(n_chunks).encode("utf-8")
-        ])
+        self.send_cleaner_job(base_path=metadata["source_path"],
+                              file_id=file_id,
+                              n_chunks=n_chunks,
+                              metadata=metadata)
         self.log.debug("Forwarded to cleaner %s", file_id)
 
     def finish_without_cleaner(self, targets, metadata, open_connections):
@@ -497,7 +661,7 @@ class DataFetcher(DataFetcherBase):
         # pylint: disable=unused-argument
 
         if self.config_df["remove_data"] and self.config["remove_flag"]:
-            response = requests.delete(self.source_file)
+            response = self.config["session"].delete(self.source_file)
 
             try:
                 response.raise_for_status()
@@ -511,6 +675,10 @@ class DataFetcher(DataFetcherBase):
         """Implementation of the abstract method stop.
         """
 
+        if self.download_executor is not None:
+            self.download_executor.shutdown(wait=True)
+            self.download_executor = None
+
         # close base class zmq sockets
         self.close_socket()
 
@@ -520,17 +688,26 @@ class Cleaner(CleanerBase):
     Implementation of the cleaner when handling http detectors.
     """
 
+    def __init__(self, *args, **kwargs):
+        # each worker thread of the remover keeps its own session to reuse
+        # the connections to the detector
+        self.sessions = threading.local()
+
+        CleanerBase.__init__(self, *args, **kwargs)
+
+    def _get_session(self):
+        try:
+            return self.sessions.session
+        except AttributeError:
+            self.sessions.session = requests.session()
+            return self.sessions.session
+
     def remove_element(self, base_path, file_id):
 
         # generate file path
         source_file = os.path.join(base_path, file_id)
 
-        # remove file
-        response = requests.delete(source_file)
-
-        try:
-            response.raise_for_status()
-            self.log.debug("Deleting file '%s' succeeded.", source_file)
-        except Exception:
-            self.log.error("Deleting file '%s' failed.", source_file,
-                           exc_info=True)
+        # remove file, errors are raised to retry
+        response = self._get_session().delete(source_file)
+        response.raise_for_status()
+        self.log.debug("Deleting file '%s' succeeded.", source_file)
@@ -33,7 +33,6 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 from collections import namedtuple
-import json
 import time
 import os
 import zmq
@@ -264,7 +263,8 @@ class DataFetcher(DataFetcherBase):
             metadata_extended = metadata.copy()
             metadata_extended["chunk_number"] = chunk_number
 
-            payload = [json.dumps(metadata_extended).encode("utf-8"), data]
+            # the metadata is encoded when sending it
+            payload = [metadata_extended, data]
         except Exception:
             self.log.error("Unable to pack multipart-message for file '%s'",
                            self.source_file, exc_info=True)
@@ -38,9 +38,11 @@ from builtins import super  # pylint: disable=redefined-builtin
 import argparse
 from distutils.version import LooseVersion
 from importlib import import_module
+import json
 import logging
 import multiprocessing
 import os
+import queue
 import tempfile
 import time
 import signal
@@ -67,6 +69,9 @@ from base_class import Base  # noqa E402
 from signalhandler import run_signalhandler  # noqa E402
 from taskprovider import run_taskprovider  # noqa E402
 from datadispatcher import run_datadispatcher  # noqa E402
+from dispatcher_scaler import (DispatcherScaler,  # noqa E402
+                               SCALE_UP,
+                               SCALE_DOWN)
 from statserver import run_statserver  # noqa E402
 
 __author__ = 'Manuela Kuhn <manuela.kuhn@desy.de>'
@@ -489,6 +494,7 @@ class DataManager(Base):
 
         self.device = None
         self.control_pub_socket = None
+        self.load_socket = None
         self.context = None
 
         self.log = None
@@ -525,6 +531,16 @@ class DataManager(Base):
         self.signalhandler_pr = None
         self.taskprovider_pr = None
         self.datadispatcher_pr = []
+        # data dispatchers which were requested to stop
+        self.draining_pr = []
+        self.dispatcher_index = 0
+
+        self.scaler = None
+        self.load = None
+
+        # names of the processes which reported that they are set up
+        self.ready_processes = set()
+        self.startup_timeout = None
 
         self.use_cleaner = None
         self.cleaner_m = None
@@ -557,6 +573,9 @@ class DataManager(Base):
             self.ipc_dir = os.path.join(tempfile.gettempdir(), "hidra")
             raise
 
+        # needed to initialize base_class
+        self.config_all = self.config
+
         config_gen = self.config["general"]
         config_df = self.config["datafetcher"]
 
@@ -595,7 +614,12 @@ class DataManager(Base):
         config_df["use_cleaner"] = self.use_cleaner
 
         self.use_statserver = config_gen["use_statserver"]
+        try:
+            self.startup_timeout = config_gen["startup_timeout"]
+        except KeyError:
+            self.startup_timeout = 10
         self.number_of_streams = config_df["number_of_streams"]
+        self._setup_scaling()
         self.use_data_stream = config_df["use_data_stream"]
         self.log.info("Usage of data stream set to '%s'", self.use_data_stream)
 
@@ -627,6 +651,51 @@ class DataManager(Base):
                                                     log_queue=self.log_queue)
         self._check_data_stream_targets()
 
+    def _setup_scaling(self):
+        """Set up the scaling of the number of data dispatchers.
+        """
+        config_df = self.config["datafetcher"]
+
+        min_streams = config_df.get("min_number_of_streams",
+                                    self.number_of_streams)
+        max_streams = config_df.get("max_number_of_streams",
+                                    self.number_of_streams)
+
+        if min_streams == max_streams:
+            return
+
+        try:
+            use_credit_dispatch = config_df["use_credit_dispatch"]
+        except KeyError:
+            use_credit_dispatch = False
+
+        if not use_credit_dispatch:
+            self.log.warning("Scaling the number of data dispatchers needs "
+                             "use_credit_dispatch to be enabled, keeping %s "
+                             "data dispatchers", self.number_of_streams)
+            return
+
+        # the receiver of the data stream waits for the close file signals
+        # of as many data dispatchers as were started initially (the
+        # number is part of the dispatcher id)
+        if config_df["use_data_stream"]:
+            self.log.warning("Scaling the number of data dispatchers is not "
+                             "supported together with use_data_stream, "
+                             "keeping %s data dispatchers",
+                             self.number_of_streams)
+            return
+
+        kwargs = {}
+        for key in ["scale_up_delay", "scale_down_delay"]:
+            if key in config_df:
+                kwargs[key] = config_df[key]
+
+        self.scaler = DispatcherScaler(min_dispatchers=min_streams,
+                                       max_dispatchers=max_streams,
+                                       **kwargs)
+        self.log.info("Scaling number of data dispatchers between %s and %s",
+                      min_streams, max_streams)
+
     def _setup_logging(self):
         config_gen = self.config["general"]
 
@@ -787,6 +856,20 @@ class DataManager(Base):
             endpoint=self.endpoints.control_pub_con
         )
 
+        if self.scaler is not None:
+            # socket to get the load of the data dispatchers reported by the
+            # taskprovider
+            self.load_socket = self.start_socket(
+                name="load_socket",
+                sock_type=zmq.SUB,
+                sock_con="connect",
+                endpoint=self.endpoints.control_sub_con
+            )
+            self.load_socket.setsockopt_string(zmq.SUBSCRIBE, "load")
+
+        if self.use_statserver:
+            self.setup_stats_collection()
+
     def run(self):
         """Running while reacting to exceptions.
         """
@@ -808,6 +891,13 @@ class DataManager(Base):
         """Starting all thread and processes and checks if they are running.
         """
 
+        startup_start = time.time()
+        self.ready_queue = multiprocessing.Queue()
+        self.ready_processes = set()
+
+        # the processes are started as soon as the ones they depend on
+        # reported that their sockets are set up
+
         # StatServer
         if self.use_statserver:
             self.statserver = multiprocessing.Process(
@@ -817,6 +907,7 @@ class DataManager(Base):
                     log_queue=self.log_queue,
                     log_level=self.log_level,
                     stop_request=self.stop_request,
+                    ready_queue=self.ready_queue,
                     procname=self.procname + "-statserver"
                 )
             )
@@ -833,33 +924,12 @@ class DataManager(Base):
                 log_queue=self.log_queue,
                 log_level=self.log_level,
                 stop_request=self.stop_request,
+                ready_queue=self.ready_queue,
                 procname=self.procname + "-signalhandler"
             )
         )
         self.signalhandler_pr.start()
 
-        # needed, because otherwise the requests for the first files are not
-        # forwarded properly
-        time.sleep(0.5)
-
-        if not self.signalhandler_pr.is_alive():
-            self.log.error("Signalhandler did not start.")
-            return
-
-        # TaskProvider
-        self.taskprovider_pr = multiprocessing.Process(
-            target=run_taskprovider,
-            kwargs=dict(
-                config=self.config,
-                endpoints=self.endpoints,
-                log_queue=self.log_queue,
-                log_level=self.log_level,
-                stop_request=self.stop_request,
-                procname=self.procname + "-taskprovider"
-            )
-        )
-        self.taskprovider_pr.start()
-
         # Cleaner
         if self.use_cleaner:
             self.log.info("Loading cleaner from data fetcher module: %s",
@@ -875,6 +945,7 @@ class DataManager(Base):
                         log_level=self.log_level,
                         endpoints=self.endpoints,
                         stop_request=self.stop_request,
+                        ready_queue=self.ready_queue,
                         procname=self.procname + "-cleaner"
                     )
                 )
@@ -885,23 +956,44 @@ class DataManager(Base):
                       self.config["datafetcher"]["type"])
 
         # DataDispatcher
-        for i in range(self.number_of_streams):
-            dispatcher_id = "{}/{}".format(i + 1, self.number_of_streams)
-            proc = multiprocessing.Process(
-                target=run_datadispatcher,
-                kwargs=dict(
-                    dispatcher_id=dispatcher_id,
-                    endpoints=self.endpoints,
-                    fixed_stream_addr=self.fixed_stream_addr,
-                    config=self.config,
-                    log_queue=self.log_queue,
-                    log_level=self.log_level,
-                    stop_request=self.stop_request,
-                    procname=self.procname + "-datadispatcher-" + str(i + 1)
-                )
+        for _ in range(self.number_of_streams):
+            self._start_datadispatcher()
+
+        # the requests for the first files are only forwarded properly if the
+        # signal handler is set up
+        if not self._wait_for_ready({"SignalHandler": self.signalhandler_pr}):
+            self.log.error("Signalhandler did not start.")
+            return
+
+        # TaskProvider
+        self.taskprovider_pr = multiprocessing.Process(
+            target=run_taskprovider,
+            kwargs=dict(
+                config=self.config,
+                endpoints=self.endpoints,
+                log_queue=self.log_queue,
+                log_level=self.log_level,
+                stop_request=self.stop_request,
+                ready_queue=self.ready_queue,
+                procname=self.procname + "-taskprovider"
             )
-            proc.start()
-            self.datadispatcher_pr.append(proc)
+        )
+        self.taskprovider_pr.start()
+
+        processes = {"TaskProvider": self.taskprovider_pr}
+        if self.use_statserver:
+            processes["StatServer"] = self.statserver
+        if self.use_cleaner:
+            processes["Cleaner"] = self.cleaner_pr
+        for proc in self.datadispatcher_pr:
+            processes["DataDispatcher-" + proc.dispatcher_id] = proc
+
+        if not self._wait_for_ready(processes):
+            return
+
+        startup_time = time.time() - startup_start
+        self.log.info("Startup took %.3f s", startup_time)
+        self.update_stats("startup_time", startup_time)
 
         # indicates if the processed are sent to waiting mode
         sleep_was_sent = False
@@ -930,6 +1022,9 @@ class DataManager(Base):
 
             time.sleep(1)
 
+            if self.scaler is not None and not sleep_was_sent:
+                self._scale_datadispatchers()
+
             run_loop = (not self.stop_request.is_set()
                         and self.core_parts_status_check())
 
@@ -947,6 +1042,149 @@ class DataManager(Base):
                        for datadispatcher in self.datadispatcher_pr):
                 self.log.info("One DataDispatcher terminated.")
 
+    def _start_datadispatcher(self):
+        """Start an additional data dispatcher process.
+        """
+
+        self.dispatcher_index += 1
+        dispatcher_id = "{}/{}".format(self.dispatcher_index,
+                                       self.number_of_streams)
+        proc = multiprocessing.Process(
+            target=run_datadispatcher,
+            kwargs=dict(
+                dispatcher_id=dispatcher_id,
+                endpoints=self.endpoints,
+                fixed_stream_addr=self.fixed_stream_addr,
+                config=self.config,
+                log_queue=self.log_queue,
+                log_level=self.log_level,
+                stop_request=self.stop_request,
+                ready_queue=self.ready_queue,
+                procname=(self.procname + "-datadispatcher-"
+                          + str(self.dispatcher_index))
+            )
+        )
+        proc.dispatcher_id = dispatcher_id
+        proc.start()
+        self.datadispatcher_pr.append(proc)
+
+    def _wait_for_ready(self, processes):
+        """Wait till processes reported that their sockets are set up.
+
+        Args:
+            processes: A dictionary of the form <name>: <process> with the
+                processes to wait for.
+
+        Returns:
+            True if all processes are ready, False if one of them died or did
+            not report in time.
+        """
+
+        end = time.time() + self.startup_timeout
+
+        while True:
+            waiting = [name for name in processes
+                       if name not in self.ready_processes]
+            if not waiting:
+                return True
+
+            for name in waiting:
+                if not processes[name].is_alive():
+                    self.log.error("%s terminated during startup.", name)
+                    return False
+
+            remaining = end - time.time()
+            if remaining <= 0:
+                self.log.error("%s did not report to be ready within %s s.",
+                               ", ".join(sorted(waiting)),
+                               self.startup_timeout)
+                return False
+
+            if self.stop_request.is_set():
+                return False
+
+            try:
+                name = self.ready_queue.get(timeout=min(remaining, 0.1))
+            except queue.Empty:
+                continue
+
+            self.log.debug("%s is ready", name)
+            self.ready_processes.add(name)
+
+    def _drain_datadispatcher(self):
+        """Stop the newest data dispatcher after its jobs are done.
+        """
+
+        proc = self.datadispatcher_pr.pop()
+        self.draining_pr.append(proc)
+
+        self.log.info("Sending 'DRAIN' signal for DataDispatcher-%s",
+                      proc.dispatcher_id)
+        self.control_pub_socket.send_multipart(
+            [b"control", b"DRAIN", proc.dispatcher_id.encode("utf-8")]
+        )
+
+    def _scale_datadispatchers(self):
+        """Adapt the number of data dispatchers to the load.
+        """
+
+        # get the newest load report
+        while True:
+            try:
+                message = self.load_socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.error.Again:
+                break
+            self.load = json.loads(message[1].decode("utf-8"))
+
+        # data dispatchers started by scaling up
+        while True:
+            try:
+                name = self.ready_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.log.debug("%s is ready", name)
+            self.ready_processes.add(name)
+
+        # clean up data dispatchers which are drained
+        for proc in [p for p in self.draining_pr if not p.is_alive()]:
+            proc.join()
+            self.draining_pr.remove(proc)
+            self.log.info("DataDispatcher-%s drained.", proc.dispatcher_id)
+
+        if self.load is None:
+            return
+
+        n_dispatchers = len(self.datadispatcher_pr)
+        decision = self.scaler.update(self.load, n_dispatchers)
+        # every load report is only taken into account once
+        self.load = None
+
+        if decision == SCALE_UP:
+            self._start_datadispatcher()
+        elif decision == SCALE_DOWN:
+            self._drain_datadispatcher()
+        else:
+            return
+
+        self.log.info("Scaled number of data dispatchers from %s to %s",
+                      n_dispatchers, len(self.datadispatcher_pr))
+        self.update_stats("number_of_streams", len(self.datadispatcher_pr))
+        self.update_stats("dispatcher_scaling", {
+            "time": time.time(),
+            "from": n_dispatchers,
+            "to": len(self.datadispatcher_pr),
+        })
+
+    def stats_config(self):
+        """Extend the stats_config function of the Base class
+        """
+        conf = super().stats_config()
+        conf["number_of_streams"] = ["datafetcher", "number_of_streams"]
+        conf["dispatcher_scaling"] = "dispatcher_scaling"
+        conf["startup_time"] = "startup_time"
+
+        return conf
+
     def core_parts_status_check(self):
         """Check if the core components still are running.
 
@@ -1006,7 +1244,8 @@ class DataManager(Base):
                 self.log.error("Cleaner hangs (PID %s).", self.cleaner_pr.pid)
             is_hanging = True
 
-        for i, datadispatcher in enumerate(self.datadispatcher_pr):
+        datadispatchers = self.datadispatcher_pr + self.draining_pr
+        for i, datadispatcher in enumerate(datadispatchers):
             if datadispatcher is not None and datadispatcher.is_alive():
                 if log:
                     self.log.error("DataDispatcher-%s hangs (PID %s)",
@@ -1050,6 +1289,8 @@ class DataManager(Base):
             self.device = None
 
         self.stop_socket(name="control_pub_socket")
+        self.stop_socket(name="load_socket")
+        self.cleanup_base()
 
         # detecting hanging processes
         self.check_hanging(log=True)
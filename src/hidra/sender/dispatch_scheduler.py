@@ -0,0 +1,333 @@
+# Copyright (C) 2015  DESY, Manuela Kuhn, Notkestr. 85, D-22607 Hamburg
+#
+# HiDRA is a generic tool set for high performance data multiplexing with
+# different qualities of service and based on Python and ZeroMQ.
+#
+# This software is free: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Manuela Kuhn <manuela.kuhn@desy.de>
+#
+
+"""
+This module implements the credit based scheduling of jobs to the data
+dispatchers.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import deque, OrderedDict
+
+__author__ = 'Manuela Kuhn <manuela.kuhn@desy.de>'
+
+
+SMALL_LANE = "small"
+LARGE_LANE = "large"
+
+
+class DispatcherCredit(object):
+    """The capacity a data dispatcher advertised and what is used of it.
+
+    The capacity is shared by all data handlers of the dispatcher.
+    """
+
+    def __init__(self, capacity_bytes, capacity_jobs):
+        self.capacity_bytes = capacity_bytes
+        self.capacity_jobs = capacity_jobs
+
+        # entries are of the form <job id>: (<size>, <lane>, <identity>)
+        self.in_flight = OrderedDict()
+        self.bytes_in_flight = 0
+
+    def n_large_jobs(self):
+        """Number of jobs of the large lane currently in flight.
+        """
+        return sum(1 for _, lane, _ in self.in_flight.values()
+                   if lane == LARGE_LANE)
+
+    def n_jobs(self, identity):
+        """Number of jobs in flight at one data handler.
+        """
+        return sum(1 for _, _, handler in self.in_flight.values()
+                   if handler == identity)
+
+    def fits(self, size):
+        """Check if a job of the given size can be assigned.
+
+        A job which is larger than the whole capacity is accepted if the
+        dispatcher is idle, otherwise it would never be sent.
+        """
+
+        if len(self.in_flight) >= self.capacity_jobs:
+            return False
+
+        if not self.in_flight:
+            return True
+
+        return self.bytes_in_flight + size <= self.capacity_bytes
+
+    def assign(self, job_id, size, lane, identity):
+        """Use up credit for a new job sent to the data handler identity.
+        """
+        self.in_flight[job_id] = (size, lane, identity)
+        self.bytes_in_flight += size
+
+    def release(self, job_id):
+        """Return the credit of a finished job.
+        """
+        try:
+            size, _, _ = self.in_flight.pop(job_id)
+        except KeyError:
+            return
+        self.bytes_in_flight -= size
+
+    def drop(self, identity):
+        """Return the credit of all jobs of a data handler.
+        """
+        for job_id, (_, _, handler) in list(self.in_flight.items()):
+            if handler == identity:
+                self.release(job_id)
+
+
+class DispatchScheduler(object):
+    """Assigns jobs to data dispatchers depending on their free capacity.
+
+    The data dispatchers advertise how many bytes and how many jobs they can
+    handle at the same time (register) and return the credit of each
+    finished job identified by its job id (release). Jobs are assigned in
+    order of arrival to the dispatcher with the least bytes in flight.
+
+    A data dispatcher can consist of multiple data handlers which each
+    announce themselves but share the capacity of their dispatcher. A job
+    is sent to the handler of the dispatcher with the fewest jobs in flight.
+
+    If a threshold for large files is set, jobs are split into a small-file
+    and a large-file lane. The small-file lane is served first and only a
+    limited number of dispatchers work on large files at the same time so
+    that small files are not stuck behind large ones.
+    """
+
+    def __init__(self,
+                 large_file_threshold=None,
+                 max_large_file_dispatchers=1):
+        """
+        Args:
+            large_file_threshold (optional): Size in bytes from which on a
+                file is put into the large-file lane (None disables lanes).
+            max_large_file_dispatchers (optional): How many dispatchers are
+                allowed to work on large files at the same time (None means
+                no limit).
+        """
+
+        self.large_file_threshold = large_file_threshold
+        self.max_large_file_dispatchers = max_large_file_dispatchers
+
+        # entries are of the form <dispatcher>: <DispatcherCredit>
+        self.dispatchers = {}
+        # entries are of the form <identity>: <dispatcher>
+        self.handlers = {}
+        # the identities of the data handlers, to keep the assignment
+        # deterministic
+        self.dispatcher_order = []
+
+        self.lanes = {
+            SMALL_LANE: deque(),
+            LARGE_LANE: deque()
+        }
+
+        self.next_job_id = 0
+
+    def register(self, identity, capacity_bytes, capacity_jobs,
+                 dispatcher=None):
+        """A data handler advertised the capacity of its dispatcher.
+
+        The capacity is only counted once per dispatcher, no matter how many
+        of its data handlers announce it. If the data handler was already
+        known (e.g. it was restarted) all its jobs in flight are dropped.
+
+        Args:
+            identity: The identity of the data handler.
+            capacity_bytes: How many bytes the dispatcher can handle at once.
+            capacity_jobs: How many jobs the dispatcher can handle at once.
+            dispatcher (optional): The dispatcher the data handler belongs
+                to (defaults to the identity).
+        """
+
+        if dispatcher is None:
+            dispatcher = identity
+
+        if identity in self.handlers:
+            self.unregister(identity)
+
+        try:
+            credit = self.dispatchers[dispatcher]
+            credit.capacity_bytes = capacity_bytes
+            credit.capacity_jobs = capacity_jobs
+        except KeyError:
+            self.dispatchers[dispatcher] = DispatcherCredit(
+                capacity_bytes=capacity_bytes,
+                capacity_jobs=capacity_jobs
+            )
+
+        self.handlers[identity] = dispatcher
+        self.dispatcher_order.append(identity)
+
+    def unregister(self, identity):
+        """Remove a data handler, no further jobs are assigned to it.
+
+        The dispatcher is removed together with its last data handler.
+        """
+
+        try:
+            dispatcher = self.handlers.pop(identity)
+        except KeyError:
+            return
+
+        self.dispatcher_order.remove(identity)
+        self.dispatchers[dispatcher].drop(identity)
+
+        if dispatcher not in self.handlers.values():
+            del self.dispatchers[dispatcher]
+
+    def release(self, identity, job_id):
+        """A data handler finished a job and returns its credit.
+
+        Args:
+            identity: The identity of the data handler.
+            job_id: The id the job was assigned with.
+        """
+
+        try:
+            self.dispatchers[self.handlers[identity]].release(job_id)
+        except KeyError:
+            pass
+
+    def get_lane(self, size):
+        """Determine the lane a file of the given size belongs to.
+        """
+
+        if (self.large_file_threshold is not None
+                and size >= self.large_file_threshold):
+            return LARGE_LANE
+        return SMALL_LANE
+
+    def add_job(self, job, size, front=False):
+        """Queue a job.
+
+        Args:
+            job: The job to be sent to a dispatcher.
+            size: The size of the file in bytes (None if unknown).
+            front (optional): Queue the job before all others of its lane
+                (e.g. to retry it without reordering the files).
+        """
+
+        if size is None:
+            size = 0
+
+        if front:
+            self.lanes[self.get_lane(size)].appendleft((job, size))
+        else:
+            self.lanes[self.get_lane(size)].append((job, size))
+
+    def has_jobs(self, lane=None):
+        """Check if there are jobs waiting to be assigned.
+
+        Args:
+            lane (optional): Only check this lane.
+        """
+
+        if lane is not None:
+            return bool(self.lanes[lane])
+        return any(self.lanes.values())
+
+    def queue_depth(self):
+        """The number of waiting jobs per lane.
+        """
+        return {lane: len(jobs) for lane, jobs in self.lanes.items()}
+
+    def get_load(self):
+        """How many jobs are waiting and how many dispatchers are busy.
+        """
+
+        return {
+            "queue_depth": sum(len(jobs) for jobs in self.lanes.values()),
+            "dispatchers": len(self.dispatchers),
+            "busy": sum(1 for credit in self.dispatchers.values()
+                        if credit.in_flight)
+        }
+
+    def _n_large_file_dispatchers(self):
+        return sum(1 for credit in self.dispatchers.values()
+                   if credit.n_large_jobs())
+
+    def _select_dispatcher(self, size, lane):
+        large_limit_reached = (
+            lane == LARGE_LANE
+            and self.max_large_file_dispatchers is not None
+            and (self._n_large_file_dispatchers()
+                 >= self.max_large_file_dispatchers)
+        )
+
+        selected = None
+        selected_load = None
+        for identity in self.dispatcher_order:
+            credit = self.dispatchers[self.handlers[identity]]
+
+            if not credit.fits(size):
+                continue
+
+            # only dispatchers already working on large files can get more
+            if large_limit_reached and not credit.n_large_jobs():
+                continue
+
+            load = (credit.bytes_in_flight, credit.n_jobs(identity))
+            if selected is None or load < selected_load:
+                selected = identity
+                selected_load = load
+
+        return selected
+
+    def get_assignments(self):
+        """Assign as many waiting jobs as possible.
+
+        Returns:
+            A list of (<identity>, <job id>, <job>, <size>) tuples in the
+            order the jobs should be sent.
+        """
+
+        assignments = []
+
+        for lane in [SMALL_LANE, LARGE_LANE]:
+            jobs = self.lanes[lane]
+
+            # keep the order inside of the lane
+            while jobs:
+                job, size = jobs[0]
+
+                identity = self._select_dispatcher(size, lane)
+                if identity is None:
+                    break
+
+                jobs.popleft()
+                job_id = self.next_job_id
+                self.next_job_id += 1
+
+                self.dispatchers[self.handlers[identity]].assign(
+                    job_id, size, lane, identity
+                )
+                assignments.append((identity, job_id, job, size))
+
+        return assignments
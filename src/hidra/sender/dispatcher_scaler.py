@@ -0,0 +1,154 @@
+# Copyright (C) 2015  DESY, Manuela Kuhn, Notkestr. 85, D-22607 Hamburg
+#
+# HiDRA is a generic tool set for high performance data multiplexing with
+# different qualities of service and based on Python and ZeroMQ.
+#
+# This software is free: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Manuela Kuhn <manuela.kuhn@desy.de>
+#
+
+"""
+This module implements the decision when to start or stop data dispatchers.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import time
+
+__author__ = 'Manuela Kuhn <manuela.kuhn@desy.de>'
+
+
+SCALE_UP = 1
+SCALE_DOWN = -1
+KEEP = 0
+
+
+class DispatcherScaler(object):
+    """Decides on the number of data dispatchers based on their load.
+
+    The load is reported by the task provider and consists of the number of
+    jobs waiting for a free dispatcher (backlog) and the fraction of busy
+    dispatchers (utilisation).
+
+    A dispatcher is added if there was a backlog for scale_up_delay seconds
+    and one is removed if there was no backlog and the utilisation stayed
+    below scale_down_utilisation for scale_down_delay seconds. After each
+    decision the next one is delayed by cooldown seconds to give the load
+    time to adapt.
+    """
+
+    def __init__(self,
+                 min_dispatchers,
+                 max_dispatchers,
+                 scale_up_delay=2,
+                 scale_down_delay=60,
+                 scale_down_utilisation=0.5,
+                 cooldown=5):
+        """
+        Args:
+            min_dispatchers: The number of dispatchers to keep at least.
+            max_dispatchers: The number of dispatchers to start at most.
+            scale_up_delay (optional): How long a backlog has to persist
+                before a dispatcher is added (in s).
+            scale_down_delay (optional): How long the dispatchers have to be
+                underutilised before one is removed (in s).
+            scale_down_utilisation (optional): The fraction of busy
+                dispatchers below which they are underutilised.
+            cooldown (optional): The minimal time between two decisions
+                (in s).
+        """
+
+        self.min_dispatchers = min_dispatchers
+        self.max_dispatchers = max_dispatchers
+        self.scale_up_delay = scale_up_delay
+        self.scale_down_delay = scale_down_delay
+        self.scale_down_utilisation = scale_down_utilisation
+        self.cooldown = cooldown
+
+        self.backlog_since = None
+        self.underutilised_since = None
+        self.last_decision = None
+
+    @staticmethod
+    def get_utilisation(load):
+        """The fraction of busy dispatchers.
+        """
+
+        if not load["dispatchers"]:
+            return 0
+        return load["busy"] / load["dispatchers"]
+
+    def update(self, load, n_dispatchers, now=None):
+        """Decide if a dispatcher should be added or removed.
+
+        Args:
+            load: The load reported by the task provider, a dictionary with
+                the keys queue_depth, dispatchers and busy.
+            n_dispatchers: The number of dispatchers currently running.
+            now (optional): The current time (in s).
+
+        Returns:
+            SCALE_UP, SCALE_DOWN or KEEP.
+        """
+
+        if now is None:
+            now = time.time()
+
+        if load["queue_depth"] > 0:
+            if self.backlog_since is None:
+                self.backlog_since = now
+            self.underutilised_since = None
+        else:
+            self.backlog_since = None
+
+            if self.get_utilisation(load) < self.scale_down_utilisation:
+                if self.underutilised_since is None:
+                    self.underutilised_since = now
+            else:
+                self.underutilised_since = None
+
+        if n_dispatchers < self.min_dispatchers:
+            return self._decide(SCALE_UP, now)
+
+        if n_dispatchers > self.max_dispatchers:
+            return self._decide(SCALE_DOWN, now)
+
+        if (self.last_decision is not None
+                and now - self.last_decision < self.cooldown):
+            return KEEP
+
+        if (self.backlog_since is not None
+                and now - self.backlog_since >= self.scale_up_delay
+                and n_dispatchers < self.max_dispatchers):
+            return self._decide(SCALE_UP, now)
+
+        if (self.underutilised_since is not None
+                and now - self.underutilised_since >= self.scale_down_delay
+                and n_dispatchers > self.min_dispatchers):
+            return self._decide(SCALE_DOWN, now)
+
+        return KEEP
+
+    def _decide(self, decision, now):
+        self.last_decision = now
+        # the load has to be observed again with the new number of dispatchers
+        self.backlog_since = None
+        self.underutilised_since = None
+
+        return decision
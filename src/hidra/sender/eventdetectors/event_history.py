@@ -0,0 +1,88 @@
+# Copyright (C) 2015  DESY, Manuela Kuhn, Notkestr. 85, D-22607 Hamburg
+#
+# HiDRA is a generic tool set for high performance data multiplexing with
+# different qualities of service and based on Python and ZeroMQ.
+#
+# This software is free: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Manuela Kuhn <manuela.kuhn@desy.de>
+#
+
+"""
+This module implements the history the event detectors use to prevent
+double events.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+
+__author__ = 'Manuela Kuhn <manuela.kuhn@desy.de>'
+
+
+class EventHistory(object):
+    """A bounded history of the events seen last.
+
+    Lookups and updates take constant time. Adding an entry again moves it
+    to the end, the entry added least recently is evicted first. With a size
+    of 0 nothing is remembered.
+    """
+
+    def __init__(self, size):
+        """
+        Args:
+            size: How many entries to keep at most (None for no limit).
+        """
+
+        self.size = size
+        self.entries = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def add(self, key):
+        """Add an entry or move it to the end if it is known.
+
+        Args:
+            key: The entry, has to be hashable (e.g. a (path, filename)
+                tuple).
+
+        Returns:
+            True if the entry was not in the history, False otherwise.
+        """
+
+        try:
+            # remove and add again to move it to the end of the order
+            del self.entries[key]
+            is_new = False
+        except KeyError:
+            is_new = True
+
+        if self.size == 0:
+            return is_new
+
+        self.entries[key] = None
+        if self.size is not None and len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+        return is_new
@@ -171,6 +171,37 @@ class EventDetectorBase(Base):
         """
         pass
 
+    def get_poll_fd(self):
+        """A file descriptor or zmq socket to poll for new events.
+
+        If one is returned, get_new_event is only called when it is readable
+        and must not block then.
+
+        Returns:
+            The file descriptor or zmq socket or None if get_new_event has to
+            be called in a loop instead (waiting for events itself).
+        """
+        return None
+
+    def has_pending_events(self):
+        """If get_new_event has events without the poll fd being readable.
+
+        E.g. events which were held back before. The task provider then also
+        calls get_new_event when polling timed out.
+
+        Returns:
+            True if there are pending events, False otherwise.
+        """
+        return False
+
+    def pop_stats(self):
+        """The statistics collected since the last call.
+
+        Returns:
+            A list of (<name>, <value>) tuples to be sent to the stats server.
+        """
+        return []
+
     @abc.abstractmethod
     def stop(self):
         """Stop and clean up.
@@ -287,6 +287,11 @@ class EventDetector(EventDetectorBase):
         )
 #        self.mon_socket.setsockopt_string(zmq.SUBSCRIBE, "")
 
+    def get_poll_fd(self):
+        """Implementation of the get_poll_fd method of the base class.
+        """
+        return self.mon_socket
+
     def get_new_event(self):
         """Implementation of the abstract method get_new_event.
         """
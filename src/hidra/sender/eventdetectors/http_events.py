@@ -33,6 +33,8 @@ eventdetector:
         history_size: int
         det_ip: string
         det_api_version: string
+        min_poll_interval: float (optional)
+        max_poll_interval: float (optional)
 
 Example config:
     http_events:
@@ -51,12 +53,12 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
-import collections
 import os
 import socket
 import time
 import requests
 
+from event_history import EventHistory
 from eventdetectorbase import EventDetectorBase
 
 __author__ = ('Manuela Kuhn <manuela.kuhn@desy.de>',
@@ -64,31 +66,53 @@ __author__ = ('Manuela Kuhn <manuela.kuhn@desy.de>',
 
 
 class HTTPConnection:
+    # False if the file list did not change since the last request
+    modified = True
+
     def __init__(self, session):
         self.session = session
 
+        # validators of the last file list for conditional requests
+        self.etag = None
+        self.last_modified = None
+        self.file_list = None
+
     def get_file_list(self, url):
-        response = self.session.get(url)
+        headers = {}
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+
+        response = self.session.get(url, headers=headers)
+
+        # only detectors supporting conditional requests answer this way
+        if response.status_code == 304:
+            self.modified = False
+            return self.file_list
+
         response.raise_for_status()
-        return response.json()
+
+        self.modified = True
+        self.etag = response.headers.get("ETag")
+        self.last_modified = response.headers.get("Last-Modified")
+        self.file_list = response.json()
+
+        return self.file_list
 
 
 class FileFilterDeque:
     def __init__(self, fix_subdirs, history_size):
         self.fix_subdirs = tuple(fix_subdirs)
-        # history to prevent double events
-        self.files_seen = collections.deque(maxlen=history_size)
+        # history to prevent double events, files listed again are kept
+        self.files_seen = EventHistory(history_size)
 
     def get_new_files(self, files_stored):
         new_files = []
-        if (not files_stored
-                or set(files_stored).issubset(self.files_seen)):
-            return []
 
         for file_obj in files_stored:
             if (file_obj.startswith(self.fix_subdirs)
-                    and file_obj not in self.files_seen):
-                self.files_seen.append(file_obj)
+                    and self.files_seen.add(file_obj)):
                 new_files.append(file_obj)
 
         return new_files
@@ -162,7 +186,9 @@ def create_eventdetector_impl(
         det_ip, det_api_version, history_size, fix_subdirs, log,
         file_writer_url=(
             "http://{det_ip}/filewriter/api/{det_api_version}/files/"),
-        data_url="http://{det_ip}/data"):
+        data_url="http://{det_ip}/data",
+        min_poll_interval=0.05,
+        max_poll_interval=2.0):
 
     det_ip = resolve_ip(det_ip)
 
@@ -185,16 +211,22 @@ def create_eventdetector_impl(
         data_url=data_url,
         connection=connection,
         file_filter=file_filter,
-        log=log)
+        log=log,
+        min_poll_interval=min_poll_interval,
+        max_poll_interval=max_poll_interval)
 
 
 class EventDetectorImpl:
     def __init__(
-            self, file_writer_url, data_url, connection, file_filter, log):
+            self, file_writer_url, data_url, connection, file_filter, log,
+            min_poll_interval=0.05, max_poll_interval=2.0):
         self.log = log
 
-        # time to sleep after detector returned emtpy file list
-        self.sleep_time = 0.5
+        # time to sleep after detector returned no new files, it is reset
+        # when new files show up and doubled for each poll without
+        self.min_poll_interval = min_poll_interval
+        self.max_poll_interval = max(max_poll_interval, min_poll_interval)
+        self.sleep_time = self.min_poll_interval
         # Enable specification via IP and DNS name
 
         self.file_writer_url = file_writer_url
@@ -213,20 +245,30 @@ class EventDetectorImpl:
             self.log.error("Error in getting file list from %s",
                            self.file_writer_url, exc_info=True)
             # Wait till next try to prevent denial of service
-            time.sleep(self.sleep_time)
+            self._back_off()
             return []
 
-        new_files = self.file_filter.get_new_files(files_stored)
+        if self.connection.modified:
+            new_files = self.file_filter.get_new_files(files_stored)
+        else:
+            new_files = []
 
         if not new_files:
             # no new files received
-            time.sleep(self.sleep_time)
+            self._back_off()
             return []
 
+        # the acquisition is running, poll again right away
+        self.sleep_time = self.min_poll_interval
+
         event_message_list = self._build_event_messages(new_files)
 
         return event_message_list
 
+    def _back_off(self):
+        time.sleep(self.sleep_time)
+        self.sleep_time = min(self.sleep_time * 2, self.max_poll_interval)
+
     def _get_files_stored(self):
         files_stored = self.connection.get_file_list(self.file_writer_url)
 
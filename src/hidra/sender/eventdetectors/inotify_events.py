@@ -62,7 +62,6 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
-import collections
 import copy
 import os
 import re
@@ -76,6 +75,7 @@ try:
 except ImportError:
     import pathlib2 as pathlib
 
+from event_history import EventHistory
 from eventdetectorbase import EventDetectorBase
 from hidra import convert_suffix_list_to_regex
 from inotify_utils import get_event_message, CleanUp
@@ -217,7 +217,7 @@ class EventDetector(EventDetectorBase):
                                                       compile_regex=True,
                                                       log=self.log)
 
-        self.history = collections.deque(maxlen=self.config["history_size"])
+        self.history = EventHistory(self.config["history_size"])
 
         self.lock = threading.Lock()
 
@@ -235,7 +235,8 @@ class EventDetector(EventDetectorBase):
                 cleanup_time=self.cleanup_time,
                 action_time=self.action_time,
                 lock=self.lock,
-                log_queue=self.log_queue
+                log_queue=self.log_queue,
+                threads=self.config.get("cleanup_threads", 4)
             )
             self.cleanup_thread.start()
         else:
@@ -273,16 +274,12 @@ class EventDetector(EventDetectorBase):
         remaining_events = self._get_remaining_events()
 
         # only take the events which are not handles yet
-        event_message_list = [
-            event for event in remaining_events
-            if [os.path.join(event["source_path"], event["relative_path"]),
-                event["filename"]] not in self.history
-        ]
-        self.history += [
-            [os.path.join(event["source_path"], event["relative_path"]),
-             event["filename"]]
-            for event in remaining_events
-        ]
+        event_message_list = []
+        for event in remaining_events:
+            key = (os.path.join(event["source_path"], event["relative_path"]),
+                   event["filename"])
+            if self.history.add(key):
+                event_message_list.append(event)
 
         for event in self.inotify.event_gen(**self.inotify_conf):
 
@@ -300,7 +297,7 @@ class EventDetector(EventDetectorBase):
                     current_mon_regex = value
 
             # only files of the configured event type are send
-            if current_mon_event and [path, filename] not in self.history:
+            if current_mon_event and (path, filename) not in self.history:
 
                 # only files matching the regex specified with the current
                 # event are monitored
@@ -314,13 +311,26 @@ class EventDetector(EventDetectorBase):
                 self.log.debug("event_message %s", event_message)
                 event_message_list.append(event_message)
 
-                self.history.append([path, filename])
+                self.history.add((path, filename))
 
                 return event_message_list
 
         # if timeout was reached
         return []
 
+    def pop_stats(self):
+        """Extend the pop_stats function of the base class with the duration
+        of the clean up passes.
+        """
+
+        if self.cleanup_thread is None:
+            return []
+
+        stats = self.cleanup_thread.pop_stats()
+        if stats is None:
+            return []
+        return [("cleanup", stats)]
+
     def stop(self):
         """Implementation of the abstract method stop.
         """
@@ -36,6 +36,18 @@ import os
 import threading
 import time
 
+try:
+    from os import scandir
+except ImportError:
+    # python 2
+    from scandir import scandir
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # python 2 without the futures backport
+    ThreadPoolExecutor = None
+
 import hidra.utils as utils
 
 __author__ = 'Manuela Kuhn <manuela.kuhn@desy.de>'
@@ -113,13 +125,39 @@ def common_stop(config, log):
         log.info("No left over files in monitored_dir.")
 
 
+class _DirCache(object):
+    """What the clean up found in a directory during the last pass.
+    """
+
+    __slots__ = ["mtime", "listed", "files", "dirs"]
+
+    def __init__(self, mtime, listed):
+        self.mtime = mtime
+        # when the directory was listed
+        self.listed = listed
+        # entries are of the form <filename>: <modification time>
+        self.files = {}
+        # entries are of the form <dirname>: <_DirCache>
+        self.dirs = {}
+
+
 class CleanUp(threading.Thread):
     """
     A threading finding left over files and generate events form them.
+
+    The directories are traversed incrementally: the content of a directory
+    whose modification time did not change since the last pass is taken from
+    a cache instead of listing it and getting the modification time of each
+    file again. Only the files which were not old enough yet are checked
+    again. The monitored subdirectories are traversed in parallel.
     """
 
     # pylint: disable=too-many-instance-attributes
 
+    # a directory modified less than this before it was listed is listed
+    # again because its modification time could miss later changes (in s)
+    mtime_resolution = 1
+
     def __init__(self,
                  paths,
                  mon_subdirs,
@@ -127,7 +165,8 @@ class CleanUp(threading.Thread):
                  cleanup_time,
                  action_time,
                  lock,
-                 log_queue):
+                 log_queue,
+                 threads=4):
 
         self.log = utils.get_logger("CleanUp", log_queue, log_level="info")
 
@@ -143,6 +182,13 @@ class CleanUp(threading.Thread):
         self.lock = lock
         self.run_loop = True
 
+        self.threads = max(1, min(threads, len(mon_subdirs)))
+        self.executor = None
+
+        # entries are of the form <dirname>: <_DirCache>
+        self.cache = {}
+        self.stats = None
+
         self.log.debug("threading.Thread init")
         threading.Thread.__init__(self)
 
@@ -154,11 +200,12 @@ class CleanUp(threading.Thread):
                                                       directory))
                         for directory in self.mon_subdirs]
 
+        if self.threads > 1 and ThreadPoolExecutor is not None:
+            self.executor = ThreadPoolExecutor(max_workers=self.threads)
+
         while self.run_loop:
             try:
-                result = []
-                for dirname in dirs_to_walk:
-                    result += self.traverse_directory(dirname)
+                result = self.traverse_directories(dirs_to_walk)
 
                 with self.lock:
                     _file_event_list += result
@@ -167,63 +214,201 @@ class CleanUp(threading.Thread):
                 self.log.error("Stopping loop due to error", exc_info=True)
                 break
 
-    def traverse_directory(self, dirname):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+    def traverse_directories(self, dirnames):
+        """
+        Traverses the given directories and generate events for all files
+        found which match the pattern and where not touched for some time.
+
+        Args:
+            dirnames (list): the directories to traverse.
+
+        Returns:
+            A list of event messages.
+        """
+
+        start = time.time()
+        # one per directory to not share them between the threads
+        counts = [{"listed": 0, "cached": 0} for _ in dirnames]
+
+        if self.executor is None:
+            results = [self.traverse_directory(dirname, count)
+                       for dirname, count in zip(dirnames, counts)]
+        else:
+            results = list(self.executor.map(self.traverse_directory,
+                                             dirnames, counts))
+
+        event_list = []
+        for result in results:
+            event_list += result
+
+        stats = {
+            "duration": time.time() - start,
+            "dirs_listed": sum(count["listed"] for count in counts),
+            "dirs_cached": sum(count["cached"] for count in counts),
+            "events": len(event_list)
+        }
+        with self.lock:
+            self.stats = stats
+
+        return event_list
+
+    def traverse_directory(self, dirname, counts=None):
         """
         Traverses the given directory and generate events for all files found
         which match the pattern and where not touched for some time.
 
         Args:
             dirname (str): the directory to traverse and check for files.
+            counts (optional): A dictionary counting the directories listed
+                and taken from the cache.
 
         Returns:
             A list of event messages.
         """
 
+        if counts is None:
+            counts = {"listed": 0, "cached": 0}
+
+        try:
+            mtime = os.stat(dirname).st_mtime
+        except OSError:
+            self.cache.pop(dirname, None)
+            return []
+
         event_list = []
+        self.cache[dirname] = self._traverse(dirname,
+                                             mtime,
+                                             self.cache.get(dirname),
+                                             time.time(),
+                                             event_list,
+                                             counts)
+
+        return event_list
 
-        for root, _, files in os.walk(dirname):
-            for filename in files:
-                if self.mon_regex.match(filename) is None:
-                    # self.log.debug("File ending not in monitored Suffixes: "
-                    #               "{}".format(filename))
+    def _traverse(self, dirname, mtime, cached, time_current, event_list,
+                  counts):
+        # pylint: disable=too-many-arguments
+
+        if (cached is not None
+                and cached.mtime == mtime
+                and mtime < cached.listed - self.mtime_resolution):
+            # no files were added or removed
+            counts["cached"] += 1
+            dir_cache = cached
+            subdirs = [(name, os.path.join(dirname, name), None)
+                       for name in cached.dirs]
+            self._check_cached_files(dirname, dir_cache, time_current,
+                                     event_list)
+        else:
+            counts["listed"] += 1
+            dir_cache = _DirCache(mtime, time_current)
+            subdirs = self._list_directory(dirname, dir_cache, time_current,
+                                           event_list)
+
+        for name, path, entry in subdirs:
+            try:
+                if entry is None:
+                    sub_mtime = os.stat(path).st_mtime
+                else:
+                    # reuses the stat result of the listing if available
+                    sub_mtime = entry.stat(follow_symlinks=False).st_mtime
+            except OSError:
+                # removed in the meantime
+                continue
+
+            sub_cached = None
+            if cached is not None:
+                sub_cached = cached.dirs.get(name)
+
+            dir_cache.dirs[name] = self._traverse(path,
+                                                  sub_mtime,
+                                                  sub_cached,
+                                                  time_current,
+                                                  event_list,
+                                                  counts)
+
+        return dir_cache
+
+    def _list_directory(self, dirname, dir_cache, time_current, event_list):
+        subdirs = []
+
+        try:
+            entries = list(scandir(dirname))
+        except OSError:
+            self.log.error("Unable to list directory: %s", dirname,
+                           exc_info=True)
+            return subdirs
+
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    # symlinked directories are not followed (like os.walk)
+                    if not entry.is_symlink():
+                        subdirs.append((entry.name, entry.path, entry))
                     continue
+            except OSError:
+                continue
 
-                filepath = os.path.join(root, filename)
-                self.log.debug("filepath: %s", filepath)
+            if self.mon_regex.match(entry.name) is None:
+                continue
 
+            try:
+                time_last_modified = entry.stat().st_mtime
+            except Exception:
+                self.log.error("Unable to get modification time for file: "
+                               "%s", entry.path, exc_info=True)
+                continue
+
+            dir_cache.files[entry.name] = time_last_modified
+            self._check_file(dirname, entry.name, time_last_modified,
+                             time_current, event_list)
+
+        return subdirs
+
+    def _check_cached_files(self, dirname, dir_cache, time_current,
+                            event_list):
+        for filename, time_last_modified in list(dir_cache.files.items()):
+            if time_current - time_last_modified < self.cleanup_time:
+                # the file may have been written to since
+                filepath = os.path.join(dirname, filename)
                 try:
                     time_last_modified = os.stat(filepath).st_mtime
-                except Exception:
-                    self.log.error("Unable to get modification time for file: "
-                                   "%s", filepath, exc_info=True)
+                except OSError:
+                    del dir_cache.files[filename]
                     continue
+                dir_cache.files[filename] = time_last_modified
 
-                try:
-                    # get current time
-                    time_current = time.time()
-                except Exception:
-                    self.log.error("Unable to get current time for file: %s",
-                                   filepath, exc_info=True)
-                    continue
+            self._check_file(dirname, filename, time_last_modified,
+                             time_current, event_list)
 
-                if time_current - time_last_modified >= self.cleanup_time:
-                    self.log.debug("New closed file detected: %s",
-                                   filepath)
-#                    self.log.debug("modTime: %s, currentTime: %s",
-#                                   time_last_modified, time_current)
-#                    self.log.debug("time_current - time_last_modified: %s, "
-#                                   "cleanup_time: %s",
-#                                   (time_current - time_last_modified),
-#                                   self.cleanup_time)
-                    event_message = get_event_message(root,
-                                                      filename,
-                                                      self.paths)
-                    self.log.debug("event_message: %s", event_message)
-
-                    # add to result list
-                    event_list.append(event_message)
+    def _check_file(self, dirname, filename, time_last_modified,
+                    time_current, event_list):
+        if time_current - time_last_modified >= self.cleanup_time:
+            self.log.debug("New closed file detected: %s",
+                           os.path.join(dirname, filename))
+            event_message = get_event_message(dirname, filename, self.paths)
+            self.log.debug("event_message: %s", event_message)
 
-        return event_list
+            # add to result list
+            event_list.append(event_message)
+
+    def pop_stats(self):
+        """The statistics of the last pass if not taken yet.
+
+        Returns:
+            A dictionary with the duration of the pass, the number of
+            directories listed and taken from the cache and the number of
+            events found, or None.
+        """
+
+        with self.lock:
+            stats = self.stats
+            self.stats = None
+
+        return stats
 
     def stop(self):
         """Stops the clean up thread
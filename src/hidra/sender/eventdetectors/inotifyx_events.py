@@ -37,6 +37,7 @@ eventdetector:
         use_cleanup: boolean
         action_time: float
         time_till_closed: float
+        cleanup_threads: int (optional)
 
 Example config:
     inotifyx_events:
@@ -62,11 +63,12 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
-import collections
 import copy
+import functools
 import os
 import re
 import threading
+import time
 
 import inotifyx
 from future.utils import iteritems
@@ -76,9 +78,11 @@ try:
 except ImportError:
     import pathlib2 as pathlib
 
+from event_history import EventHistory
 from eventdetectorbase import EventDetectorBase
 from hidra import convert_suffix_list_to_regex
 from inotify_utils import get_event_message, CleanUp, common_stop
+from watch_manager import WatchManager
 
 __author__ = 'Manuela Kuhn <manuela.kuhn@desy.de>'
 
@@ -91,6 +95,9 @@ class EventDetector(EventDetectorBase):
     inotifyx library.
     """
 
+    # the precision of the modification times to expect (in s)
+    mtime_resolution = 1
+
     def __init__(self, eventdetector_base_config):
 
         EventDetectorBase.__init__(self, eventdetector_base_config,
@@ -104,7 +111,7 @@ class EventDetector(EventDetectorBase):
         #   self.log_queue
         #   self.log
 
-        self.wd_to_path = {}
+        self.watches = None
         self.file_descriptor = None
         self.paths = None
         self.mon_subdirs = None
@@ -114,6 +121,13 @@ class EventDetector(EventDetectorBase):
         self.history = None
         self.lock = None
 
+        # files found by a rescan which could still be open
+        self.rescanned = set()
+        self.time_till_closed = None
+        # when the inotify events were read last, files closed before were
+        # reported already
+        self.time_read = None
+
         self.cleanup_time = None
         self.action_time = None
         self.cleanup_thread = None
@@ -163,6 +177,14 @@ class EventDetector(EventDetectorBase):
             self.timeout = 1
 
         self.file_descriptor = inotifyx.init()
+        self.watches = WatchManager(
+            add_watch=functools.partial(inotifyx.add_watch,
+                                        self.file_descriptor),
+            rm_watch=functools.partial(inotifyx.rm_watch,
+                                       self.file_descriptor),
+            log=self.log,
+            recent_dirs=self.config.get("rescan_dirs", 1000)
+        )
 
         # TODO why is this necessary
         self.paths = [self.config["monitored_dir"]]
@@ -197,10 +219,13 @@ class EventDetector(EventDetectorBase):
                                                       compile_regex=True,
                                                       log=self.log)
 
-        self.history = collections.deque(maxlen=self.config["history_size"])
+        self.history = EventHistory(self.config["history_size"])
+        self.time_till_closed = self.config.get("time_till_closed", 2)
 
         self.lock = threading.Lock()
 
+        # the files existing when starting are not reported
+        self.time_read = time.time()
         self._add_watch()
 
         if self.config["use_cleanup"]:
@@ -216,12 +241,19 @@ class EventDetector(EventDetectorBase):
                 cleanup_time=self.cleanup_time,
                 action_time=self.action_time,
                 lock=self.lock,
-                log_queue=self.log_queue
+                log_queue=self.log_queue,
+                threads=self.config.get("cleanup_threads", 4)
             )
             self.cleanup_thread.start()
         else:
             self.get_remaining_events = self._get_no_events
 
+    def _get_monitored_dirs(self):
+        """The absolute paths of the fix_subdirs.
+        """
+        return [os.path.normpath(os.path.join(self.paths[0], directory))
+                for directory in self.mon_subdirs]
+
     def _add_watch(self):
         """Add directories to inotify watch.
 
@@ -229,46 +261,132 @@ class EventDetector(EventDetectorBase):
         inotify watch.
         """
 
-        for path in self._get_directory_structure():
+        for directory in self._get_monitored_dirs():
+            if os.path.isdir(directory):
+                n_watched = self.watches.watch_tree(directory)
+                self.log.info("Added %s directories in %s to watch",
+                              n_watched, directory)
+            else:
+                self.log.info("Dir does not exist: %s", directory)
+
+    def _filter_files(self, files, parts):
+        """The files found in a directory scan which have to be reported.
+
+        Args:
+            files: A list of (<dirpath>, <filename>) tuples.
+            parts: The inotify event types which triggered the scan.
+
+        Returns:
+            A list of (<dirpath>, <filename>) tuples.
+        """
+
+        filtered = []
+        for dirpath, filename in files:
+            # pylint: disable=no-member
+            if self.mon_regex.match(filename) is None:
+                self.log.debug("File does not match monitored "
+                               "regex: %s", filename)
+                self.log.debug("detected events were: %s", parts)
+                continue
+
+            # not added to the history because the file could still be
+            # open, the close event has to get through then
+            if (dirpath, filename) in self.history:
+                continue
+
+            filtered.append((dirpath, filename))
+
+        return filtered
+
+    def _get_file_events(self, files, parts):
+        """Generate the event messages for files found in a directory scan.
+
+        Args:
+            files: A list of (<dirpath>, <filename>) tuples.
+            parts: The inotify event types which triggered the scan.
+
+        Returns:
+            A list of event messages.
+        """
+
+        event_message_list = []
+        for dirpath, filename in self._filter_files(files, parts):
+            event_message = get_event_message(dirpath, filename, self.paths)
+            self.log.debug("event_message: %s", event_message)
+            event_message_list.append(event_message)
+
+        return event_message_list
+
+    def _rescan(self, parts):
+        """Recover from an overflow of the event queue.
+
+        Only the files modified since the events were read last can have
+        missed their events, the others were reported already (even if the
+        history does not remember them).
+
+        Args:
+            parts: The inotify event types which triggered the rescan.
+
+        Returns:
+            A list of event messages.
+        """
+
+        files = []
+        self.watches.rescan(self._get_monitored_dirs(), files)
+
+        modified_since = self.time_read - self.mtime_resolution
+        for key in self._filter_files(files, parts):
             try:
-                watch_descriptor = inotifyx.add_watch(
-                    self.file_descriptor,
-                    path
-                )
-                self.wd_to_path[watch_descriptor] = path
-                self.log.debug("Register watch for path: %s", path)
-            except Exception:
-                self.log.error("Could not register watch for path: %s", path,
-                               exc_info=True)
+                time_last_modified = os.stat(os.path.join(*key)).st_mtime
+            except OSError:
+                # removed in the meantime
+                continue
+
+            if time_last_modified >= modified_since:
+                self.rescanned.add(key)
 
-    def _get_directory_structure(self):
-        """For all directories configured find all sub-directories contained.
+        # the files could still be open, thus the ones modified recently are
+        # reported later
+        return self._get_rescanned_events()
+
+    def _get_rescanned_events(self):
+        """Generate the event messages for the files found by a rescan.
+
+        Files modified within time_till_closed could still be open. They are
+        left to their close event and only reported once they were not
+        modified for that long and no event was seen for them.
 
         Returns:
-            A list of directories to be monitored.
+            A list of event messages.
         """
 
-        # Add the default subdirs
-        self.log.debug("paths: %s", self.paths)
-        dirs_to_walk = [os.path.normpath(os.path.join(self.paths[0],
-                                                      directory))
-                        for directory in self.mon_subdirs]
-        self.log.debug("dirs_to_walk: %s", dirs_to_walk)
-        monitored_dirs = []
+        time_current = time.time()
 
-        # Walk the tree
-        for directory in dirs_to_walk:
-            if os.path.isdir(directory):
-                monitored_dirs.append(directory)
-                for root, _, _ in os.walk(directory):
-                    # Add the found dirs to the list for the inotify-watch
-                    if root not in monitored_dirs:
-                        monitored_dirs.append(root)
-                        self.log.info("Add directory to monitor: %s", root)
-            else:
-                self.log.info("Dir does not exist: %s", directory)
+        event_message_list = []
+        for key in list(self.rescanned):
+            if key in self.history:
+                # the close event got through
+                self.rescanned.discard(key)
+                continue
+
+            try:
+                time_last_modified = os.stat(os.path.join(*key)).st_mtime
+            except OSError:
+                # removed in the meantime
+                self.rescanned.discard(key)
+                continue
+
+            if time_current - time_last_modified < self.time_till_closed:
+                continue
 
-        return monitored_dirs
+            self.rescanned.discard(key)
+            self.history.add(key)
+
+            event_message = get_event_message(key[0], key[1], self.paths)
+            self.log.debug("event_message: %s", event_message)
+            event_message_list.append(event_message)
+
+        return event_message_list
 
     def _get_no_events(self):  # pylint: disable=no-self-use
         """No events to add.
@@ -301,6 +419,26 @@ class EventDetector(EventDetectorBase):
 
         return event_message_list
 
+    def get_poll_fd(self):
+        """Implementation of the get_poll_fd method of the base class.
+
+        The events found by the clean up thread do not wake up the file
+        descriptor, thus it cannot be used then.
+        """
+
+        if self.config["use_cleanup"]:
+            return None
+        return self.file_descriptor
+
+    def has_pending_events(self):
+        """Implementation of the has_pending_events method of the base class.
+
+        The files held back after a rescan are reported even if no further
+        inotify events arrive.
+        """
+
+        return bool(self.rescanned)
+
     def get_new_event(self):
         """Implementation of the abstract method get_new_event.
 
@@ -311,34 +449,53 @@ class EventDetector(EventDetectorBase):
         remaining_events = self.get_remaining_events()
 
         # only take the events which are not handles yet
-        event_message_list = [
-            event for event in remaining_events
-            if [os.path.join(event["source_path"], event["relative_path"]),
-                event["filename"]] not in self.history
-        ]
-        self.history += [
-            [os.path.join(event["source_path"], event["relative_path"]),
-             event["filename"]]
-            for event in remaining_events
-        ]
+        event_message_list = []
+        for event in remaining_events:
+            key = (os.path.join(event["source_path"], event["relative_path"]),
+                   event["filename"])
+            if self.history.add(key):
+                event_message_list.append(event)
+
+        if self.rescanned:
+            event_message_list += self._get_rescanned_events()
 
         # event_message_list = self.get_remaining_events()
         event_message = {}
 
-        events = inotifyx.get_events(self.file_descriptor, self.timeout)
+        # when polled, this is also called for the files held back after a
+        # rescan, thus it must not wait for new events then
+        if self.get_poll_fd() is None:
+            timeout = self.timeout
+        else:
+            timeout = 0
+        events = inotifyx.get_events(self.file_descriptor, timeout)
+        time_read = time.time()
         removed_wd = None
 
         for event in events:
 
+            parts = event.get_mask_description()
+            parts_array = parts.split("|")
+
+            # events were dropped by the kernel, thus the directories they
+            # could have happened in have to be scanned
+            if "IN_Q_OVERFLOW" in parts_array:
+                event_message_list += self._rescan(parts)
+                continue
+
+            # the directory was removed
+            if "IN_IGNORED" in parts_array:
+                self.watches.forget(event.wd)
+                continue
+
             if not event.name:
                 continue
 
-            try:
-                path = self.wd_to_path[event.wd]
-            except Exception:
+            path = self.watches.get_path(event.wd)
+            if path is None:
                 path = removed_wd
-            parts = event.get_mask_description()
-            parts_array = parts.split("|")
+            else:
+                self.watches.mark_active(path)
 
             is_dir = ("IN_ISDIR" in parts_array)
             is_created = ("IN_CREATE" in parts_array)
@@ -379,48 +536,18 @@ class EventDetector(EventDetectorBase):
                     self.log.debug("Directory already contained in path list:"
                                    " %s", dirname)
                 else:
-                    watch_descriptor = inotifyx.add_watch(   # noqa E501
-                        self.file_descriptor,
-                        dirname
-                    )
-                    self.wd_to_path[watch_descriptor] = dirname
-                    self.log.info("Added new directory to watch: %s", dirname)
-
                     # because inotify misses subdirectory creations if they
                     # happen to fast, the newly created directory has to be
                     # walked to get catch this misses
                     # http://stackoverflow.com/questions/15806488/
                     #        inotify-missing-events
-                    for dirpath, directories, files in os.walk(dirname):
-                        # Add the found dirs to the list for the inotify-watch
-                        for dname in directories:
-                            subdir = os.path.join(dirpath, dname)
-                            watch_descriptor = inotifyx.add_watch(
-                                self.file_descriptor,
-                                subdir
-                            )
-                            self.wd_to_path[watch_descriptor] = subdir
-                            self.log.info("Added new subdirectory to watch: "
-                                          "%s", subdir)
-                        self.log.debug("files: %s", files)
-
-                        for filename in files:
-                            # self.log.debug("filename: {}".format(filename))
-                            # pylint: disable=no-member
-                            if self.mon_regex.match(filename) is None:
-                                self.log.debug("File does not match monitored "
-                                               "regex: %s", filename)
-                                self.log.debug("detected events were: %s",
-                                               parts)
-                                continue
-
-                            event_message = get_event_message(dirpath,
-                                                              filename,
-                                                              self.paths)
-                            self.log.debug("event_message: %s", event_message)
-                            event_message_list.append(event_message)
-#                            self.log.debug("event_message_list: {}"
-#                                           .format(event_message_list))
+                    files = []
+                    n_watched = self.watches.watch_tree(dirname, files)
+                    self.log.info("Added new directory to watch: %s "
+                                  "(%s directories)", dirname, n_watched)
+                    self.log.debug("files: %s", files)
+
+                    event_message_list += self._get_file_events(files, parts)
                 continue
 
             # if a directory is renamed the old watch has to be removed
@@ -431,26 +558,17 @@ class EventDetector(EventDetectorBase):
                 # self.log.debug(event.name)
 
                 dirname = os.path.join(path, event.name)
-                found_watch = None
-                for watch, watch_path in iteritems(self.wd_to_path):
-                    if watch_path == dirname:
-                        found_watch = watch
-                        break
-                inotifyx.rm_watch(self.file_descriptor, found_watch)
+                self.watches.unwatch_tree(dirname)
                 self.log.info("Removed directory from watch: %s", dirname)
                 # the IN_MOVE_FROM event always apears before the IN_MOVE_TO
                 # (+ additional) events and thus has to be stored till loop
                 # is finished
-                removed_wd = self.wd_to_path[found_watch]
-                # removing the watch out of the dictionary cannot be done
-                # inside the loop (would throw error: dictionary changed size
-                # during iteration)
-                del self.wd_to_path[found_watch]
+                removed_wd = dirname
                 continue
 
             # only files of the configured event type are send
             if (not is_dir and current_mon_event
-                    and [path, event.name] not in self.history):
+                    and (path, event.name) not in self.history):
 
                 # only files matching the regex specified with the current
                 # event are monitored
@@ -464,10 +582,30 @@ class EventDetector(EventDetectorBase):
                 self.log.debug("event_message %s", event_message)
                 event_message_list.append(event_message)
 
-                self.history.append([path, event.name])
+                self.history.add((path, event.name))
+
+        self.time_read = time_read
 
         return event_message_list
 
+    def pop_stats(self):
+        """Extend the pop_stats function of the base class with the number of
+        watches, the queue overflows and the duration of the clean up passes.
+        """
+
+        stats = []
+
+        watch_stats = self.watches.pop_stats()
+        if watch_stats is not None:
+            stats.append(("watches", watch_stats))
+
+        if self.cleanup_thread is not None:
+            cleanup_stats = self.cleanup_thread.pop_stats()
+            if cleanup_stats is not None:
+                stats.append(("cleanup", cleanup_stats))
+
+        return stats
+
     def stop(self):
         """Implementation of the abstract method stop.
         """
@@ -476,16 +614,8 @@ class EventDetector(EventDetectorBase):
             self.cleanup_thread.stop()
 
         try:
-            for watch_descriptor, watch_path in self.wd_to_path.items():
-                try:
-                    inotifyx.rm_watch(
-                        self.file_descriptor,
-                        watch_descriptor
-                    )
-                except Exception:
-                    self.log.error("Unable to remove watch: %s for %s",
-                                   watch_descriptor, watch_path, exc_info=True)
-            self.wd_to_path = {}
+            if self.watches is not None:
+                self.watches.unwatch_all()
         finally:
             if self.file_descriptor is not None:
                 try:
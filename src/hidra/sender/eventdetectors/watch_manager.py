@@ -0,0 +1,363 @@
+# Copyright (C) 2015  DESY, Manuela Kuhn, Notkestr. 85, D-22607 Hamburg
+#
+# HiDRA is a generic tool set for high performance data multiplexing with
+# different qualities of service and based on Python and ZeroMQ.
+#
+# This software is free: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Manuela Kuhn <manuela.kuhn@desy.de>
+#
+
+"""
+This module implements the management of the inotify watches of the
+monitored directory trees.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import errno
+import os
+
+try:
+    from os import scandir
+except ImportError:
+    # python 2
+    from scandir import scandir
+
+from event_history import EventHistory
+
+__author__ = 'Manuela Kuhn <manuela.kuhn@desy.de>'
+
+INOTIFY_PROC_DIR = "/proc/sys/fs/inotify"
+
+
+def get_inotify_limit(name):
+    """Read a limit of the inotify subsystem of the kernel.
+
+    Args:
+        name: The name of the limit (e.g. max_user_watches).
+
+    Returns:
+        The limit or None if it could not be determined.
+    """
+
+    try:
+        with open(os.path.join(INOTIFY_PROC_DIR, name)) as limit_file:
+            return int(limit_file.read())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _is_in_tree(path, roots):
+    # checks the parents instead of comparing with each root
+    while path not in roots:
+        parent = os.path.dirname(path)
+        if parent == path:
+            return False
+        path = parent
+    return True
+
+
+class WatchManager(object):
+    """Keeps track of the inotify watches of directory trees.
+
+    Watches are looked up by descriptor and by path in constant time, the
+    watched subdirectories are indexed by their parent so that removing a
+    subtree only visits the watches in it. The directories events were seen
+    in last are remembered, so that only their subtrees have to be scanned
+    again when the event queue overflowed.
+    """
+
+    def __init__(self, add_watch, rm_watch, log, recent_dirs=1000):
+        """
+        Args:
+            add_watch: The function to watch a directory, taking the path
+                and returning the watch descriptor.
+            rm_watch: The function to remove a watch, taking the watch
+                descriptor.
+            log: The logger to use.
+            recent_dirs (optional): How many of the directories with
+                events to remember for rescans.
+        """
+
+        self.add_watch = add_watch
+        self.rm_watch = rm_watch
+        self.log = log
+
+        self.wd_to_path = {}
+        self.path_to_wd = {}
+        # the watched directories by their parent directory
+        self.children = {}
+        self.recent = EventHistory(recent_dirs)
+
+        self.n_failed = 0
+        self.n_overflows = 0
+        self.n_rescanned = 0
+        self.changed = False
+
+        self.limits = {
+            "max_user_watches": get_inotify_limit("max_user_watches"),
+            "max_queued_events": get_inotify_limit("max_queued_events")
+        }
+
+    def __len__(self):
+        return len(self.wd_to_path)
+
+    def _index(self, path):
+        self.children.setdefault(os.path.dirname(path), set()).add(path)
+
+    def _unindex(self, path):
+        parent = os.path.dirname(path)
+        siblings = self.children.get(parent)
+        if siblings is not None:
+            siblings.discard(path)
+            if not siblings:
+                del self.children[parent]
+
+    def get_path(self, watch_descriptor):
+        """The directory a watch belongs to (None if unknown).
+        """
+        return self.wd_to_path.get(watch_descriptor)
+
+    def watch(self, path):
+        """Watch a directory.
+
+        Args:
+            path: The absolute path of the directory.
+
+        Returns:
+            True if the directory is watched, False otherwise.
+        """
+
+        try:
+            watch_descriptor = self.add_watch(path)
+        except (IOError, OSError) as excp:
+            self.n_failed += 1
+            self.changed = True
+            if excp.errno == errno.ENOSPC:
+                self.log.error("Could not register watch for path: %s, "
+                               "limit of inotify watches reached (%s "
+                               "watches, max_user_watches=%s)", path,
+                               len(self), self.limits["max_user_watches"])
+            else:
+                self.log.error("Could not register watch for path: %s",
+                               path, exc_info=True)
+            return False
+
+        # watching a directory again returns the same descriptor
+        old_path = self.wd_to_path.get(watch_descriptor)
+        if old_path is None:
+            self.changed = True
+        elif old_path != path:
+            # the directory was renamed
+            del self.path_to_wd[old_path]
+            self._unindex(old_path)
+
+        self.wd_to_path[watch_descriptor] = path
+        self.path_to_wd[path] = watch_descriptor
+        self._index(path)
+
+        return True
+
+    def watch_tree(self, path, files=None):
+        """Watch a directory and all its subdirectories.
+
+        Each directory is watched before it is listed, thus no entries
+        created in the meantime are missed.
+
+        Args:
+            path: The absolute path of the directory.
+            files (optional): A list to add the (<dirpath>, <filename>) of
+                the files found to.
+
+        Returns:
+            The number of directories watched.
+        """
+
+        n_watched = 0
+        dirs_to_walk = [path]
+
+        while dirs_to_walk:
+            dirpath = dirs_to_walk.pop()
+
+            if not self.watch(dirpath):
+                continue
+            n_watched += 1
+
+            try:
+                entries = list(scandir(dirpath))
+            except OSError:
+                # removed in the meantime
+                self.log.debug("Could not list directory: %s", dirpath)
+                continue
+
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    continue
+
+                if is_dir:
+                    dirs_to_walk.append(entry.path)
+                elif files is not None:
+                    files.append((dirpath, entry.name))
+
+        return n_watched
+
+    def unwatch_tree(self, path):
+        """Remove the watches of a directory and its subdirectories.
+
+        Args:
+            path: The absolute path of the directory.
+
+        Returns:
+            The number of watches removed.
+        """
+
+        paths = []
+        dirs_to_walk = [path]
+        while dirs_to_walk:
+            dirpath = dirs_to_walk.pop()
+            if dirpath in self.path_to_wd:
+                paths.append(dirpath)
+            dirs_to_walk.extend(self.children.get(dirpath, ()))
+
+        for watched in paths:
+            watch_descriptor = self.path_to_wd.pop(watched)
+            self._unindex(watched)
+            del self.wd_to_path[watch_descriptor]
+            try:
+                self.rm_watch(watch_descriptor)
+            except Exception:
+                # the directory is gone already
+                self.log.debug("Could not remove watch for path: %s",
+                               watched)
+
+        if paths:
+            self.changed = True
+
+        return len(paths)
+
+    def unwatch_all(self):
+        """Remove all watches.
+        """
+
+        for watch_descriptor, path in self.wd_to_path.items():
+            try:
+                self.rm_watch(watch_descriptor)
+            except Exception:
+                self.log.error("Unable to remove watch: %s for %s",
+                               watch_descriptor, path, exc_info=True)
+
+        self.wd_to_path = {}
+        self.path_to_wd = {}
+        self.children = {}
+        self.changed = True
+
+    def forget(self, watch_descriptor):
+        """Drop a watch which was removed by the kernel (IN_IGNORED).
+        """
+
+        path = self.wd_to_path.pop(watch_descriptor, None)
+        if path is not None:
+            if self.path_to_wd.get(path) == watch_descriptor:
+                del self.path_to_wd[path]
+                self._unindex(path)
+            self.changed = True
+
+    def mark_active(self, path):
+        """Remember that an event was seen in a directory.
+        """
+        self.recent.add(path)
+
+    def get_rescan_dirs(self, roots):
+        """The subtrees which could have missed events.
+
+        Args:
+            roots: The monitored directories, rescanned completely if no
+                events were seen yet.
+
+        Returns:
+            A list of directories not contained in each other.
+        """
+
+        candidates = [path for path in self.recent if os.path.isdir(path)]
+        if not candidates:
+            candidates = roots
+
+        # parents sort before their subdirectories
+        rescan_dirs = set()
+        for path in sorted(candidates, key=len):
+            if not _is_in_tree(path, rescan_dirs):
+                rescan_dirs.add(path)
+
+        return sorted(rescan_dirs)
+
+    def rescan(self, roots, files):
+        """Recover from an overflow of the event queue.
+
+        The subtrees events were seen in last are watched again (watching
+        new subdirectories) and their files are reported, the event detector
+        has to filter the ones handled already.
+
+        Args:
+            roots: The monitored directories.
+            files: A list to add the (<dirpath>, <filename>) of the files
+                found to.
+
+        Returns:
+            The number of directories rescanned.
+        """
+
+        self.n_overflows += 1
+        self.changed = True
+
+        rescan_dirs = self.get_rescan_dirs(roots)
+        self.log.warning("Event queue overflowed (max_queued_events=%s), "
+                         "rescanning: %s", self.limits["max_queued_events"],
+                         rescan_dirs)
+
+        n_rescanned = 0
+        for path in rescan_dirs:
+            n_rescanned += self.watch_tree(path, files)
+
+        self.n_rescanned += n_rescanned
+        return n_rescanned
+
+    def get_stats(self):
+        """The number of watches and overflows.
+        """
+
+        stats = {
+            "watches": len(self),
+            "failed": self.n_failed,
+            "overflows": self.n_overflows,
+            "rescanned_dirs": self.n_rescanned
+        }
+        stats.update(self.limits)
+
+        return stats
+
+    def pop_stats(self):
+        """The statistics if they changed since the last call (else None).
+        """
+
+        if not self.changed:
+            return None
+
+        self.changed = False
+        return self.get_stats()
@@ -58,13 +58,11 @@ from __future__ import unicode_literals
 # requires dependency on future
 from builtins import super  # pylint: disable=redefined-builtin
 
-import bisect
-import copy
+import heapq
 import logging
 import os
 import threading
 import time
-from multiprocessing.dummy import Pool as ThreadPool
 
 from future.utils import iteritems
 from watchdog.observers import Observer
@@ -90,9 +88,6 @@ __author__ = 'Manuela Kuhn <manuela.kuhn@desy.de>'
 # except NameError:
 #     WindowsError = None
 
-_potential_close_events = []  # pylint: disable=invalid-name
-_events_marked_to_remove = []  # pylint: disable=invalid-name
-
 # pylint: disable=global-variable-not-assigned
 
 
@@ -104,6 +99,47 @@ class EventStore(object):
         self.cond = threading.Condition()
         self.events = []
 
+        # a pipe which is readable while events are stored
+        self.pipe = None
+        self.signaled = False
+
+    def get_fd(self):
+        """A file descriptor to poll for new events.
+
+        Returns:
+            The read end of a pipe which is readable while the store is not
+            empty.
+        """
+
+        with self.cond:
+            if self.pipe is None:
+                self.pipe = os.pipe()
+                self.signaled = False
+                if self.events:
+                    self._signal()
+
+            return self.pipe[0]
+
+    def close_fd(self):
+        """Close the pipe created by get_fd.
+        """
+
+        with self.cond:
+            if self.pipe is not None:
+                os.close(self.pipe[0])
+                os.close(self.pipe[1])
+                self.pipe = None
+
+    def _signal(self):
+        if self.pipe is not None and not self.signaled:
+            os.write(self.pipe[1], b"x")
+            self.signaled = True
+
+    def _clear(self):
+        if self.pipe is not None and self.signaled:
+            os.read(self.pipe[0], 1)
+            self.signaled = False
+
     def add(self, event):
         """Add a event to the store
 
@@ -115,6 +151,7 @@ class EventStore(object):
             self.events.append(event)
             # Waking up threads that are waiting for new input
             self.cond.notify()
+            self._signal()
 
     def get_all(self, blocking=False, timeout=None):
         """Get and emtpy all stored event.
@@ -138,6 +175,7 @@ class EventStore(object):
             # len(self.events) > 0, so we do nothing special and return
             # whatever events there are
             events, self.events = self.events, []
+            self._clear()
 
         return events
 
@@ -155,11 +193,114 @@ class EventStore(object):
 
         with self.cond:
             self.events = []
+            self._clear()
 
 
 _event_store = EventStore()  # pylint: disable=invalid-name
 
 
+class CloseDeadlines(object):
+    """The files which could be closed, ordered by when to check them.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        # entries are of the form (<deadline>, <filepath>)
+        self.heap = []
+        # the files in the heap
+        self.files = set()
+
+    def add(self, filepath, deadline):
+        """Schedule a file to be checked if it was not already.
+
+        Args:
+            filepath: The absolute path of the file.
+            deadline: When to check the file (in epoch time).
+
+        Returns:
+            True if the file was added, False if it was scheduled already.
+        """
+
+        with self.cond:
+            if filepath in self.files:
+                return False
+
+            self.files.add(filepath)
+            heapq.heappush(self.heap, (deadline, filepath))
+
+            # the waiting thread has to wake up earlier
+            if self.heap[0][1] == filepath:
+                self.cond.notify()
+
+        return True
+
+    def reschedule(self, filepath, deadline):
+        """Check a file popped by get_due again later.
+
+        Args:
+            filepath: The absolute path of the file.
+            deadline: When to check the file (in epoch time).
+        """
+
+        with self.cond:
+            self.files.discard(filepath)
+        self.add(filepath, deadline)
+
+    def discard(self, filepath):
+        """Stop tracking a file popped by get_due.
+        """
+
+        with self.cond:
+            self.files.discard(filepath)
+
+    def get_due(self, timeout):
+        """Wait for the files whose deadline passed.
+
+        The files stay marked as scheduled until they are rescheduled or
+        discarded, thus new events for them are ignored in the meantime.
+
+        Args:
+            timeout: How long to wait at most (in s).
+
+        Returns:
+            A list of file paths.
+        """
+
+        with self.cond:
+            now = time.time()
+            if not self.heap or self.heap[0][0] > now:
+                if self.heap:
+                    timeout = min(timeout, self.heap[0][0] - now)
+                self.cond.wait(timeout)
+                now = time.time()
+
+            due = []
+            while self.heap and self.heap[0][0] <= now:
+                due.append(heapq.heappop(self.heap)[1])
+
+        return due
+
+    def wake_up(self):
+        """Wake up the thread waiting in get_due.
+        """
+
+        with self.cond:
+            self.cond.notify_all()
+
+    def __len__(self):
+        return len(self.files)
+
+    def remove_all(self):
+        """Remove all files"""
+
+        with self.cond:
+            self.heap = []
+            self.files = set()
+
+
+_close_deadlines = CloseDeadlines()  # pylint: disable=invalid-name
+
+
 # documentation of watchdog: https://pythonhosted.org/watchdog/api.html
 class WatchdogEventHandler(RegexMatchingEventHandler):
     """
@@ -169,6 +310,7 @@ class WatchdogEventHandler(RegexMatchingEventHandler):
     def __init__(self, handler_id, config, lock, log_queue):
         self.handler_id = handler_id
         self.lock = lock
+        self.time_till_closed = config["time_till_closed"]
 
         # Suppress logging messages of watchdog observer
         logging.getLogger("watchdog.observers.inotify_buffer").setLevel(
@@ -257,7 +399,7 @@ class WatchdogEventHandler(RegexMatchingEventHandler):
             self.process(event)
 
     def on_created(self, event):
-        global _potential_close_events   # pylint: disable=invalid-name
+        global _close_deadlines   # pylint: disable=invalid-name
 
         # pylint: disable=no-member
         if self.detect_create and self.detect_create.match(event.src_path):
@@ -270,15 +412,15 @@ class WatchdogEventHandler(RegexMatchingEventHandler):
         if self.detect_close and self.detect_close.match(event.src_path):
             self.log.debug("On close event detected (from create, "
                            "filename=%s)", event.src_path)
+            # the file was just modified, thus it cannot be closed before
             if (not event.is_directory
-                    and event.src_path not in _potential_close_events):
-                self.log.debug("Append event to _potential_close_events: %s",
-                               event.src_path)
-#                _potential_close_events.append(event.src_path)
-                bisect.insort_left(_potential_close_events, event.src_path)
+                    and _close_deadlines.add(
+                        event.src_path, time.time() + self.time_till_closed
+                    )):
+                self.log.debug("Scheduled close check: %s", event.src_path)
 
     def on_modified(self, event):
-        global _potential_close_events   # pylint: disable=invalid-name
+        global _close_deadlines   # pylint: disable=invalid-name
 
         # pylint: disable=no-member
         if self.detect_modify and self.detect_modify.match(event.src_path):
@@ -288,12 +430,13 @@ class WatchdogEventHandler(RegexMatchingEventHandler):
 
         # pylint: disable=no-member
         if self.detect_close and self.detect_close.match(event.src_path):
+            # files scheduled already are rescheduled when checked
             if (not event.is_directory
-                    and event.src_path not in _potential_close_events):
+                    and _close_deadlines.add(
+                        event.src_path, time.time() + self.time_till_closed
+                    )):
                 self.log.debug("On close event detected (from modify, "
                                "filename=%s)", event.src_path)
-#                _potential_close_events.append(event.src_path)
-                bisect.insort_left(_potential_close_events, event.src_path)
 
     def on_deleted(self, event):
         # pylint: disable=no-member
@@ -386,12 +529,15 @@ def get_event_message(filepath, paths):
 
 class CheckModTime(threading.Thread):
     """
-    A thread going over the found events on a regular basis and checking them
-    for their modification time.
+    A thread checking the modification time of the found files when their
+    deadline is reached.
+
+    A file is checked time_till_closed after it was last seen modified. If
+    it was modified in the meantime, it is checked again time_till_closed
+    after this modification.
     """
 
     def __init__(self,
-                 number_of_threads,
                  time_till_closed,
                  mon_dir,
                  action_time,
@@ -405,48 +551,22 @@ class CheckModTime(threading.Thread):
                                     log_level="info")
 
         self.log.debug("init")
-        # Make the Pool of workers
-        self.pool = ThreadPool(number_of_threads)
         self.mon_dir = mon_dir
         self.time_till_closed = time_till_closed  # s
+        # how often to check for stop requests while idle
         self.action_time = action_time
         self.lock = lock
         self.stopper = stop_request
-        self.pool_running = True
 
     def run(self):
         """Keep check for events."""
-        global _event_store  # pylint: disable=invalid-name
-        global _potential_close_events  # pylint: disable=invalid-name
-        global _events_marked_to_remove  # pylint: disable=invalid-name
+        global _close_deadlines  # pylint: disable=invalid-name
 
         self.log.debug("start run")
         while not self.stopper.is_set():
             try:
-                with self.lock:
-                    tmp_copy_of_events = copy.deepcopy(_potential_close_events)
-
-                if self.pool_running:
-                    self.pool.map(self.check_last_modified, tmp_copy_of_events)
-                else:
-                    self.log.info("Pool was already closed")
-                    break
-
-                for event in _events_marked_to_remove:
-                    try:
-                        with self.lock:
-                            _potential_close_events.remove(event)
-                        self.log.debug("Removing event: %s", event)
-                    except Exception:
-                        self.log.error("Removing event failed: %s", event,
-                                       exc_info=True)
-                        self.log.debug("_events_marked_to_remove=%s",
-                                       _events_marked_to_remove)
-                        self.log.debug("_potential_close_events=%s",
-                                       _potential_close_events)
-                _events_marked_to_remove = []
-
-                time.sleep(self.action_time)
+                for filepath in _close_deadlines.get_due(self.action_time):
+                    self.check_last_modified(filepath)
             except Exception:
                 self.log.error("Stopping loop due to error", exc_info=True)
                 break
@@ -454,13 +574,14 @@ class CheckModTime(threading.Thread):
     def check_last_modified(self, filepath):
         """
         Checks if a files modification time is above the threshold. If so it
-        is added to the global event message list.
+        is added to the global event message list, otherwise it is checked
+        again when it would reach the threshold.
 
         Args:
             filepath (str): the filename of the file to check (absolute path).
         """
         global _event_store   # pylint: disable=invalid-name
-        global _events_marked_to_remove   # pylint: disable=invalid-name
+        global _close_deadlines   # pylint: disable=invalid-name
 
         try:
             stat_result = os.stat(filepath)
@@ -470,16 +591,7 @@ class CheckModTime(threading.Thread):
             self.log.error("Unable to get modification time for file: %s",
                            filepath, exc_info=True)
             # remove the file from the observing list
-            with self.lock:
-                _events_marked_to_remove.append(filepath)
-            return
-
-        try:
-            # get current time
-            time_current = time.time()
-        except Exception:
-            self.log.error("Unable to get current time for file: %s",
-                           filepath, exc_info=True)
+            _close_deadlines.discard(filepath)
             return
 
         if file_size == 0:
@@ -489,6 +601,8 @@ class CheckModTime(threading.Thread):
         else:
             threshold = self.time_till_closed
 
+        time_current = time.time()
+
         if time_current - time_last_modified >= threshold:
             self.log.debug("New closed file detected: %s", filepath)
 
@@ -498,26 +612,23 @@ class CheckModTime(threading.Thread):
             # add to result list
             _event_store.add(event_message)
 
-            with self.lock:
-                _events_marked_to_remove.append(filepath)
+            _close_deadlines.discard(filepath)
         else:
             self.log.debug("File was last modified %s sec ago: %s",
                            time_current - time_last_modified, filepath)
+            _close_deadlines.reschedule(filepath,
+                                        time_last_modified + threshold)
 
     def stop(self):
-        """ Stopping the loop and closing the pool
+        """ Stopping the loop
         """
-        if self.pool_running:
+        global _close_deadlines   # pylint: disable=invalid-name
+
+        if not self.stopper.is_set():
             self.log.info("Stopping CheckModTime")
             self.stopper.set()
-            self.pool_running = False
 
-        if self.pool is not None:
-            # close the pool and wait for the work to finish
-            self.pool.close()
-            self.pool.join()
-            self.log.info("Checking pool joined")
-            self.pool = None
+        _close_deadlines.wake_up()
 
     def __exit__(self, exception_type, exception_value, traceback):
         self.stop()
@@ -602,7 +713,6 @@ class EventDetector(EventDetectorBase):
             self.log.info("Started observer for directory: %s", path)
 
         self.checking_thread = CheckModTime(
-            number_of_threads=4,
             time_till_closed=self.config["time_till_closed"],
             mon_dir=self.mon_dir,
             action_time=self.config["action_time"],
@@ -612,6 +722,16 @@ class EventDetector(EventDetectorBase):
         )
         self.checking_thread.start()
 
+    def get_poll_fd(self):
+        """Implementation of the get_poll_fd method of the base class.
+        """
+        global _event_store   # pylint: disable=invalid-name
+
+        # zmq can only poll sockets on Windows
+        if utils.is_windows():
+            return None
+        return _event_store.get_fd()
+
     def get_new_event(self):
         """Implementation of the abstract method get_new_event.
         """
@@ -624,8 +744,7 @@ class EventDetector(EventDetectorBase):
         """
 
         global _event_store   # pylint: disable=invalid-name
-        global _potential_close_events   # pylint: disable=invalid-name
-        global _events_marked_to_remove   # pylint: disable=invalid-name
+        global _close_deadlines   # pylint: disable=invalid-name
 
         self.stop_request.set()
 
@@ -637,7 +756,7 @@ class EventDetector(EventDetectorBase):
 
             self.observer_threads = None
 
-        # close the pool and wait for the work to finish
+        # wait for the checks to finish
         if self.checking_thread is not None:
             self.log.info("Stopping checking thread")
             self.checking_thread.stop()
@@ -648,5 +767,5 @@ class EventDetector(EventDetectorBase):
         # resetting event list
         with self.lock:
             _event_store.remove_all()
-            _potential_close_events = []
-            _events_marked_to_remove = []
+            _event_store.close_fd()
+            _close_deadlines.remove_all()
@@ -258,6 +258,11 @@ class EventDetector(EventDetectorBase):
             endpoint=self.endpoints.eventdet_bind
         )
 
+    def get_poll_fd(self):
+        """Implementation of the get_poll_fd method of the base class.
+        """
+        return self.event_socket
+
     def get_new_event(self):
         """Implementation of the abstract method get_new_event.
         """
@@ -0,0 +1,289 @@
+# Copyright (C) 2015  DESY, Manuela Kuhn, Notkestr. 85, D-22607 Hamburg
+#
+# HiDRA is a generic tool set for high performance data multiplexing with
+# different qualities of service and based on Python and ZeroMQ.
+#
+# This software is free: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Manuela Kuhn <manuela.kuhn@desy.de>
+#
+
+"""
+This module implements the tracing of the time a file spends in the different
+stages of the sender.
+
+For sampled files the timestamps are carried in the workload/metadata
+dictionary (key "trace") while the file passes through the sender. The
+durations between the stages are sent to the stat server which aggregates
+them into histograms.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import math
+import time
+
+__author__ = 'Manuela Kuhn <manuela.kuhn@desy.de>'
+
+
+TRACE_KEY = "trace"
+
+# in the order the file passes them
+STAGES = [
+    "detected",
+    "requests_resolved",
+    "queued",
+    "dispatched",
+    "metadata",
+    "first_chunk_sent",
+    "last_chunk_sent",
+    "confirmed",
+    "removed",
+]
+
+PERCENTILES = [50, 95, 99]
+
+
+class LatencySampler(object):
+    """Decides which files are traced.
+
+    Every n-th file is traced with n determined by the sample rate. This is
+    cheaper than drawing random numbers and spreads the samples evenly.
+    """
+
+    def __init__(self, sample_rate):
+        """
+        Args:
+            sample_rate: The fraction of files to trace (0 disables tracing,
+                1 traces every file).
+        """
+
+        if sample_rate and sample_rate > 0:
+            self.interval = max(1, int(round(1 / min(sample_rate, 1))))
+        else:
+            self.interval = None
+
+        self.counter = 0
+
+    def sample(self):
+        """Check if the next file should be traced.
+        """
+
+        if self.interval is None:
+            return False
+
+        self.counter += 1
+        if self.counter >= self.interval:
+            self.counter = 0
+            return True
+        return False
+
+    def start(self, workload):
+        """Start a trace for the workload if it is sampled.
+
+        Args:
+            workload: The event dictionary of the file.
+        """
+
+        if isinstance(workload, dict) and self.sample():
+            workload[TRACE_KEY] = {"detected": time.time()}
+
+
+def mark(metadata, stage):
+    """Add a timestamp for the stage if the file is traced.
+
+    Args:
+        metadata: The workload/metadata dictionary of the file.
+        stage: The stage the file reached.
+    """
+
+    try:
+        metadata[TRACE_KEY][stage] = time.time()
+    except (KeyError, TypeError):
+        pass
+
+
+def get_trace(metadata):
+    """The trace of a file or None if it is not traced.
+    """
+
+    try:
+        return metadata[TRACE_KEY]
+    except (KeyError, TypeError):
+        return None
+
+
+def without_trace(metadata):
+    """The metadata to send to the receivers.
+
+    The trace is only used on the sender side, thus a copy of the metadata
+    without it is returned if the file is traced.
+    """
+
+    try:
+        if TRACE_KEY not in metadata:
+            return metadata
+    except TypeError:
+        return metadata
+
+    stripped = metadata.copy()
+    del stripped[TRACE_KEY]
+    return stripped
+
+
+def get_latencies(trace, stages=None):
+    """Calculates how long the file spent to reach each stage.
+
+    The latency of a stage is the time since the last stage reached before
+    (stages which were skipped, e.g. no data was sent, are ignored).
+
+    Args:
+        trace: The dictionary with the timestamps of the stages.
+        stages (optional): Only determine the latencies of these stages.
+
+    Returns:
+        A dictionary with the latency in seconds for each stage.
+    """
+
+    latencies = {}
+    previous = None
+    for stage in STAGES:
+        if stage not in trace:
+            continue
+
+        if previous is not None and (stages is None or stage in stages):
+            latencies[stage] = max(0, trace[stage] - previous)
+
+        previous = trace[stage]
+
+    return latencies
+
+
+class LatencyHistogram(object):
+    """Histogram with logarithmically growing bins.
+
+    The memory usage only depends on the range of values and not on the
+    number of values added. Percentiles are determined with a relative error
+    smaller than the bin growth.
+    """
+
+    def __init__(self, min_value=1e-6, growth=1.1):
+        """
+        Args:
+            min_value (optional): All values smaller than this end up in the
+                first bin.
+            growth (optional): Factor between the upper bounds of successive
+                bins.
+        """
+
+        self.min_value = min_value
+        self.growth = growth
+        self._log_growth = math.log(growth)
+
+        self.bins = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _get_bin(self, value):
+        if value <= self.min_value:
+            return 0
+        return int(math.ceil(math.log(value / self.min_value)
+                             / self._log_growth))
+
+    def _get_upper_bound(self, index):
+        return self.min_value * self.growth ** index
+
+    def add(self, value):
+        """Add a new value.
+        """
+
+        index = self._get_bin(value)
+        self.bins[index] = self.bins.get(index, 0) + 1
+
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """Determine the value below which the given percent of values lie.
+        """
+
+        if not self.count:
+            return None
+
+        rank = percent / 100 * self.count
+        cumulated = 0
+        for index in sorted(self.bins):
+            cumulated += self.bins[index]
+            if cumulated >= rank:
+                # the bin bounds are an estimate, the extrema are exact
+                return min(max(self._get_upper_bound(index), self.min),
+                           self.max)
+
+        return self.max
+
+    def summary(self):
+        """The percentiles and key figures of the histogram.
+        """
+
+        result = {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "min": self.min,
+            "max": self.max,
+        }
+        for percent in PERCENTILES:
+            result["p{}".format(percent)] = self.percentile(percent)
+
+        return result
+
+
+class LatencyStats(object):
+    """Collects the latencies of all stages.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+
+    def add(self, latencies):
+        """Add the latencies of a file.
+
+        Args:
+            latencies: A dictionary with stages and their latency in seconds.
+        """
+
+        for stage, value in latencies.items():
+            try:
+                histogram = self.histograms[stage]
+            except KeyError:
+                histogram = LatencyHistogram()
+                self.histograms[stage] = histogram
+
+            histogram.add(value)
+
+    def summary(self):
+        """The percentiles for each stage.
+        """
+
+        return {stage: histogram.summary()
+                for stage, histogram in self.histograms.items()}
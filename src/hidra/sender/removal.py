@@ -0,0 +1,244 @@
+# Copyright (C) 2015  DESY, Manuela Kuhn, Notkestr. 85, D-22607 Hamburg
+#
+# HiDRA is a generic tool set for high performance data multiplexing with
+# different qualities of service and based on Python and ZeroMQ.
+#
+# This software is free: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Manuela Kuhn <manuela.kuhn@desy.de>
+#
+
+"""
+This module implements removing the files in the cleaner.
+
+Removing a file can be slow (e.g. an unlink on a parallel filesystem or a
+request to a detector API), thus it is done in worker threads so that the
+cleaner keeps up with the confirmations. Failed removals are retried with
+an exponential backoff. A removal still waiting when the file is announced
+again (e.g. it was re-created under the same name) is cancelled, so that the
+new file is not removed with the confirmations of the old one.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import queue
+import threading
+import time
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # python 2 without the futures backport
+    ThreadPoolExecutor = None
+
+from latency_tracing import LatencyHistogram
+
+__author__ = 'Manuela Kuhn <manuela.kuhn@desy.de>'
+
+
+class Remover(object):
+    """Removes files in the background.
+
+    The methods have to be called from the same thread, only the removal
+    itself is done by the worker threads.
+    """
+
+    def __init__(self,
+                 remove,
+                 log,
+                 threads=4,
+                 max_backlog=1000,
+                 retries=3,
+                 retry_delay=0.1):
+        """
+        Args:
+            remove: The function removing a file, called with base_path and
+                file_id. It has to raise an exception if removing failed.
+            log: The logger to use.
+            threads (optional): How many files to remove in parallel (0
+                removes in the calling thread).
+            max_backlog (optional): How many files may wait for being
+                removed before submitting blocks.
+            retries (optional): How often to retry a failed removal.
+            retry_delay (optional): How long to wait before the first retry
+                (in s), doubled for each further one.
+        """
+
+        self.remove = remove
+        self.log = log
+        self.max_backlog = max(max_backlog, 1)
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        self.executor = None
+        if threads > 0 and ThreadPoolExecutor is not None:
+            self.executor = ThreadPoolExecutor(max_workers=threads)
+
+        # the removals done by the worker threads
+        self.completed = queue.Queue()
+        # the removals taken from the queue but not handed out yet
+        self.done = []
+        # the number of files submitted but not handed out yet
+        self.backlog = 0
+        # the removals not started for good yet, shared with the workers
+        self.pending = {}
+        self.lock = threading.Lock()
+
+        self.n_removed = 0
+        self.n_failed = 0
+        self.n_retries = 0
+        self.n_cancelled = 0
+        self.latency = LatencyHistogram()
+
+    def _is_pending(self, file_id, token, done=False):
+        with self.lock:
+            if self.pending.get(file_id) is not token:
+                return False
+            if done:
+                del self.pending[file_id]
+            return True
+
+    def _remove(self, base_path, file_id, context, submitted, token):
+        attempt = 0
+        while True:
+            if not self._is_pending(file_id, token):
+                self.log.info("Removing file %s was cancelled.", file_id)
+                success = None
+                break
+
+            try:
+                self.remove(base_path, file_id)
+                success = True
+                break
+            except Exception:
+                if attempt >= self.retries:
+                    self.log.error("Removing file %s failed, giving up after "
+                                   "%s retries.", file_id, attempt,
+                                   exc_info=True)
+                    success = False
+                    break
+
+                delay = self.retry_delay * 2 ** attempt
+                self.log.warning("Removing file %s failed, retrying in %s s.",
+                                 file_id, delay, exc_info=True)
+                time.sleep(delay)
+                attempt += 1
+
+        self._is_pending(file_id, token, done=True)
+        self.completed.put(
+            (file_id, context, success, attempt, time.time() - submitted)
+        )
+
+    def _collect(self, block=False):
+        try:
+            self.done.append(self.completed.get(block=block))
+        except queue.Empty:
+            return False
+        return True
+
+    def submit(self, base_path, file_id, context=None):
+        """Remove a file.
+
+        Blocks while max_backlog files are waiting for being removed.
+
+        Args:
+            base_path: The base path of the file.
+            file_id: The file id (relative path) of the file.
+            context (optional): Handed out with the file when it is removed.
+        """
+
+        while self.backlog - len(self.done) >= self.max_backlog:
+            self._collect(block=True)
+
+        self.backlog += 1
+
+        token = object()
+        with self.lock:
+            self.pending[file_id] = token
+
+        if self.executor is None:
+            self._remove(base_path, file_id, context, time.time(), token)
+        else:
+            self.executor.submit(self._remove,
+                                 base_path, file_id, context, time.time(),
+                                 token)
+
+    def cancel(self, file_id):
+        """Do not remove a file which is waiting for being removed.
+
+        A removal which is already in progress is not interrupted but not
+        retried anymore.
+
+        Args:
+            file_id: The file id (relative path) of the file.
+
+        Returns:
+            True if a removal was cancelled, False otherwise.
+        """
+
+        with self.lock:
+            return self.pending.pop(file_id, None) is not None
+
+    def get_removed(self):
+        """Get the files whose removal finished since the last call.
+
+        Returns:
+            A list of entries of the form (file_id, context, success), with
+            success being None if the removal was cancelled.
+        """
+
+        while self._collect():
+            pass
+
+        removed = []
+        for file_id, context, success, retries, duration in self.done:
+            self.backlog -= 1
+            self.n_retries += retries
+            if success:
+                self.n_removed += 1
+            elif success is None:
+                self.n_cancelled += 1
+            else:
+                self.n_failed += 1
+            self.latency.add(duration)
+
+            removed.append((file_id, context, success))
+
+        self.done = []
+        return removed
+
+    def get_stats(self):
+        """The number of removed files and how long it took.
+        """
+
+        return {
+            "backlog": self.backlog,
+            "removed": self.n_removed,
+            "failed": self.n_failed,
+            "retries": self.n_retries,
+            "cancelled": self.n_cancelled,
+            "latency": self.latency.summary(),
+        }
+
+    def stop(self):
+        """Wait for the pending removals and stop the worker threads.
+        """
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
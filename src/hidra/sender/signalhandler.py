@@ -70,6 +70,12 @@ UnpackedMessage = namedtuple(
     ]
 )
 
+# optional signals the receivers can use to negotiate features with the
+# sender, announced together with the version
+NEGOTIATION_SIGNALS = [b"SET_METADATA_FORMAT",
+                       b"SET_COMPRESSION",
+                       b"SET_BATCHING"]
+
 
 TargetProperties = namedtuple(
     "TargetProperties", [
@@ -92,7 +98,8 @@ class SignalHandler(Base):
                  log_queue,
                  log_level,
                  stop_request,
-                 context=None):
+                 context=None,
+                 ready_queue=None):
 
         super().__init__()
 
@@ -102,6 +109,7 @@ class SignalHandler(Base):
         self.config = config
         self.endpoints = endpoints
         self.stop_request = stop_request
+        self.ready_queue = ready_queue
         self.stopped = None
 
         self.log = None
@@ -112,6 +120,19 @@ class SignalHandler(Base):
         # to rotate through the open permanent requests
         self.perm_requests = []
 
+        # to route files in the task provider directly
+        self.use_local_routing = None
+        self.routing_version = 0
+        # the routing table last published (without version)
+        self.published_routing = None
+
+        # the metadata format to use for targets supporting it
+        self.metadata_format = None
+        # the codec to compress the data with for targets supporting it
+        self.compression = None
+        # small files are sent in batches to targets supporting it
+        self.batch_files = None
+
         self.whitelist = None
         self.open_connections = []
 
@@ -161,6 +182,44 @@ class SignalHandler(Base):
             self.context = zmq.Context()
             self.ext_context = False
 
+        try:
+            self.use_local_routing = (
+                self.config["general"]["use_local_routing"]
+            )
+        except KeyError:
+            self.use_local_routing = False
+
+        try:
+            self.metadata_format = (
+                self.config["datafetcher"]["metadata_format"]
+            )
+        except KeyError:
+            self.metadata_format = utils.JSON
+
+        if self.metadata_format not in utils.get_metadata_formats():
+            self.log.error("Metadata format %s is not supported, falling "
+                           "back to %s", self.metadata_format, utils.JSON)
+            self.metadata_format = utils.JSON
+
+        try:
+            self.compression = self.config["datafetcher"]["compression"]
+        except KeyError:
+            self.compression = None
+
+        if (self.compression is not None
+                and self.compression not in utils.get_compression_codecs()):
+            self.log.error("Compression codec %s is not available, data is "
+                           "sent uncompressed", self.compression)
+            self.compression = None
+
+        try:
+            df_type = self.config["datafetcher"]["type"]
+            self.batch_files = (
+                self.config["datafetcher"][df_type]["batch_files"]
+            )
+        except KeyError:
+            self.batch_files = False
+
         if self.config["general"]["use_statserver"]:
             self.setup_stats_collection()
 
@@ -262,6 +321,7 @@ class SignalHandler(Base):
         """
 
         self.setup()
+        self.report_ready("SignalHandler")
 
         try:
             self.stopped = False
@@ -308,6 +368,12 @@ class SignalHandler(Base):
             (internal forwarding of requests which came from external)
             GET_REQUESTS: TaskProvider asks to get the next set of open
                           requests
+            GET_REQUESTS_BATCH: TaskProvider asks to get the open requests
+                                for a list of files at once
+            GET_ROUTING_TABLE: TaskProvider asks for the current routing
+                               table (if use_local_routing is enabled)
+            CONSUME_REQUESTS: TaskProvider used up leased open requests
+                              (if use_local_routing is enabled)
 
         control_sub_socket
             (internal control messages)
@@ -350,6 +416,8 @@ class SignalHandler(Base):
                 else:
                     self.send_response(unpacked_message.response)
 
+                self._publish_routing_table()
+
             # ----------------------------------------------------------------
             # request from external
             # ----------------------------------------------------------------
@@ -366,6 +434,8 @@ class SignalHandler(Base):
                 else:
                     self.log.info("Request not supported.")
 
+                self._publish_routing_table()
+
             # ----------------------------------------------------------------
             # control commands from internal
             # ----------------------------------------------------------------
@@ -381,44 +451,45 @@ class SignalHandler(Base):
         try:
             in_message = self.request_fw_socket.recv_multipart()
 
-            if in_message[0] != b"GET_REQUESTS":
+            if in_message[0] == b"GET_REQUESTS":
+                self.log.debug("New request for signals received.")
+                filename = json.loads(in_message[1].decode("utf-8"))
+
+                open_requests = self._get_open_requests(filename)
+
+                # open requests might have been used up
+                self._publish_routing_table()
+
+            elif in_message[0] == b"GET_REQUESTS_BATCH":
+                self.log.debug("New batched request for signals received.")
+                filenames = json.loads(in_message[1].decode("utf-8"))
+
+                # keep the order of the filenames so that the round-robin
+                # distribution is the same as when requesting one by one
+                open_requests = [self._get_open_requests(filename)
+                                 for filename in filenames]
+
+                # open requests might have been used up
+                self._publish_routing_table()
+
+            elif in_message[0] == b"GET_ROUTING_TABLE":
+                self.log.debug("New request for routing table received.")
+                open_requests = self._get_routing_table()
+
+            elif in_message[0] == b"CONSUME_REQUESTS":
+                self.log.debug("Leased requests were consumed.")
+                consumed = json.loads(in_message[1].decode("utf-8"))
+
+                self._consume_requests(consumed)
+                self._publish_routing_table()
+                open_requests = self._get_routing_table()
+
+            else:
                 self.log.debug("in_message=%s", in_message)
                 self.log.error("Failed to receive/answer new signal requests: "
                                "incoming message not supported")
                 return
 
-            self.log.debug("New request for signals received.")
-            filename = json.loads(in_message[1].decode("utf-8"))
-            open_requests = []
-
-            for i, trgt_prop in enumerate(self.registered_streams):
-                request_set = trgt_prop.targets
-
-                if request_set:
-                    # [<host:port>, <prio>, <suffix_regex>, <metadata|data>]
-                    socket_id, prio, pattern, send_type = (
-                        request_set[self.perm_requests[i]])
-
-                    # Check if filename matches requested regex
-                    if pattern.match(filename) is not None:
-                        # do not send pattern
-                        open_requests.append([socket_id, prio, send_type])
-
-                        # distribute in round-robin order
-                        self.perm_requests[i] = (
-                            (self.perm_requests[i] + 1) % len(request_set)
-                        )
-
-            for request_set in self.vari_requests:
-                # Check if filename suffix matches requested suffix
-                if (request_set
-                        and (request_set[0][2].match(filename) is not None)):
-                    socket_id, prio, pattern, send_type = request_set.pop(0)
-                    # do not send pattern
-                    open_requests.append([socket_id, prio, send_type])
-
-            if not open_requests:
-                open_requests = ["None"]
             self.request_fw_socket.send_string(json.dumps(open_requests))
 
             self.log.debug("Answered to request: %s", open_requests)
@@ -431,6 +502,164 @@ class SignalHandler(Base):
             self.log.error("Failed to receive/answer new signal requests",
                            exc_info=True)
 
+    def _get_open_requests(self, filename):
+        """Determine the targets a file should be sent to.
+
+        The permanent requests are distributed in round-robin order and
+        the matching variable requests are consumed.
+
+        Args:
+            filename: The name of the file to get the requests for.
+
+        Returns:
+            A list of [<host:port>, <prio>, <metadata|data>] entries or
+            ["None"] if there are no open requests for this file.
+        """
+
+        open_requests = []
+
+        for i, trgt_prop in enumerate(self.registered_streams):
+            request_set = trgt_prop.targets
+
+            if request_set:
+                # [<host:port>, <prio>, <suffix_regex>, <metadata|data>]
+                socket_id, prio, pattern, send_type = (
+                    request_set[self.perm_requests[i]])
+
+                # Check if filename matches requested regex
+                if pattern.match(filename) is not None:
+                    # do not send pattern
+                    open_requests.append([socket_id, prio, send_type])
+
+                    # distribute in round-robin order
+                    self.perm_requests[i] = (
+                        (self.perm_requests[i] + 1) % len(request_set)
+                    )
+
+        for request_set in self.vari_requests:
+            # Check if filename suffix matches requested suffix
+            if (request_set
+                    and (request_set[0][2].match(filename) is not None)):
+                socket_id, prio, pattern, send_type = request_set.pop(0)
+                # do not send pattern
+                open_requests.append([socket_id, prio, send_type])
+
+        if not open_requests:
+            open_requests = ["None"]
+
+        return open_requests
+
+    def _get_routing_table(self):
+        """Get a snapshot of all registered requests.
+
+        The task provider uses this snapshot to determine the targets of a
+        file without asking the signal handler. The open requests in query
+        mode are only leased to it and have to be confirmed as consumed
+        (see _consume_requests).
+
+        Returns:
+            A dictionary of the form:
+            {
+                "version": <version of the snapshot>,
+                "streams": [
+                    {
+                        "key": [<appid>, <time registered>],
+                        "targets": [[<host:port>, <prio>, <regex>,
+                                     <metadata|data>], ...],
+                        "next": <next node number to serve>
+                    }, ...
+                ],
+                "queries": [
+                    {
+                        "key": [<appid>, <time registered>],
+                        "requests": [[<host:port>, <prio>, <regex>,
+                                      <metadata|data>], ...]
+                    }, ...
+                ]
+            }
+        """
+
+        def _serialize(targets):
+            # compiled regex cannot be serialized
+            return [[socket_id, prio, pattern.pattern, send_type]
+                    for socket_id, prio, pattern, send_type in targets]
+
+        return {
+            "version": self.routing_version,
+            "streams": [
+                {
+                    "key": [trgt_prop.appid, trgt_prop.time_registered],
+                    "targets": _serialize(trgt_prop.targets),
+                    "next": self.perm_requests[i]
+                }
+                for i, trgt_prop in enumerate(self.registered_streams)
+            ],
+            "queries": [
+                {
+                    "key": [trgt_prop.appid, trgt_prop.time_registered],
+                    "requests": _serialize(self.vari_requests[i])
+                }
+                for i, trgt_prop in enumerate(self.registered_queries)
+            ]
+        }
+
+    def _publish_routing_table(self):
+        """Send the current routing table to the task provider.
+        """
+
+        if not self.use_local_routing:
+            return
+
+        table = self._get_routing_table()
+        del table["version"]
+
+        # the task providers only have to be updated on changes
+        if table == self.published_routing:
+            return
+
+        self.published_routing = table
+        self.routing_version += 1
+
+        try:
+            self.control_pub_socket.send_multipart(
+                [b"routing",
+                 json.dumps(self._get_routing_table()).encode("utf-8")]
+            )
+            self.log.debug("Published routing table (version %s)",
+                           self.routing_version)
+        except Exception:
+            self.log.error("Failed to publish routing table", exc_info=True)
+
+    def _consume_requests(self, consumed):
+        """Remove the open requests the task provider used up.
+
+        Args:
+            consumed: A list of [<key>, <request>] entries, where key
+                identifies the registered query and request is of the form
+                [<host:port>, <prio>, <regex>, <metadata|data>] (see
+                _get_routing_table).
+        """
+
+        keys = [[trgt_prop.appid, trgt_prop.time_registered]
+                for trgt_prop in self.registered_queries]
+
+        for key, request in consumed:
+            try:
+                request_set = self.vari_requests[keys.index(key)]
+            except ValueError:
+                # query was stopped in the meantime
+                continue
+
+            socket_id, prio, pattern, send_type = request
+            for i, socket_conf in enumerate(request_set):
+                # the request might have been cancelled in the meantime
+                if (socket_conf[0] == socket_id
+                        and socket_conf[1] == prio
+                        and socket_conf[2].pattern == pattern
+                        and socket_conf[3] == send_type):
+                    del request_set[i]
+                    break
+
     def _handle_request_external_next(self, in_message):
         socket_id = utils.convert_socket_to_fqdn(
             in_message[1].decode("utf-8"), self.log
@@ -758,6 +987,94 @@ class SignalHandler(Base):
         # send signal back to receiver
         self.send_response([signal])
 
+    def _publish_metadata_format(self, socket_ids):
+        """Tell the data fetchers which metadata format the targets support.
+
+        Targets not announced this way get JSON encoded metadata.
+
+        Args:
+            socket_ids: The socket ids with the metadata formats they
+                support, of the form
+                [[<host:port>, <prio>, <suffix>, [<format>, ...]], ...]
+        """
+
+        if self.metadata_format == utils.JSON:
+            return
+
+        formats = []
+        for socket_conf in socket_ids:
+            try:
+                remote_formats = socket_conf[3]
+            except IndexError:
+                remote_formats = []
+
+            metadata_format = utils.negotiate_metadata_format(
+                remote_formats, self.metadata_format
+            )
+            self.log.info("Using metadata format %s for %s", metadata_format,
+                          socket_conf[0])
+            formats.append([socket_conf[0], metadata_format])
+
+        self.control_pub_socket.send_multipart(
+            [b"signal",
+             b"METADATA_FORMAT",
+             json.dumps(formats).encode("utf-8")]
+        )
+
+    def _publish_compression(self, socket_ids):
+        """Tell the data fetchers which targets get compressed data.
+
+        Targets not announced this way get uncompressed data.
+
+        Args:
+            socket_ids: The socket ids with the codecs they support, of the
+                form [[<host:port>, <prio>, <suffix>, [<codec>, ...]], ...]
+        """
+
+        if self.compression is None:
+            return
+
+        codecs = []
+        for socket_conf in socket_ids:
+            try:
+                remote_codecs = socket_conf[3]
+            except IndexError:
+                remote_codecs = []
+
+            codec = utils.negotiate_compression(remote_codecs,
+                                                self.compression)
+            self.log.info("Using compression %s for %s", codec,
+                          socket_conf[0])
+            codecs.append([socket_conf[0], codec])
+
+        self.control_pub_socket.send_multipart(
+            [b"signal",
+             b"COMPRESSION",
+             json.dumps(codecs).encode("utf-8")]
+        )
+
+    def _publish_batching(self, socket_ids):
+        """Tell the data fetchers which targets can receive batches.
+
+        Targets not announced this way get each file in its own message.
+
+        Args:
+            socket_ids: The socket ids supporting batches, of the form
+                [[<host:port>, <prio>, <suffix>], ...]
+        """
+
+        if not self.batch_files:
+            return
+
+        targets = [socket_conf[0] for socket_conf in socket_ids]
+        self.log.info("Sending batches of files to %s", targets)
+
+        self.control_pub_socket.send_multipart(
+            [b"signal",
+             b"BATCHING",
+             json.dumps(targets).encode("utf-8")]
+        )
+
     def _stop_signal(self,
                      signal,
                      appid,
@@ -898,7 +1215,7 @@ class SignalHandler(Base):
         if signal == b"GET_VERSION":
             self.log.info("Received signal: %s", signal)
 
-            self.send_response([signal, version])
+            self.send_response([signal, version] + NEGOTIATION_SIGNALS)
             return
         else:
             self.log.info("Received signal: %s for hosts %s",
@@ -1059,6 +1376,36 @@ class SignalHandler(Base):
 
             return
 
+        # --------------------------------------------------------------------
+        # SET_METADATA_FORMAT
+        # --------------------------------------------------------------------
+        elif signal == b"SET_METADATA_FORMAT":
+
+            self._publish_metadata_format(socket_ids)
+            self.send_response([signal])
+
+            return
+
+        # --------------------------------------------------------------------
+        # SET_COMPRESSION
+        # --------------------------------------------------------------------
+        elif signal == b"SET_COMPRESSION":
+
+            self._publish_compression(socket_ids)
+            self.send_response([signal])
+
+            return
+
+        # --------------------------------------------------------------------
+        # SET_BATCHING
+        # --------------------------------------------------------------------
+        elif signal == b"SET_BATCHING":
+
+            self._publish_batching(socket_ids)
+            self.send_response([signal])
+
+            return
+
         else:
             self.send_response([b"NO_VALID_SIGNAL"])
 
@@ -37,6 +37,9 @@ import setproctitle
 import zmq
 
 from base_class import Base
+from chunk_sizing import ChunksizeStats
+from copy_engine import CopyStats
+from latency_tracing import LatencyStats
 import hidra.utils as utils
 
 
@@ -46,16 +49,28 @@ class StatServer(Base):
     outside.
     """
 
-    def __init__(self, config, log_queue, log_level, stop_request):
+    def __init__(self,
+                 config,
+                 log_queue,
+                 log_level,
+                 stop_request,
+                 ready_queue=None):
         super().__init__()
 
         self.config = config
         self.log_queue = log_queue
         self.log_level = log_level
         self.stop_request = stop_request
+        self.ready_queue = ready_queue
 
         self.log = None
         self.stats = {"config": config}
+        # the latencies of the traced files per stage
+        self.latency_stats = LatencyStats()
+        # the amount of data stored locally per copy method
+        self.copy_stats = CopyStats()
+        # how many files were sent with which chunk size
+        self.chunksize_stats = ChunksizeStats()
 
         self.ipc_dir_umask = 0o001
 
@@ -121,6 +136,7 @@ class StatServer(Base):
         """Collect stats from and exposes them.
         """
         self._setup()
+        self.report_ready("StatServer")
 
         try:
             self._run()
@@ -158,7 +174,7 @@ class StatServer(Base):
                 self.log.debug("key=%s", key)
 
                 try:
-                    answer = self.stats[key]
+                    answer = self._get(key)
                 except KeyError:
                     self.log.error("Key '%s' not found in stats", key)
                     answer = "ERROR"
@@ -179,7 +195,16 @@ class StatServer(Base):
     def _update(self, param, value):
         self.log.debug("Update: %s", param)
 
-        if isinstance(param, list):
+        if param == "latency":
+            self.latency_stats.add(value)
+
+        elif param == "copy":
+            self.copy_stats.add(*value)
+
+        elif param == "chunksize":
+            self.chunksize_stats.add(*value)
+
+        elif isinstance(param, list):
             conf = self.stats["config"]
             for i in param[:-1]:
                 conf = conf[i]
@@ -189,6 +214,15 @@ class StatServer(Base):
             self.stats[param] = value
 
     def _get(self, param):
+        if param == "latency":
+            return self.latency_stats.summary()
+
+        if param == "copy":
+            return self.copy_stats.summary()
+
+        if param == "chunksize":
+            return self.chunksize_stats.summary()
+
         return self.stats[param]
 
     def stop(self):
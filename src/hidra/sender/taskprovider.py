@@ -37,11 +37,15 @@ import errno
 from importlib import import_module
 import json
 import os
+import re
 import setproctitle
 import signal
+import time
 import zmq
 
 from base_class import Base
+from dispatch_scheduler import DispatchScheduler, SMALL_LANE
+import latency_tracing
 import hidra.utils as utils
 
 __author__ = 'Manuela Kuhn <manuela.kuhn@desy.de>'
@@ -58,15 +62,19 @@ class TaskProvider(Base):
                  endpoints,
                  log_queue,
                  log_level,
-                 stop_request):
+                 stop_request,
+                 ready_queue=None):
 
         super().__init__()
 
         self.config = config
+        # needed to initialize base_class
+        self.config_all = config
         self.endpoints = endpoints
         self.log_queue = log_queue
         self.log_level = log_level
         self.stop_request = stop_request
+        self.ready_queue = ready_queue
 
         self.log = None
         self.eventdetector = None
@@ -75,13 +83,28 @@ class TaskProvider(Base):
         self.request_fw_socket = None
         self.router_socket = None
         self.control_socket = None
+        self.routing_socket = None
+        self.load_socket = None
         self.poller = None
+        self.event_poller = None
+        self.eventdetector_fd = None
         self.timeout = None
 
         self.eventdetector = None
         self.stopped = None
         self.ignore_accumulated_events = None
 
+        self.use_local_routing = None
+        self.routing_table = None
+
+        self.use_credit_dispatch = None
+        self.scheduler = None
+        self.queue_depth = None
+        self.drained_dispatchers = set()
+        self.last_load_report = 0
+
+        self.latency_sampler = None
+
     def _setup(self):
         """Initializes parameters and creates sockets.
         """
@@ -100,10 +123,44 @@ class TaskProvider(Base):
             self.timeout = 1000
         self.log.debug("Set timeout to %s ms", self.timeout)
 
+        try:
+            self.use_local_routing = (
+                self.config["general"]["use_local_routing"]
+            )
+        except KeyError:
+            self.use_local_routing = False
+
+        try:
+            sample_rate = self.config["general"]["latency_sample_rate"]
+        except KeyError:
+            sample_rate = 0
+
+        if sample_rate:
+            self.latency_sampler = latency_tracing.LatencySampler(sample_rate)
+            self.log.info("Tracing latencies (sample rate %s)", sample_rate)
+
+        try:
+            config_df = self.config["datafetcher"]
+            self.use_credit_dispatch = config_df["use_credit_dispatch"]
+        except KeyError:
+            self.use_credit_dispatch = False
+
+        if self.use_credit_dispatch:
+            self.scheduler = DispatchScheduler(
+                large_file_threshold=config_df.get("large_file_threshold"),
+                max_large_file_dispatchers=config_df.get(
+                    "max_large_file_dispatchers", 1
+                )
+            )
+            self.log.info("Using credit based dispatching")
+
         # remember if the context was created outside this class or not
         self.log.info("Registering ZMQ context")
         self.context = zmq.Context()
 
+        if self.config["general"].get("use_statserver", False):
+            self.setup_stats_collection()
+
         try:
             self.ignore_accumulated_events = (
                 self.config["eventdetector"]["ignore_accumulated_events"]
@@ -131,10 +188,31 @@ class TaskProvider(Base):
 
         try:
             self.create_sockets()
+            self._setup_event_polling()
         except Exception:
             self.log.error("Cannot create sockets", exc_info=True)
             self.stop()
 
+    def _setup_event_polling(self):
+        """Poll the event detector together with the control socket.
+
+        Event detectors exposing a pollable file descriptor or socket are
+        only asked for new events when there are some, so that control
+        signals are reacted to without waiting for the event timeout.
+        """
+
+        self.eventdetector_fd = self.eventdetector.get_poll_fd()
+        if self.eventdetector_fd is None:
+            self.log.debug("Event detector is not pollable")
+            return
+
+        self.event_poller = zmq.Poller()
+        self.event_poller.register(self.control_socket, zmq.POLLIN)
+        self.event_poller.register(self.eventdetector_fd, zmq.POLLIN)
+        if self.use_credit_dispatch:
+            self.event_poller.register(self.router_socket, zmq.POLLIN)
+        self.log.info("Polling event detector")
+
     def create_sockets(self):
         """Create ZMQ sockets.
         """
@@ -158,6 +236,10 @@ class TaskProvider(Base):
                                 [zmq.RCVTIMEO, self.timeout]]
             sockopt_router += [[zmq.SNDTIMEO, self.timeout]]
 
+        if self.use_credit_dispatch:
+            # get notified if a data dispatcher is not available anymore
+            sockopt_router += [[zmq.ROUTER_MANDATORY, 1]]
+
         # socket to get forwarded requests
         self.request_fw_socket = self.start_socket(
             name="request_fw_socket",
@@ -168,9 +250,11 @@ class TaskProvider(Base):
         )
 
         # socket to distribute the events to the worker
+        # (with credit based dispatching the workers announce their free
+        # capacity and the jobs are routed explicitly)
         self.router_socket = self.start_socket(
             name="router_socket",
-            sock_type=zmq.PUSH,
+            sock_type=zmq.ROUTER if self.use_credit_dispatch else zmq.PUSH,
             sock_con="bind",
             endpoint=self.endpoints.router_bind,
             # this sometimes blocks indefinitely if there are problems
@@ -178,8 +262,32 @@ class TaskProvider(Base):
             socket_options=sockopt_router
         )
 
+        if self.use_local_routing:
+            # socket to get routing table updates from the signal handler
+            # (they are sent via the control channel)
+            self.routing_socket = self.start_socket(
+                name="routing_socket",
+                sock_type=zmq.SUB,
+                sock_con="connect",
+                endpoint=self.endpoints.control_sub_con
+            )
+
+            self.routing_socket.setsockopt_string(zmq.SUBSCRIBE, "routing")
+
+        if self.use_credit_dispatch:
+            # socket to report the load of the data dispatchers
+            # (used to scale the number of data dispatchers)
+            self.load_socket = self.start_socket(
+                name="load_socket",
+                sock_type=zmq.PUB,
+                sock_con="connect",
+                endpoint=self.endpoints.control_pub_con
+            )
+
         self.poller = zmq.Poller()
         self.poller.register(self.control_socket, zmq.POLLIN)
+        if self.use_credit_dispatch:
+            self.poller.register(self.router_socket, zmq.POLLIN)
 
     def run(self):
         """Wrapper around the _run method to detect if it has stopped.
@@ -191,6 +299,8 @@ class TaskProvider(Base):
             self.stop()
             raise
 
+        self.report_ready("TaskProvider")
+
         self.stopped = False
         try:
             self._run()
@@ -213,6 +323,26 @@ class TaskProvider(Base):
 
         while not self.stop_request.is_set():
 
+            # ----------------------------------------------------------------
+            # wait for events
+            # ----------------------------------------------------------------
+            if self.event_poller is not None:
+                socks = dict(self.event_poller.poll(self.timeout))
+
+                if (self.control_socket in socks
+                        and socks[self.control_socket] == zmq.POLLIN):
+                    if self.check_control_signal():
+                        break
+
+                if (self.eventdetector_fd not in socks
+                        and not self.eventdetector.has_pending_events()):
+                    # dispatch waiting jobs to freed data dispatchers and
+                    # keep reporting the load
+                    if self.use_credit_dispatch:
+                        self._dispatch_jobs()
+                        self._report_load()
+                    continue
+
             # ----------------------------------------------------------------
             # get events
             # ----------------------------------------------------------------
@@ -240,13 +370,33 @@ class TaskProvider(Base):
                                exc_info=True)
                 workload_list = []
 
+            for name, value in self.eventdetector.pop_stats():
+                self.update_stats(name, value)
+
+            if self.latency_sampler is not None:
+                for workload in workload_list:
+                    self.latency_sampler.start(workload)
+
+            # ----------------------------------------------------------------
+            # get requests for these events
+            # ----------------------------------------------------------------
+            requests_list = self._get_requests(workload_list)
+
+            if self.latency_sampler is not None:
+                for workload in workload_list:
+                    latency_tracing.mark(workload, "requests_resolved")
+
             # ----------------------------------------------------------------
             # process events
             # ----------------------------------------------------------------
-            for workload in workload_list:
+            for workload, requests in zip(workload_list, requests_list):
                 if self.stop_request.is_set():
                     break
-                self._process_workload(workload)
+                self._process_workload(workload, requests)
+
+            if self.use_credit_dispatch:
+                self._dispatch_jobs()
+                self._report_load()
 
             # ----------------------------------------------------------------
             # control commands
@@ -254,34 +404,234 @@ class TaskProvider(Base):
             if self._check_control_socket():
                 break
 
-    def _process_workload(self, workload):
-        # TODO validate workload dict
+    def _get_requests(self, workload_list):
+        """Get the open requests for all events at once.
 
-        # ------------------------------------------------------------
-        # get requests for this event
-        # ------------------------------------------------------------
-        requests = ["None"]  # default
-        try:
+        Args:
+            workload_list: The list of events gotten by the event detector.
+
+        Returns:
+            A list containing the requests for each workload (in the same
+            order). Events without any open requests get ["None"].
+        """
+
+        requests_list = [["None"] for _ in workload_list]  # default
+
+        # only events describing files can have requests
+        # (e.g. CLOSE_FILE can also be sent as workload)
+        indices = []
+        filenames = []
+        for i, workload in enumerate(workload_list):
+            try:
+                filenames.append(workload["filename"])
+                indices.append(i)
+            except (TypeError, KeyError):
+                pass
+
+        if not filenames:
+            return requests_list
+
+        batch = None
+        if self.use_local_routing:
+            batch = self._get_requests_local(filenames)
+
+        if batch is None:
             self.log.debug("Get requests...")
+            batch = self._send_request(b"GET_REQUESTS_BATCH", filenames)
+
+        if batch is None:
+            return requests_list
+
+        if len(batch) != len(filenames):
+            self.log.error("Get Requests... failed. Number of received "
+                           "requests (%s) does not match number of "
+                           "files (%s)", len(batch), len(filenames))
+            return requests_list
+
+        for i, requests in zip(indices, batch):
+            requests_list[i] = requests
+
+        return requests_list
+
+    def _send_request(self, signal, payload):
+        """Send a request to the signal handler and wait for the answer.
+
+        Args:
+            signal: The type of request (e.g. GET_REQUESTS_BATCH).
+            payload: The data to send along with the request (has to be json
+                serializable).
+
+        Returns:
+            The decoded answer or None if the request failed.
+        """
+
+        try:
             self.request_fw_socket.send_multipart(
-                [b"GET_REQUESTS",
-                 json.dumps(workload["filename"]).encode("utf-8")]
+                [signal, json.dumps(payload).encode("utf-8")]
             )
 
-            requests = json.loads(self.request_fw_socket.recv_string())
+            return json.loads(self.request_fw_socket.recv_string())
 
-        except TypeError:
-            # This happens when CLOSE_FILE is sent as workload
-            pass
         except zmq.error.Again:
             self.log.error("Error when getting requests due to timeout "
                            "of request_socket")
         except Exception:
             self.log.error("Get Requests... failed.", exc_info=True)
 
+        return None
+
+    def _get_requests_local(self, filenames):
+        """Determine the requests with the routing table of the task provider.
+
+        Args:
+            filenames: The filenames to get the requests for.
+
+        Returns:
+            A list containing the requests for each filename or None if no
+            routing table is available.
+        """
+
+        self._update_routing_table()
+
+        if self.routing_table is None:
+            return None
+
+        consumed = []
+        batch = [self._match_requests(filename, consumed)
+                 for filename in filenames]
+
+        # the leased requests have to be removed from the signal handler as
+        # well, otherwise they would be used again with the next update
+        if consumed:
+            self.log.debug("Consume requests: %s", consumed)
+            table = self._send_request(b"CONSUME_REQUESTS", consumed)
+            if table is not None:
+                self._set_routing_table(table)
+
+        return batch
+
+    def _match_requests(self, filename, consumed):
+        """Determine the requests for a file with the routing table.
+
+        This follows the same rules as the signal handler does, i.e. the
+        streams are distributed in round-robin order and the open requests
+        in query mode are used up.
+
+        Args:
+            filename: The filename to get the requests for.
+            consumed: A list the used up open requests are added to.
+
+        Returns:
+            A list of [<host:port>, <prio>, <metadata|data>] entries or
+            ["None"] if there are no open requests for this file.
+        """
+
+        open_requests = []
+
+        for stream in self.routing_table["streams"]:
+            request_set = stream["targets"]
+
+            if request_set:
+                socket_id, prio, pattern, send_type = (
+                    request_set[stream["next"]])
+
+                if pattern.match(filename) is not None:
+                    open_requests.append([socket_id, prio, send_type])
+
+                    # distribute in round-robin order
+                    stream["next"] = (stream["next"] + 1) % len(request_set)
+
+        for query in self.routing_table["queries"]:
+            request_set = query["requests"]
+
+            if request_set and request_set[0][2].match(filename) is not None:
+                socket_id, prio, pattern, send_type = request_set.pop(0)
+                open_requests.append([socket_id, prio, send_type])
+                # the whole request identifies it in the signal handler
+                consumed.append([query["key"],
+                                 [socket_id, prio, pattern.pattern,
+                                  send_type]])
+
+        if not open_requests:
+            open_requests = ["None"]
+
+        return open_requests
+
+    def _update_routing_table(self):
+        """Get the newest routing table published by the signal handler.
+        """
+
+        table = None
+        # only the newest one is of interest
+        while True:
+            try:
+                _, message = self.routing_socket.recv_multipart(zmq.NOBLOCK)
+                table = json.loads(message.decode("utf-8"))
+            except zmq.error.Again:
+                break
+            except Exception:
+                self.log.error("Invalid routing table received.",
+                               exc_info=True)
+
+        # updates are only published on changes
+        if table is None and self.routing_table is None:
+            self.log.debug("Get routing table...")
+            table = self._send_request(b"GET_ROUTING_TABLE", None)
+
+        if table is not None:
+            self._set_routing_table(table)
+
+    def _set_routing_table(self, table):
+        """Replace the routing table by a newer one.
+
+        The round-robin position of the streams which did not change is
+        kept because the signal handler does not know about the files
+        routed by the task provider.
+
+        Args:
+            table: The routing table as received from the signal handler.
+        """
+
+        if (self.routing_table is not None
+                and table["version"] <= self.routing_table["version"]):
+            self.log.debug("Ignore outdated routing table (version %s)",
+                           table["version"])
+            return
+
+        def _compile(targets):
+            return [[socket_id, prio, re.compile(pattern), send_type]
+                    for socket_id, prio, pattern, send_type in targets]
+
+        old_streams = {}
+        if self.routing_table is not None:
+            old_streams = {
+                tuple(stream["key"]): stream
+                for stream in self.routing_table["streams"]
+            }
+
+        for stream in table["streams"]:
+            stream["targets"] = _compile(stream["targets"])
+
+            old_stream = old_streams.get(tuple(stream["key"]))
+            if (old_stream is not None
+                    and len(old_stream["targets"]) == len(stream["targets"])):
+                stream["next"] = old_stream["next"]
+
+        for query in table["queries"]:
+            query["requests"] = _compile(query["requests"])
+
+        self.routing_table = table
+        self.log.debug("Routing table updated (version %s)", table["version"])
+
+    def _process_workload(self, workload, requests):
+        # TODO validate workload dict
+
         # ------------------------------------------------------------
         # build message dict
         # ------------------------------------------------------------
+        if self.latency_sampler is not None:
+            latency_tracing.mark(workload, "queued")
+
         try:
             self.log.debug("Building message dict...")
             # set correct escape characters
@@ -300,6 +650,10 @@ class TaskProvider(Base):
             if requests != ["None"]:
                 message.append(json.dumps(requests).encode("utf-8"))
 
+            if self.use_credit_dispatch:
+                self.scheduler.add_job(message, self._get_file_size(workload))
+                return
+
             while True:
                 try:
                     self.router_socket.send_multipart(message)
@@ -315,6 +669,195 @@ class TaskProvider(Base):
             self.log.error("Sending message...failed.", exc_info=True)
             raise
 
+    def _get_file_size(self, workload):
+        """Determine the size of the file described by the workload.
+
+        Returns:
+            The size in bytes or None if it could not be determined (e.g. if
+            the file is not located in a local filesystem).
+        """
+
+        try:
+            return os.path.getsize(os.path.join(workload["source_path"],
+                                                workload["relative_path"],
+                                                workload["filename"]))
+        except (OSError, TypeError, KeyError):
+            return None
+
+    def _dispatch_jobs(self):
+        """Send the queued jobs to the data dispatchers with free capacity.
+
+        Blocks till all small files are assigned, large files can be waiting
+        for free capacity while new events are processed.
+        """
+
+        while not self.stop_request.is_set():
+            self._receive_credits()
+
+            failed = set()
+            requeue = []
+            for identity, job_id, message, size in (
+                    self.scheduler.get_assignments()):
+
+                # the dispatcher is gone, do not try it again in this pass
+                if identity in failed:
+                    requeue.append((message, size))
+                    continue
+
+                self.log.debug("Sending message to %s", identity)
+                try:
+                    self.router_socket.send_multipart(
+                        [identity, str(job_id).encode("utf-8")] + message
+                    )
+                except zmq.error.ZMQError:
+                    self.log.error("Sending message to %s failed, requeue "
+                                   "job", identity, exc_info=True)
+                    failed.add(identity)
+                    self.scheduler.unregister(identity)
+                    requeue.append((message, size))
+
+            # keep the order of the files
+            for message, size in reversed(requeue):
+                self.scheduler.add_job(message, size, front=True)
+
+            self._update_queue_depth()
+
+            if not self.scheduler.has_jobs(lane=SMALL_LANE):
+                break
+
+            # wait till a data dispatcher gets free
+            socks = dict(self.poller.poll(self.timeout))
+            if (self.control_socket in socks
+                    and socks[self.control_socket] == zmq.POLLIN):
+
+                if self.check_control_signal():
+                    break
+
+            if self.router_socket not in socks:
+                self.log.warning("No data dispatcher with free capacity")
+
+    def _receive_credits(self):
+        """Get the capacity announcements of the data dispatchers.
+
+        The messages are of the form:
+        - [<identity>, b"READY", <json encoded capacity>] when a dispatcher
+          is started
+        - [<identity>, b"DONE", <job id>] when a dispatcher finished a job
+        """
+
+        while True:
+            try:
+                message = self.router_socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.error.Again:
+                break
+
+            identity, command = message[:2]
+            if command == b"DONE":
+                self.scheduler.release(identity, int(message[2]))
+            elif (command == b"READY"
+                  and self._get_dispatcher_id(identity)
+                  in self.drained_dispatchers):
+                # the drain signal arrived before the dispatcher was ready
+                self._stop_dispatcher(identity)
+            elif command == b"READY":
+                capacity = json.loads(message[2].decode("utf-8"))
+                self.log.info("Data dispatcher %s ready (capacity: %s)",
+                              identity, capacity)
+                # the data handlers of a dispatcher share its capacity
+                self.scheduler.register(
+                    identity,
+                    capacity_bytes=capacity["bytes"],
+                    capacity_jobs=capacity["jobs"],
+                    dispatcher=self._get_dispatcher_id(identity)
+                )
+            else:
+                self.log.error("Unknown message from data dispatcher %s: %s",
+                               identity, message[1:])
+
+    def _report_load(self):
+        """Publish the load of the data dispatchers once per second.
+        """
+
+        now = time.time()
+        if now - self.last_load_report < 1:
+            return
+        self.last_load_report = now
+
+        load = self.scheduler.get_load()
+        try:
+            self.load_socket.send_multipart(
+                [b"load", json.dumps(load).encode("utf-8")]
+            )
+        except Exception:
+            self.log.error("Could not report load", exc_info=True)
+
+    @staticmethod
+    def _get_dispatcher_id(identity):
+        """Determine the data dispatcher a data handler belongs to.
+
+        The data handlers are identified by <dispatcher_id> or
+        <dispatcher_id>-<handler_number>.
+        """
+        return identity.decode("utf-8").split("-")[0]
+
+    def _stop_dispatcher(self, identity):
+        """Tell a data handler to stop after its queued jobs are done.
+
+        Messages to one data handler are delivered in order, so all jobs
+        already assigned to it are handled before it stops.
+        """
+
+        self.log.info("Stopping data handler %s", identity)
+        self.scheduler.unregister(identity)
+        try:
+            self.router_socket.send_multipart([identity, b"STOP"])
+        except zmq.error.ZMQError:
+            self.log.error("Could not stop data handler %s", identity,
+                           exc_info=True)
+
+    def _react_to_drain_signal(self, message):
+        """Overwrite the base class reaction method to drain signal.
+
+        No new jobs are assigned to the data dispatcher and its data handlers
+        are stopped.
+
+        Args:
+            message: The control signal of the form
+                [b"DRAIN", <dispatcher_id>]
+        """
+
+        if not self.use_credit_dispatch:
+            self.log.error("Draining a data dispatcher is only supported "
+                           "with credit based dispatching")
+            return
+
+        dispatcher_id = message[1].decode("utf-8")
+        self.log.info("Draining data dispatcher %s", dispatcher_id)
+        self.drained_dispatchers.add(dispatcher_id)
+
+        for identity in list(self.scheduler.dispatcher_order):
+            if self._get_dispatcher_id(identity) == dispatcher_id:
+                self._stop_dispatcher(identity)
+
+    def _update_queue_depth(self):
+        """Send the number of waiting jobs per lane to the stats server.
+        """
+
+        queue_depth = self.scheduler.queue_depth()
+        if queue_depth != self.queue_depth:
+            self.queue_depth = queue_depth
+            self.update_stats("queue_depth", queue_depth)
+
+    def stats_config(self):
+        """Extend the stats_config function of the Base class
+        """
+        conf = super().stats_config()
+        conf["queue_depth"] = "taskprovider_queue_depth"
+        conf["cleanup"] = "eventdetector_cleanup"
+        conf["watches"] = "eventdetector_watches"
+
+        return conf
+
     def _check_control_socket(self):
         """Check if any control signal where received over the control socket
 
@@ -347,6 +890,11 @@ class TaskProvider(Base):
 
         # cleanup accumulated events
         if self.ignore_accumulated_events:
+            # a pollable event detector would block if there are none
+            if (self.eventdetector_fd is not None
+                    and not zmq.select([self.eventdetector_fd], [], [], 0)[0]):
+                return
+
             try:
                 acc_events = self.eventdetector.get_new_event()
                 self.log.debug("Ignore accumulated workload: %s", acc_events)
@@ -361,12 +909,16 @@ class TaskProvider(Base):
         self.stop_request.set()
         self.wait_for_stopped()
 
+        super().stop()
+
         if self.eventdetector is not None:
             self.eventdetector.stop()
             self.eventdetector = None
 
         self.stop_socket(name="router_socket")
         self.stop_socket(name="request_fw_socket")
+        self.stop_socket(name="routing_socket")
+        self.stop_socket(name="load_socket")
         self.stop_socket(name="control_socket")
 
         if self.context is not None:
@@ -0,0 +1,78 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import collections
+import os
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.dirname(os.path.realpath(__file__)))))
+sys.path.insert(0, os.path.join(BASE_DIR, "src", "hidra", "sender",
+                                "eventdetectors"))
+
+from event_history import EventHistory  # noqa E402
+
+
+def get_events(n_events, n_dirs):
+    # every event is seen twice, e.g. IN_CLOSE_WRITE and the cleanup
+    events = [("/ramdisk/current/raw/{}".format(i % n_dirs),
+               "file_{:06d}.cbf".format(i))
+              for i in range(n_events)]
+    return events + events
+
+
+def use_deque(events, history_size):
+    history = collections.deque(maxlen=history_size)
+    n_new = 0
+    for event in events:
+        if list(event) not in history:
+            history.append(list(event))
+            n_new += 1
+    return n_new
+
+
+def use_event_history(events, history_size):
+    history = EventHistory(history_size)
+    n_new = 0
+    for event in events:
+        if event not in history:
+            history.add(event)
+            n_new += 1
+    return n_new
+
+
+def main():
+
+    n_events = 100000
+    events = get_events(n_events, n_dirs=10)
+
+    for history_size in [1000, 10000, n_events]:
+        print("history_size", history_size)
+
+        t = time.time()
+        use_event_history(events, history_size)
+        print("    event_history, time needed", time.time() - t)
+
+        # takes more than 10 minutes for the largest history
+        if history_size > 10000:
+            continue
+
+        t = time.time()
+        use_deque(events, history_size)
+        print("    deque, time needed", time.time() - t)
+
+
+if __name__ == "__main__":
+    main()
+
+# output python3 (100000 events, each seen twice)
+# history_size 1000
+#     event_history, time needed 0.23515605926513672
+#     deque, time needed 7.393801212310791
+# history_size 10000
+#     event_history, time needed 0.2916066646575928
+#     deque, time needed 72.08512449264526
+# history_size 100000
+#     event_history, time needed 0.19142913818359375
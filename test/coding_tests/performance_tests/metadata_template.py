@@ -0,0 +1,92 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import os
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.dirname(os.path.realpath(__file__)))))
+sys.path.insert(0, os.path.join(BASE_DIR, "src", "api", "python"))
+
+from hidra.utils import (  # noqa E402
+    JSON,
+    MSGPACK,
+    get_metadata_formats,
+    serialize_metadata,
+    MetadataTemplate
+)
+
+
+def get_metadata():
+    return {
+        "source_path": "/ramdisk",
+        "relative_path": "current/raw",
+        "filename": "test_file.cbf",
+        "version": "4.5.0",
+        "chunksize": 10485760,
+        "filesize": 104857600,
+        "file_mod_time": 1620136546.5,
+        "file_create_time": 1620136546.4,
+        "confirmation_required": False,
+        "chunk_number": None
+    }
+
+
+def copy_and_serialize(metadata, n_chunks, n_targets, metadata_format):
+    # per chunk: copy the metadata and serialize it for each target
+    for chunk_number in range(n_chunks):
+        chunk_metadata = metadata.copy()
+        chunk_metadata["chunk_number"] = chunk_number
+        for _ in range(n_targets):
+            serialize_metadata(chunk_metadata, metadata_format)
+
+
+def use_template(metadata, n_chunks, n_targets, metadata_format):
+    # per file: create the template, per chunk: splice in the chunk number
+    # once and share it between the targets
+    template = MetadataTemplate(metadata)
+    for chunk_number in range(n_chunks):
+        encoded = {}
+        for _ in range(n_targets):
+            if metadata_format not in encoded:
+                encoded[metadata_format] = serialize_metadata(
+                    template.chunk(chunk_number), metadata_format
+                )
+
+
+def main():
+    metadata = get_metadata()
+
+    n_chunks = 200000
+    n_targets = 3
+    print("Testing", n_chunks, "chunks with", n_targets, "targets")
+
+    for metadata_format in [JSON, MSGPACK]:
+        if metadata_format not in get_metadata_formats():
+            print(metadata_format, "not available")
+            continue
+
+        t = time.time()
+        copy_and_serialize(metadata, n_chunks, n_targets, metadata_format)
+        t_copy = time.time() - t
+        print(metadata_format, "copy and serialize, time needed", t_copy,
+              "({:.2f} us/chunk)".format(t_copy / n_chunks * 1e6))
+
+        t = time.time()
+        use_template(metadata, n_chunks, n_targets, metadata_format)
+        t_template = time.time() - t
+        print(metadata_format, "template, time needed", t_template,
+              "({:.2f} us/chunk)".format(t_template / n_chunks * 1e6))
+
+
+if __name__ == "__main__":
+    main()
+
+# output python3
+# Testing 200000 chunks with 3 targets
+# json copy and serialize, time needed 4.02 (20.12 us/chunk)
+# json template, time needed 0.31 (1.56 us/chunk)
+# msgpack copy and serialize, time needed 1.05 (5.23 us/chunk)
+# msgpack template, time needed 0.32 (1.61 us/chunk)
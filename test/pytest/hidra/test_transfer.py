@@ -5,6 +5,7 @@ import zmq
 import pytest
 
 from hidra.transfer import Transfer, generate_filepath, UsageError
+from hidra.utils import serialize_metadata
 
 logging.getLogger("Transfer").setLevel(logging.DEBUG)
 
@@ -390,3 +391,26 @@ def test_store_chunk_confirmation_error(
     assert descriptors  # Is this intended?
     pytest.skip()  # Probably the following should be true
     assert Path(filepath).is_file()
+
+
+def test_react_on_message_batch(transfer, metadata):
+    received = []
+    transfer.read_callback = lambda params, chunk: received.append(chunk)
+
+    second = dict(metadata, filename="test_filepath2.tif")
+    transfer._react_on_message([
+        serialize_metadata(metadata), b"data1",
+        serialize_metadata(second), b"data2"
+    ])
+
+    # each file of the batch is handed to the callback
+    assert received == [[metadata, b"data1"], [second, b"data2"]]
+
+
+def test_react_on_message_empty_file(transfer, metadata):
+    received = []
+    transfer.read_callback = lambda params, chunk: received.append(chunk)
+
+    transfer._react_on_message([serialize_metadata(metadata)])
+
+    assert received == [[metadata, None]]
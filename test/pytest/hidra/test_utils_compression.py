@@ -0,0 +1,42 @@
+import os
+
+import pytest
+
+from hidra.utils import (
+    ZLIB,
+    LZ4,
+    ZSTD,
+    NotSupported,
+    get_compression_codecs,
+    negotiate_compression,
+    compress,
+    decompress
+)
+
+
+@pytest.mark.parametrize("codec", [ZLIB, LZ4, ZSTD])
+def test_roundtrip(codec):
+    if codec not in get_compression_codecs():
+        pytest.skip("{} not available".format(codec))
+
+    data = b"0123456789" * 1000 + os.urandom(100)
+    compressed = compress(memoryview(data), codec)
+
+    assert len(compressed) < len(data)
+    assert decompress(compressed, codec) == data
+
+
+def test_unknown_codec():
+    with pytest.raises(NotSupported):
+        compress(b"data", "foo")
+
+    with pytest.raises(NotSupported):
+        decompress(b"data", "foo")
+
+
+def test_negotiate_compression():
+    assert ZLIB in get_compression_codecs()
+
+    assert negotiate_compression([LZ4, ZLIB], ZLIB) == ZLIB
+    assert negotiate_compression([LZ4], ZLIB) is None
+    assert negotiate_compression([ZLIB], None) is None
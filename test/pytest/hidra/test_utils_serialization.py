@@ -0,0 +1,69 @@
+import pytest
+
+from hidra.utils import (
+    JSON,
+    MSGPACK,
+    negotiate_metadata_format,
+    serialize_metadata,
+    deserialize_metadata,
+    MetadataTemplate
+)
+
+
+@pytest.fixture
+def metadata():
+    return {
+        "chunk_number": 3,
+        "relative_path": "current/raw",
+        "version": "4.5.0",
+        "filename": "test_file.cbf",
+        "file_mod_time": 1620136546.5,
+        "confirmation_required": False
+    }
+
+
+def test_json_roundtrip(metadata):
+    message = serialize_metadata(metadata)
+
+    assert message.startswith(b"{")
+    assert deserialize_metadata(message) == metadata
+
+
+def test_msgpack_roundtrip(metadata):
+    pytest.importorskip("msgpack")
+
+    message = serialize_metadata(metadata, MSGPACK)
+
+    assert not message.startswith(b"{")
+    assert deserialize_metadata(message) == metadata
+
+
+def test_negotiate_metadata_format():
+    pytest.importorskip("msgpack")
+
+    assert negotiate_metadata_format([JSON, MSGPACK]) == MSGPACK
+    assert negotiate_metadata_format([JSON]) == JSON
+    # older remote sides do not announce their formats
+    assert negotiate_metadata_format(None) == JSON
+    assert negotiate_metadata_format([JSON, MSGPACK], JSON) == JSON
+
+
+@pytest.mark.parametrize("metadata_format", [JSON, MSGPACK])
+@pytest.mark.parametrize("chunk_number", [0, 7, 128, 70000, 2**33])
+def test_metadata_template(metadata, metadata_format, chunk_number):
+    if metadata_format == MSGPACK:
+        pytest.importorskip("msgpack")
+
+    template = MetadataTemplate(metadata)
+    chunk_metadata = template.chunk(chunk_number)
+
+    message = serialize_metadata(chunk_metadata, metadata_format)
+
+    expected = dict(metadata, chunk_number=chunk_number)
+    assert chunk_metadata.to_dict() == expected
+    assert deserialize_metadata(message) == expected
+    # the prefix is reused for further chunks
+    assert template.serialize(chunk_number, metadata_format) == message
+    assert deserialize_metadata(
+        template.serialize(chunk_number + 1, metadata_format)
+    ) == dict(metadata, chunk_number=chunk_number + 1)
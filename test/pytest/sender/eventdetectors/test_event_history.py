@@ -0,0 +1,43 @@
+import hidra  # noqa
+from eventdetectors.event_history import EventHistory
+
+
+def test_add():
+    history = EventHistory(10)
+
+    assert history.add(("path", "file1"))
+    assert not history.add(("path", "file1"))
+    assert ("path", "file1") in history
+    assert ("path", "file2") not in history
+    assert len(history) == 1
+
+
+def test_eviction():
+    history = EventHistory(2)
+
+    history.add("a")
+    history.add("b")
+    # adding again moves it to the end
+    history.add("a")
+    history.add("c")
+
+    assert list(history) == ["a", "c"]
+    assert "b" not in history
+
+
+def test_size_zero():
+    history = EventHistory(0)
+
+    assert history.add("a")
+    assert history.add("a")
+    assert len(history) == 0
+
+
+def test_unbounded():
+    history = EventHistory(None)
+
+    for i in range(1000):
+        history.add(i)
+
+    assert len(history) == 1000
+    assert 0 in history
@@ -2,6 +2,7 @@ import logging
 from pathlib import Path
 from unittest.mock import create_autospec, patch
 import pytest
+import requests
 import hidra  # noqa
 from eventdetectors.http_events import (
     EventDetectorImpl, create_eventdetector_impl, HTTPConnection,
@@ -166,6 +167,47 @@ def test_filter_seen_history_size(file_filter):
     assert ret == ["current/raw/filename0.ext", filename]
 
 
+def test_filter_history_lru():
+    file_filter = FileFilterDeque(["current/raw"], 2)
+    files = ["current/raw/filename{}.ext".format(i) for i in range(3)]
+
+    assert file_filter.get_new_files(files[:2]) == files[:2]
+    # listing a file again keeps it in the history
+    assert file_filter.get_new_files(files[:1]) == []
+    assert file_filter.get_new_files(files[2:]) == files[2:]
+    assert list(file_filter.files_seen) == [files[0], files[2]]
+
+    # the least recently listed file is forgotten first
+    assert file_filter.get_new_files(files[1:2]) == [files[1]]
+    assert list(file_filter.files_seen) == [files[2], files[1]]
+
+
+def test_filter_no_history():
+    file_filter = FileFilterDeque(["current/raw"], 0)
+    files = ["current/raw/filename.ext"]
+
+    assert file_filter.get_new_files(files) == files
+    assert file_filter.get_new_files(files) == files
+
+
+def test_connection_conditional_request():
+    session = create_autospec(requests.Session, instance=True)
+    response = session.get.return_value
+    response.status_code = 200
+    response.headers = {"ETag": "1"}
+    response.json.return_value = ["filename"]
+
+    connection = HTTPConnection(session)
+    assert connection.get_file_list("url") == ["filename"]
+    assert connection.modified
+    session.get.assert_called_with("url", headers={})
+
+    response.status_code = 304
+    assert connection.get_file_list("url") == ["filename"]
+    assert not connection.modified
+    session.get.assert_called_with("url", headers={"If-None-Match": "1"})
+
+
 def test_filter_set(file_filter_set):
     files = ["current/raw/filename.ext"]
     ret = file_filter_set.get_new_files(files)
@@ -231,14 +273,38 @@ def test_filter_not_in_subdir_set(file_filter_set):
 def test_new_event_empty(eventdetector, mock_sleep):
     new_events = eventdetector.get_new_event()
     assert new_events == []
-    mock_sleep.assert_called_with(0.5)
+    mock_sleep.assert_called_with(0.05)
 
 
 def test_new_event_exception(eventdetector, connection, mock_sleep):
     connection.get_file_list.side_effect = ConnectionError
     new_events = eventdetector.get_new_event()
     assert new_events == []
-    mock_sleep.assert_called_with(0.5)
+    mock_sleep.assert_called_with(0.05)
+
+
+def test_new_event_back_off(eventdetector, connection, mock_sleep):
+    for _ in range(8):
+        eventdetector.get_new_event()
+    sleep_times = [args[0] for args, _ in mock_sleep.call_args_list]
+    assert sleep_times == [0.05, 0.1, 0.2, 0.4, 0.8, 1.6, 2.0, 2.0]
+
+    # new files reset the interval
+    mock_sleep.reset_mock()
+    connection.get_file_list.return_value = ["current/raw/filename.ext"]
+    assert eventdetector.get_new_event()
+    mock_sleep.assert_not_called()
+
+    assert eventdetector.get_new_event() == []
+    mock_sleep.assert_called_with(0.05)
+
+
+def test_new_event_not_modified(eventdetector, connection, mock_sleep):
+    connection.get_file_list.return_value = ["current/raw/filename.ext"]
+    connection.modified = False
+    new_events = eventdetector.get_new_event()
+    assert new_events == []
+    mock_sleep.assert_called_with(0.05)
 
 
 def test_new_event_files(eventdetector, connection, mock_sleep):
@@ -269,19 +335,19 @@ def test_new_event_seen_and_reused_filename(
     connection.get_file_list.return_value = [filename]
     new_events = eventdetector.get_new_event()
     assert new_events == []
-    mock_sleep.assert_called_with(0.5)
+    mock_sleep.assert_called_with(0.05)
 
     mock_sleep.reset_mock()
     connection.get_file_list.return_value = [filename]
     new_events = eventdetector.get_new_event()
     assert new_events == []
-    mock_sleep.assert_called_with(0.5)
+    mock_sleep.assert_called_with(0.1)
 
     mock_sleep.reset_mock()
     connection.get_file_list.return_value = []
     new_events = eventdetector.get_new_event()
     assert new_events == []
-    mock_sleep.assert_called_with(0.5)
+    mock_sleep.assert_called_with(0.2)
 
     mock_sleep.reset_mock()
     connection.get_file_list.return_value = [filename]
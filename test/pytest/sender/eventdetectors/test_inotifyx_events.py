@@ -1,5 +1,6 @@
 import os
 from pathlib import Path
+import time
 import pytest
 import hidra  # noqa
 from eventdetectors.inotifyx_events import EventDetector
@@ -148,3 +149,57 @@ def test_timeout(create_eventdetector):
     events = eventdetector.get_new_event()
 
     assert events == []
+
+
+def test_rescanned_files(create_eventdetector, tmp_path):
+    tmp_path = Path(str(tmp_path))  # workaround pytest issue
+    eventdetector = create_eventdetector()
+
+    dirpath = str(tmp_path / fix_subdir)
+    old_file = tmp_path / fix_subdir / "old_file.txt"
+    old_file.write_text("foo")
+    old = time.time() - 10
+    os.utime(str(old_file), (old, old))
+    open_file = tmp_path / fix_subdir / "open_file.txt"
+    open_file.write_text("foo")
+
+    # as found by a rescan after an overflow
+    eventdetector.rescanned.update([(dirpath, old_file.name),
+                                    (dirpath, open_file.name)])
+    # fetched by the task provider without new inotify events
+    assert eventdetector.has_pending_events()
+
+    # recently modified files could still be open
+    events = eventdetector._get_rescanned_events()
+    assert [event["filename"] for event in events] == [old_file.name]
+    assert eventdetector.rescanned == {(dirpath, open_file.name)}
+
+    os.utime(str(open_file), (old, old))
+
+    events = eventdetector._get_rescanned_events()
+    assert [event["filename"] for event in events] == [open_file.name]
+    assert eventdetector.rescanned == set()
+    assert not eventdetector.has_pending_events()
+
+
+def test_rescan(create_eventdetector, tmp_path):
+    tmp_path = Path(str(tmp_path))  # workaround pytest issue
+    # nothing is remembered thus an overflow must not report all files
+    eventdetector = create_eventdetector()
+
+    dirpath = str(tmp_path / fix_subdir)
+    reported_file = tmp_path / fix_subdir / "reported_file.txt"
+    reported_file.write_text("foo")
+    old = time.time() - 10
+    os.utime(str(reported_file), (old, old))
+    missed_file = tmp_path / fix_subdir / "missed_file.txt"
+    missed_file.write_text("foo")
+
+    # events were read last after the first file was closed
+    eventdetector.time_read = old + 5
+
+    events = eventdetector._rescan("IN_Q_OVERFLOW")
+
+    # the second file could still be open
+    assert events == []
+    assert eventdetector.rescanned == {(dirpath, missed_file.name)}
@@ -0,0 +1,146 @@
+import errno
+import logging
+import pytest
+import hidra  # noqa
+from eventdetectors.watch_manager import WatchManager
+
+log = logging.getLogger(__name__)
+
+
+class FakeInotify(object):
+    def __init__(self, limit=None):
+        self.watches = {}
+        self.next_wd = 1
+        self.limit = limit
+
+    def add_watch(self, path):
+        for watch_descriptor, watched in self.watches.items():
+            if watched == path:
+                return watch_descriptor
+
+        if self.limit is not None and len(self.watches) >= self.limit:
+            raise OSError(errno.ENOSPC, "No space left on device")
+
+        watch_descriptor = self.next_wd
+        self.next_wd += 1
+        self.watches[watch_descriptor] = path
+        return watch_descriptor
+
+    def rm_watch(self, watch_descriptor):
+        del self.watches[watch_descriptor]
+
+
+@pytest.fixture
+def tree(tmp_path):
+    for subdir in ["a/b/c", "a/d", "e"]:
+        (tmp_path / subdir).mkdir(parents=True)
+    (tmp_path / "a" / "b" / "file1.cbf").touch()
+    (tmp_path / "e" / "file2.cbf").touch()
+    return tmp_path
+
+
+def test_watch_tree(tree):
+    inotify = FakeInotify()
+    watches = WatchManager(inotify.add_watch, inotify.rm_watch, log)
+
+    files = []
+    assert watches.watch_tree(str(tree), files) == 6
+    assert len(watches) == 6
+    assert sorted(inotify.watches.values()) == sorted(
+        watches.path_to_wd.keys()
+    )
+    assert sorted(files) == [
+        (str(tree / "a" / "b"), "file1.cbf"),
+        (str(tree / "e"), "file2.cbf")
+    ]
+
+    # watching again does not add watches
+    watches.watch_tree(str(tree))
+    assert len(inotify.watches) == 6
+
+
+def test_unwatch_tree(tree):
+    inotify = FakeInotify()
+    watches = WatchManager(inotify.add_watch, inotify.rm_watch, log)
+    watches.watch_tree(str(tree))
+
+    assert watches.unwatch_tree(str(tree / "a")) == 4
+    assert sorted(inotify.watches.values()) == [str(tree), str(tree / "e")]
+    assert len(watches) == 2
+    assert watches.children == {
+        str(tree.parent): {str(tree)},
+        str(tree): {str(tree / "e")}
+    }
+
+
+def test_forget(tree):
+    inotify = FakeInotify()
+    watches = WatchManager(inotify.add_watch, inotify.rm_watch, log)
+    watches.watch_tree(str(tree / "e"))
+
+    watch_descriptor = watches.path_to_wd[str(tree / "e")]
+    watches.forget(watch_descriptor)
+
+    assert len(watches) == 0
+    assert watches.get_path(watch_descriptor) is None
+    assert watches.children == {}
+
+
+def test_watch_limit(tree):
+    inotify = FakeInotify(limit=2)
+    watches = WatchManager(inotify.add_watch, inotify.rm_watch, log)
+
+    assert watches.watch_tree(str(tree)) == 2
+    assert watches.get_stats()["failed"] > 0
+
+
+def test_rescan_recent_dirs(tree):
+    inotify = FakeInotify()
+    watches = WatchManager(inotify.add_watch, inotify.rm_watch, log)
+    watches.watch_tree(str(tree))
+
+    watches.mark_active(str(tree / "a" / "b" / "c"))
+    watches.mark_active(str(tree / "a"))
+    watches.mark_active(str(tree / "a" / "d"))
+
+    # subtrees are only rescanned once
+    assert watches.get_rescan_dirs([str(tree)]) == [str(tree / "a")]
+
+    # new directories are watched
+    new_dir = tree / "a" / "new"
+    new_dir.mkdir()
+    (new_dir / "file3.cbf").touch()
+
+    files = []
+    assert watches.rescan([str(tree)], files) == 5
+    assert (str(new_dir), "file3.cbf") in files
+    assert (str(tree / "e"), "file2.cbf") not in files
+    assert str(new_dir) in watches.path_to_wd
+
+    stats = watches.get_stats()
+    assert stats["overflows"] == 1
+    assert stats["rescanned_dirs"] == 5
+    assert stats["watches"] == 7
+
+
+def test_rescan_without_recent_dirs(tree):
+    inotify = FakeInotify()
+    watches = WatchManager(inotify.add_watch, inotify.rm_watch, log)
+
+    assert watches.get_rescan_dirs([str(tree)]) == [str(tree)]
+
+
+def test_pop_stats(tree):
+    inotify = FakeInotify()
+    watches = WatchManager(inotify.add_watch, inotify.rm_watch, log)
+
+    assert watches.pop_stats() is None
+
+    watches.watch_tree(str(tree))
+    assert watches.pop_stats()["watches"] == 6
+    assert watches.pop_stats() is None
+
+    watches.unwatch_all()
+    assert inotify.watches == {}
+    assert watches.pop_stats()["watches"] == 0
+
@@ -0,0 +1,160 @@
+import os
+import select
+import threading
+import time
+import pytest
+import hidra  # noqa
+import eventdetectors.watchdog_events as watchdog_events
+from eventdetectors.watchdog_events import (
+    CheckModTime, CloseDeadlines, EventStore)
+
+
+@pytest.fixture
+def checker(tmp_path):
+    watchdog_events._event_store.remove_all()
+    watchdog_events._close_deadlines.remove_all()
+
+    checker = CheckModTime(
+        time_till_closed=0.5,
+        mon_dir=str(tmp_path),
+        action_time=1,
+        lock=threading.Lock(),
+        stop_request=threading.Event(),
+        log_queue=False
+    )
+    yield checker
+
+    watchdog_events._event_store.remove_all()
+    watchdog_events._close_deadlines.remove_all()
+
+
+def test_deadline_order():
+    deadlines = CloseDeadlines()
+    now = time.time()
+
+    assert deadlines.add("b", now - 1)
+    assert deadlines.add("a", now - 2)
+    assert deadlines.add("c", now + 10)
+    # scheduled already
+    assert not deadlines.add("a", now - 3)
+
+    assert deadlines.get_due(0) == ["a", "b"]
+    assert len(deadlines) == 3
+
+
+def test_due_files_stay_scheduled():
+    deadlines = CloseDeadlines()
+
+    deadlines.add("a", time.time())
+    assert deadlines.get_due(0) == ["a"]
+    # a new event while the file is checked is ignored
+    assert not deadlines.add("a", time.time())
+
+    deadlines.discard("a")
+    assert deadlines.add("a", time.time())
+
+
+def test_get_due_waits_for_deadline():
+    deadlines = CloseDeadlines()
+    deadlines.add("a", time.time() + 0.1)
+
+    t_start = time.time()
+    assert deadlines.get_due(5) == ["a"]
+    assert 0.05 < time.time() - t_start < 1
+
+
+def test_get_due_woken_by_earlier_deadline():
+    deadlines = CloseDeadlines()
+    deadlines.add("late", time.time() + 10)
+
+    timer = threading.Timer(0.1, deadlines.add, ("early", time.time()))
+    timer.start()
+
+    t_start = time.time()
+    due = deadlines.get_due(5)
+    if not due:
+        # woken up before the deadline was reached
+        due = deadlines.get_due(5)
+    timer.join()
+
+    assert due == ["early"]
+    assert time.time() - t_start < 1
+
+
+def test_check_closed_file(checker, tmp_path):
+    filepath = tmp_path / "closed.cbf"
+    filepath.write_bytes(b"x")
+    old = time.time() - 1
+    os.utime(str(filepath), (old, old))
+
+    watchdog_events._close_deadlines.add(str(filepath), time.time())
+    for path in watchdog_events._close_deadlines.get_due(0):
+        checker.check_last_modified(path)
+
+    events = watchdog_events._event_store.get_all()
+    assert [event["filename"] for event in events] == ["closed.cbf"]
+    assert len(watchdog_events._close_deadlines) == 0
+
+
+def test_check_modified_file_is_rescheduled(checker, tmp_path):
+    filepath = tmp_path / "open.cbf"
+    filepath.write_bytes(b"x")
+    mtime = os.stat(str(filepath)).st_mtime
+
+    watchdog_events._close_deadlines.add(str(filepath), time.time())
+    for path in watchdog_events._close_deadlines.get_due(0):
+        checker.check_last_modified(path)
+
+    assert watchdog_events._event_store.get_all() == []
+    assert watchdog_events._close_deadlines.heap == [
+        (mtime + 0.5, str(filepath))
+    ]
+
+
+def test_check_empty_file_waits_longer(checker, tmp_path):
+    filepath = tmp_path / "empty.cbf"
+    filepath.touch()
+    mtime = os.stat(str(filepath)).st_mtime
+
+    watchdog_events._close_deadlines.add(str(filepath), time.time())
+    for path in watchdog_events._close_deadlines.get_due(0):
+        checker.check_last_modified(path)
+
+    assert watchdog_events._close_deadlines.heap == [
+        (mtime + 5, str(filepath))
+    ]
+
+
+def test_check_removed_file(checker, tmp_path):
+    filepath = str(tmp_path / "removed.cbf")
+
+    watchdog_events._close_deadlines.add(filepath, time.time())
+    for path in watchdog_events._close_deadlines.get_due(0):
+        checker.check_last_modified(path)
+
+    assert watchdog_events._event_store.get_all() == []
+    assert len(watchdog_events._close_deadlines) == 0
+
+
+def _readable(fd):
+    return bool(select.select([fd], [], [], 0)[0])
+
+
+def test_event_store_fd():
+    store = EventStore()
+    store.add("event1")
+
+    # events stored before are signaled as well
+    fd = store.get_fd()
+    assert _readable(fd)
+
+    store.add("event2")
+    assert store.get_all() == ["event1", "event2"]
+    assert not _readable(fd)
+
+    store.add("event3")
+    store.remove_all()
+    assert not _readable(fd)
+
+    store.close_fd()
+    assert store.pipe is None
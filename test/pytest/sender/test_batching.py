@@ -0,0 +1,63 @@
+import hidra  # noqa
+from batching import BatchCollector
+
+TARGETS_A = [["host_a:50100", 1, "data"]]
+TARGETS_B = [["host_b:50100", 1, "data"]]
+
+
+def test_batch_complete_by_count():
+    collector = BatchCollector(max_files=3, max_bytes=1000, max_delay=1)
+
+    assert collector.add(TARGETS_A, "a1", 10, now=0) == []
+    assert collector.add(TARGETS_B, "b1", 10, now=0) == []
+    assert collector.add(TARGETS_A, "a2", 10, now=0) == []
+
+    batches = collector.add(TARGETS_A, "a3", 10, now=0)
+    assert len(batches) == 1
+    assert batches[0].entries == ["a1", "a2", "a3"]
+    assert batches[0].targets == TARGETS_A
+
+    # the other targets are batched separately
+    assert list(collector.batches) == [BatchCollector.get_key(TARGETS_B)]
+
+
+def test_batch_complete_by_size():
+    collector = BatchCollector(max_files=10, max_bytes=100, max_delay=1)
+
+    assert collector.add(TARGETS_A, "a1", 60, now=0) == []
+
+    # would exceed the limit -> the old batch is sent first
+    batches = collector.add(TARGETS_A, "a2", 60, now=0)
+    assert [batch.entries for batch in batches] == [["a1"]]
+
+    batches = collector.add(TARGETS_A, "a3", 40, now=0)
+    assert [batch.entries for batch in batches] == [["a2", "a3"]]
+    assert collector.batches == {}
+
+
+def test_batch_expires():
+    collector = BatchCollector(max_files=10, max_bytes=1000, max_delay=1)
+
+    assert collector.get_timeout(now=0) is None
+
+    collector.add(TARGETS_A, "a1", 10, now=0)
+    collector.add(TARGETS_B, "b1", 10, now=0.5)
+
+    assert collector.get_timeout(now=0.2) == 0.8
+    assert collector.pop_expired(now=0.9) == []
+
+    batches = collector.pop_expired(now=1)
+    assert [batch.entries for batch in batches] == [["a1"]]
+
+    batches = collector.pop_all()
+    assert [batch.entries for batch in batches] == [["b1"]]
+    assert collector.get_timeout() is None
+
+
+def test_fits():
+    collector = BatchCollector(max_bytes=100)
+
+    assert collector.fits(100)
+    assert not collector.fits(101)
+    # empty files are not sent at all
+    assert not collector.fits(0)
@@ -0,0 +1,62 @@
+import hidra  # noqa
+from buffer_pool import BufferPool
+
+
+class Tracker(object):
+    def __init__(self, done=False):
+        self.done = done
+
+
+def test_reuse_after_tracker_done():
+    pool = BufferPool(max_buffers=2)
+
+    buf = pool.get(10)
+    tracker = Tracker()
+    pool.put(buf, [tracker])
+
+    # still referenced by ZMQ
+    assert pool.get(10) is not buf
+
+    tracker.done = True
+    assert pool.get(10) is buf
+    assert pool.n_allocated == 2
+    assert pool.n_reused == 1
+
+
+def test_reuse_without_trackers():
+    pool = BufferPool(max_buffers=2)
+
+    buf = pool.get(10)
+    pool.put(buf, [None])
+
+    assert pool.get(10) is buf
+
+
+def test_smaller_buffers_are_dropped():
+    pool = BufferPool(max_buffers=2)
+
+    buf = pool.get(10)
+    pool.put(buf)
+
+    new_buf = pool.get(20)
+    assert new_buf is not buf
+    assert len(new_buf) == 20
+
+
+def test_max_buffers():
+    pool = BufferPool(max_buffers=2)
+
+    trackers = [Tracker() for _ in range(3)]
+    buffers = [pool.get(10) for _ in range(3)]
+    for buf, tracker in zip(buffers, trackers):
+        pool.put(buf, [tracker])
+
+    assert len(pool.in_use) == 2
+
+    for tracker in trackers:
+        tracker.done = True
+
+    # the oldest buffer is not tracked anymore
+    reused = [pool.get(10), pool.get(10)]
+    assert all(buf is not buffers[0] for buf in reused)
+    assert pool.n_reused == 2
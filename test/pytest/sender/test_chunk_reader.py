@@ -0,0 +1,80 @@
+import io
+import os
+
+import pytest
+
+import hidra  # noqa
+from buffer_pool import BufferPool
+from chunk_reader import ChunkReader
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "source.cbf"
+    path.write_bytes(os.urandom(10000 * 7 + 13))
+    return path
+
+
+def read_all(reader, pool=None):
+    chunks = []
+    while True:
+        buf, chunk = reader.read()
+        if not chunk:
+            break
+        chunks.append(bytes(chunk))
+        if pool is not None:
+            pool.put(buf)
+    reader.close()
+    return chunks
+
+
+@pytest.mark.parametrize("read_ahead", [0, 1, 3])
+@pytest.mark.parametrize("use_pool", [False, True])
+def test_read(source, read_ahead, use_pool):
+    pool = BufferPool() if use_pool else None
+
+    with open(str(source), "rb") as file_descriptor:
+        reader = ChunkReader(file_descriptor, 10000,
+                             buffer_pool=pool,
+                             read_ahead=read_ahead)
+        assert (reader.thread is not None) == (read_ahead > 0)
+
+        chunks = read_all(reader, pool)
+
+    assert len(chunks) == 8
+    assert b"".join(chunks) == source.read_bytes()
+
+
+def test_no_read_ahead_for_small_files(source):
+    with open(str(source), "rb") as file_descriptor:
+        reader = ChunkReader(file_descriptor, 100000, read_ahead=2,
+                             filesize=os.path.getsize(str(source)))
+        assert reader.thread is None
+
+        assert b"".join(read_all(reader)) == source.read_bytes()
+
+
+def test_close_before_end(source):
+    pool = BufferPool()
+
+    with open(str(source), "rb") as file_descriptor:
+        reader = ChunkReader(file_descriptor, 1000, buffer_pool=pool,
+                             read_ahead=2)
+        reader.read()
+        reader.close()
+
+        assert reader.thread is None
+        assert reader.queue.empty()
+
+
+class BrokenFile(io.BytesIO):
+    def read(self, size=-1):
+        raise IOError("broken")
+
+
+def test_read_error():
+    reader = ChunkReader(BrokenFile(), 1000, read_ahead=2)
+
+    with pytest.raises(IOError):
+        reader.read()
+    reader.close()
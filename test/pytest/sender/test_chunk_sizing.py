@@ -0,0 +1,71 @@
+import hidra  # noqa
+from chunk_sizing import ChunkSizer, ChunksizeStats
+
+TARGET_FAST = ["fast:50100", 1, "data"]
+TARGET_SLOW = ["slow:50100", 1, "data"]
+
+KIB = 1024
+MIB = 1024 * KIB
+
+
+def test_default_without_estimate():
+    sizer = ChunkSizer(chunksize=10 * MIB, min_chunksize=64 * KIB,
+                       max_chunksize=64 * MIB)
+
+    assert sizer.get_chunksize(100 * MIB, [TARGET_FAST]) == 10 * MIB
+
+
+def test_small_files():
+    sizer = ChunkSizer(chunksize=10 * MIB, min_chunksize=64 * KIB,
+                       max_chunksize=64 * MIB)
+
+    assert sizer.get_chunksize(300 * KIB, [TARGET_FAST]) == 512 * KIB
+    assert sizer.get_chunksize(512 * KIB, [TARGET_FAST]) == 512 * KIB
+    assert sizer.get_chunksize(10, [TARGET_FAST]) == 64 * KIB
+    assert sizer.get_chunksize(0, [TARGET_FAST]) == 64 * KIB
+
+
+def test_throughput():
+    sizer = ChunkSizer(chunksize=10 * MIB, min_chunksize=64 * KIB,
+                       max_chunksize=64 * MIB, chunk_duration=0.1)
+
+    # 100 MiB/s -> 10 MiB per 0.1 s, rounded up
+    sizer.record([TARGET_FAST], 100 * MIB, 1)
+    assert sizer.get_chunksize(1000 * MIB, [TARGET_FAST]) == 16 * MIB
+
+    # the slowest target decides
+    sizer.record([TARGET_SLOW], 10 * MIB, 1)
+    assert (sizer.get_chunksize(1000 * MIB, [TARGET_FAST, TARGET_SLOW])
+            == 1 * MIB)
+
+    # the estimate is smoothed
+    sizer.record([TARGET_FAST], 200 * MIB, 1)
+    assert sizer.get_throughput([TARGET_FAST]) == 120 * MIB
+
+    # limits
+    sizer.record([TARGET_FAST], 100000 * MIB, 1)
+    assert sizer.get_chunksize(1000 * MIB, [TARGET_FAST]) == 64 * MIB
+    target_slowest = ["slowest:50100", 1, "data"]
+    sizer.record([target_slowest], 1 * MIB, 10)
+    assert sizer.get_chunksize(1000 * MIB, [target_slowest]) == 64 * KIB
+
+
+def test_small_files_not_measured():
+    sizer = ChunkSizer(chunksize=10 * MIB, min_chunksize=64 * KIB)
+
+    sizer.record([TARGET_FAST], 1 * KIB, 1)
+    sizer.record([TARGET_FAST], 1 * MIB, 0)
+
+    assert sizer.get_throughput([TARGET_FAST]) is None
+
+
+def test_stats():
+    stats = ChunksizeStats()
+    stats.add(1024, 1000)
+    stats.add(1024, 24)
+    stats.add(2048, 2000)
+
+    assert stats.summary() == {
+        "1024": {"files": 2, "bytes": 1024},
+        "2048": {"files": 1, "bytes": 2000},
+    }
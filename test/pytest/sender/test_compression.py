@@ -0,0 +1,62 @@
+import pytest
+
+import hidra  # noqa
+import hidra.utils as utils
+from compression import ChunkCompressor, CompressionPolicy
+
+
+def test_skip_suffixes():
+    policy = CompressionPolicy()
+
+    assert not policy.should_compress("/data/image_00001.cbf")
+    assert not policy.should_compress("/data/IMAGE_00001.CBF")
+    assert policy.should_compress("/data/image_00001.tif")
+
+
+def test_skip_incompressible():
+    policy = CompressionPolicy(skip_suffixes=[], min_ratio=0.9,
+                               probe_interval=2)
+
+    assert policy.should_compress("a.h5")
+    policy.record("a.h5", 100, 95)
+
+    # skipped until it is probed again
+    assert not policy.should_compress("b.h5")
+    assert not policy.should_compress("c.h5")
+    assert policy.should_compress("d.h5")
+    # other file types are not affected
+    assert policy.should_compress("a.tif")
+
+    policy.record("d.h5", 100, 50)
+    assert policy.should_compress("e.h5")
+
+
+def test_pays_off():
+    policy = CompressionPolicy(min_ratio=0.9)
+
+    assert policy.pays_off(100, 90)
+    assert not policy.pays_off(100, 91)
+
+
+@pytest.mark.parametrize("threads", [0, 2])
+def test_compressor(threads):
+    compressor = ChunkCompressor(utils.ZLIB, threads=threads)
+
+    chunks = [bytes(bytearray([i])) * 1000 for i in range(5)]
+    futures = [compressor.submit(chunk) for chunk in chunks]
+
+    for chunk, future in zip(chunks, futures):
+        assert utils.decompress(future.result(), utils.ZLIB) == chunk
+
+    compressor.stop()
+
+
+@pytest.mark.parametrize("threads", [0, 1])
+def test_compressor_error(threads):
+    compressor = ChunkCompressor("foo", threads=threads)
+
+    future = compressor.submit(b"data")
+    with pytest.raises(utils.NotSupported):
+        future.result()
+
+    compressor.stop()
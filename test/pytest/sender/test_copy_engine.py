@@ -0,0 +1,102 @@
+import os
+import stat
+
+import pytest
+
+import hidra  # noqa
+import copy_engine
+from copy_engine import (CopyEngine,
+                         CopyStats,
+                         MethodNotSupported,
+                         COPY_FILE_RANGE,
+                         RENAME,
+                         USERSPACE)
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "source.cbf"
+    path.write_bytes(os.urandom(100000))
+    os.chmod(str(path), 0o640)
+    return path
+
+
+def test_copy(source, tmp_path):
+    engine = CopyEngine()
+    target = tmp_path / "target.cbf"
+
+    method = engine.copy(str(source), str(target))
+
+    assert target.read_bytes() == source.read_bytes()
+    assert stat.S_IMODE(os.stat(str(target)).st_mode) == 0o640
+
+    records = engine.pop_records()
+    assert [(m, size) for m, size, _ in records] == [(method, 100000)]
+    assert engine.pop_records() == []
+
+
+def test_copy_userspace(source, tmp_path):
+    engine = CopyEngine(methods=[])
+    target = tmp_path / "target.cbf"
+
+    assert engine.copy(str(source), str(target)) == USERSPACE
+    assert target.read_bytes() == source.read_bytes()
+
+
+def test_copy_unsupported_method(source, tmp_path, monkeypatch):
+    calls = []
+
+    def unsupported(source_fd, target_fd, size):
+        calls.append(size)
+        # a partly written target has to be discarded
+        os.write(target_fd, b"garbage")
+        raise MethodNotSupported()
+
+    monkeypatch.setitem(copy_engine._COPY_FUNCTIONS, COPY_FILE_RANGE,
+                        unsupported)
+
+    engine = CopyEngine(methods=[COPY_FILE_RANGE])
+    for i in range(2):
+        target = tmp_path / "target{}.cbf".format(i)
+        assert engine.copy(str(source), str(target)) == USERSPACE
+        assert target.read_bytes() == source.read_bytes()
+
+    # not tried again for the same filesystems
+    assert calls == [100000]
+
+
+def test_copy_missing_directory(source, tmp_path):
+    engine = CopyEngine()
+
+    with pytest.raises(IOError):
+        engine.copy(str(source), str(tmp_path / "missing" / "target.cbf"))
+
+
+def test_unknown_method():
+    with pytest.raises(ValueError):
+        CopyEngine(methods=["unknown"])
+
+
+def test_move(source, tmp_path):
+    engine = CopyEngine()
+    target = tmp_path / "target.cbf"
+    content = source.read_bytes()
+
+    assert engine.move(str(source), str(target)) == RENAME
+    assert not source.exists()
+    assert target.read_bytes() == content
+
+
+def test_copy_stats():
+    stats = CopyStats()
+    stats.add("sendfile", 100, 0.5)
+    stats.add("sendfile", 300, 0.5)
+    stats.add(RENAME, 0, 0)
+
+    summary = stats.summary()
+
+    assert summary["sendfile"] == {"files": 2,
+                                   "bytes": 400,
+                                   "seconds": 1.0,
+                                   "throughput": 400}
+    assert summary[RENAME]["throughput"] is None
@@ -0,0 +1,173 @@
+import hidra  # noqa
+from dispatch_scheduler import DispatchScheduler, SMALL_LANE, LARGE_LANE
+
+
+def test_no_dispatcher_no_assignment():
+    scheduler = DispatchScheduler()
+    scheduler.add_job("job", 10)
+
+    assert scheduler.get_assignments() == []
+    assert scheduler.queue_depth() == {SMALL_LANE: 1, LARGE_LANE: 0}
+
+
+def test_assignments_respect_capacity():
+    scheduler = DispatchScheduler()
+    scheduler.register(b"d1", capacity_bytes=100, capacity_jobs=2)
+
+    for i in range(3):
+        scheduler.add_job("job{}".format(i), 40)
+
+    assert scheduler.get_assignments() == [
+        (b"d1", 0, "job0", 40), (b"d1", 1, "job1", 40)
+    ]
+    assert scheduler.has_jobs()
+
+    scheduler.release(b"d1", 0)
+    assert scheduler.get_assignments() == [(b"d1", 2, "job2", 40)]
+    assert not scheduler.has_jobs()
+
+
+def test_release_finished_job():
+    scheduler = DispatchScheduler()
+    scheduler.register(b"d1", capacity_bytes=100, capacity_jobs=2)
+
+    scheduler.add_job("job0", 90)
+    scheduler.add_job("job1", 10)
+    scheduler.get_assignments()
+
+    # the small job finishes first, the large one is still in flight
+    scheduler.release(b"d1", 1)
+    credit = scheduler.dispatchers[b"d1"]
+    assert credit.bytes_in_flight == 90
+    assert list(credit.in_flight) == [0]
+
+    # unknown or released already
+    scheduler.release(b"d1", 1)
+    assert credit.bytes_in_flight == 90
+
+
+def test_add_job_front():
+    scheduler = DispatchScheduler()
+
+    scheduler.add_job("job1", 10)
+    scheduler.add_job("job0", 10, front=True)
+    scheduler.register(b"d1", capacity_bytes=100, capacity_jobs=2)
+
+    assert [a[2] for a in scheduler.get_assignments()] == ["job0", "job1"]
+
+
+def test_least_loaded_dispatcher_is_selected():
+    scheduler = DispatchScheduler()
+    scheduler.register(b"d1", capacity_bytes=100, capacity_jobs=5)
+    scheduler.register(b"d2", capacity_bytes=100, capacity_jobs=5)
+
+    scheduler.add_job("job0", 50)
+    scheduler.add_job("job1", 10)
+    scheduler.add_job("job2", 10)
+
+    assignments = scheduler.get_assignments()
+    assert [(a[0], a[2]) for a in assignments] == [
+        (b"d1", "job0"), (b"d2", "job1"), (b"d2", "job2")
+    ]
+
+
+def test_oversized_job_is_sent_to_idle_dispatcher():
+    scheduler = DispatchScheduler()
+    scheduler.register(b"d1", capacity_bytes=10, capacity_jobs=2)
+
+    scheduler.add_job("job0", 100)
+    scheduler.add_job("job1", 1)
+
+    assert scheduler.get_assignments() == [(b"d1", 0, "job0", 100)]
+
+
+def test_small_files_bypass_large_files():
+    scheduler = DispatchScheduler(large_file_threshold=50,
+                                  max_large_file_dispatchers=1)
+    scheduler.register(b"d1", capacity_bytes=1000, capacity_jobs=1)
+    scheduler.register(b"d2", capacity_bytes=1000, capacity_jobs=1)
+
+    scheduler.add_job("large0", 500)
+    scheduler.add_job("large1", 500)
+    scheduler.add_job("small0", 5)
+
+    assignments = scheduler.get_assignments()
+    assert [(a[0], a[2]) for a in assignments] == [
+        (b"d1", "small0"), (b"d2", "large0")
+    ]
+    # the large file limit is reached
+    scheduler.release(b"d1", assignments[0][1])
+    assert scheduler.get_assignments() == []
+
+    scheduler.release(b"d2", assignments[1][1])
+    assert scheduler.get_assignments() == [(b"d1", 2, "large1", 500)]
+
+
+def test_unregister():
+    scheduler = DispatchScheduler()
+    scheduler.register(b"d1", capacity_bytes=100, capacity_jobs=1)
+    scheduler.unregister(b"d1")
+    scheduler.unregister(b"unknown")
+    scheduler.release(b"unknown", 0)
+
+    scheduler.add_job("job", None)
+    assert scheduler.get_assignments() == []
+
+
+def test_get_load():
+    scheduler = DispatchScheduler()
+    scheduler.register(b"d1", capacity_bytes=100, capacity_jobs=1)
+    scheduler.register(b"d2", capacity_bytes=100, capacity_jobs=1)
+
+    for i in range(3):
+        scheduler.add_job("job{}".format(i), 10)
+    scheduler.get_assignments()
+
+    assert scheduler.get_load() == {
+        "queue_depth": 1, "dispatchers": 2, "busy": 2
+    }
+
+
+def test_handlers_share_capacity():
+    scheduler = DispatchScheduler()
+    # each data handler announces the capacity of the whole dispatcher
+    for identity in [b"d1-0", b"d1-1", b"d1-2"]:
+        scheduler.register(identity, capacity_bytes=100, capacity_jobs=2,
+                           dispatcher="d1")
+
+    for i in range(4):
+        scheduler.add_job("job{}".format(i), 10)
+
+    # the jobs are spread over the handlers but the capacity counts once
+    assert scheduler.get_assignments() == [
+        (b"d1-0", 0, "job0", 10),
+        (b"d1-1", 1, "job1", 10)
+    ]
+    assert scheduler.get_load() == {
+        "queue_depth": 2, "dispatchers": 1, "busy": 1
+    }
+
+    scheduler.release(b"d1-1", 1)
+    assert scheduler.get_assignments() == [(b"d1-1", 2, "job2", 10)]
+
+
+def test_unregister_handler():
+    scheduler = DispatchScheduler()
+    scheduler.register(b"d1-0", capacity_bytes=100, capacity_jobs=2,
+                       dispatcher="d1")
+    scheduler.register(b"d1-1", capacity_bytes=100, capacity_jobs=2,
+                       dispatcher="d1")
+
+    scheduler.add_job("job0", 10)
+    scheduler.add_job("job1", 10)
+    scheduler.get_assignments()
+
+    # the credit of the jobs of the handler is returned
+    scheduler.unregister(b"d1-0")
+    assert scheduler.dispatchers["d1"].bytes_in_flight == 10
+
+    scheduler.add_job("job2", 10)
+    assert scheduler.get_assignments() == [(b"d1-1", 2, "job2", 10)]
+
+    scheduler.unregister(b"d1-1")
+    assert scheduler.dispatchers == {}
@@ -0,0 +1,66 @@
+import hidra  # noqa
+from dispatcher_scaler import DispatcherScaler, SCALE_UP, SCALE_DOWN, KEEP
+
+
+def get_load(queue_depth, dispatchers, busy):
+    return {"queue_depth": queue_depth,
+            "dispatchers": dispatchers,
+            "busy": busy}
+
+
+def test_scale_up_on_sustained_backlog():
+    scaler = DispatcherScaler(min_dispatchers=1, max_dispatchers=3,
+                              scale_up_delay=2, cooldown=5)
+
+    assert scaler.update(get_load(5, 1, 1), 1, now=0) == KEEP
+    assert scaler.update(get_load(5, 1, 1), 1, now=1) == KEEP
+    assert scaler.update(get_load(5, 1, 1), 1, now=2) == SCALE_UP
+
+    # cooldown
+    assert scaler.update(get_load(5, 2, 2), 2, now=3) == KEEP
+    assert scaler.update(get_load(5, 2, 2), 2, now=7) == SCALE_UP
+
+    # maximum reached
+    assert scaler.update(get_load(5, 3, 3), 3, now=20) == KEEP
+    assert scaler.update(get_load(5, 3, 3), 3, now=30) == KEEP
+
+
+def test_short_backlog_is_ignored():
+    scaler = DispatcherScaler(min_dispatchers=1, max_dispatchers=3,
+                              scale_up_delay=2)
+
+    assert scaler.update(get_load(5, 1, 1), 1, now=0) == KEEP
+    assert scaler.update(get_load(0, 1, 1), 1, now=1) == KEEP
+    assert scaler.update(get_load(5, 1, 1), 1, now=2) == KEEP
+
+
+def test_scale_down_when_underutilised():
+    scaler = DispatcherScaler(min_dispatchers=1, max_dispatchers=3,
+                              scale_down_delay=10,
+                              scale_down_utilisation=0.5,
+                              cooldown=5)
+
+    assert scaler.update(get_load(0, 3, 1), 3, now=0) == KEEP
+    assert scaler.update(get_load(0, 3, 1), 3, now=9) == KEEP
+    assert scaler.update(get_load(0, 3, 1), 3, now=10) == SCALE_DOWN
+
+    # busy enough
+    assert scaler.update(get_load(0, 2, 1), 2, now=20) == KEEP
+    assert scaler.update(get_load(0, 2, 1), 2, now=40) == KEEP
+
+    # minimum reached
+    assert scaler.update(get_load(0, 1, 0), 1, now=50) == KEEP
+    assert scaler.update(get_load(0, 1, 0), 1, now=100) == KEEP
+
+
+def test_limits_are_enforced():
+    scaler = DispatcherScaler(min_dispatchers=2, max_dispatchers=3)
+
+    assert scaler.update(get_load(0, 1, 0), 1, now=0) == SCALE_UP
+    # the cooldown does not apply
+    assert scaler.update(get_load(0, 5, 0), 5, now=1) == SCALE_DOWN
+
+
+def test_get_utilisation():
+    assert DispatcherScaler.get_utilisation(get_load(0, 0, 0)) == 0
+    assert DispatcherScaler.get_utilisation(get_load(0, 4, 1)) == 0.25
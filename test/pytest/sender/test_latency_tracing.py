@@ -0,0 +1,133 @@
+import pytest
+import hidra  # noqa
+from latency_tracing import (
+    LatencySampler, LatencyHistogram, LatencyStats, TRACE_KEY, get_latencies,
+    get_trace, mark, without_trace)
+
+
+def test_sampler_disabled():
+    sampler = LatencySampler(0)
+    workload = {"filename": "test.tif"}
+
+    for _ in range(10):
+        sampler.start(workload)
+
+    assert TRACE_KEY not in workload
+
+
+@pytest.mark.parametrize("sample_rate, expected", [
+    (1, 10), (0.5, 5), (0.1, 1), (2, 10)
+])
+def test_sampler_rate(sample_rate, expected):
+    sampler = LatencySampler(sample_rate)
+
+    sampled = 0
+    for _ in range(10):
+        workload = {"filename": "test.tif"}
+        sampler.start(workload)
+        if TRACE_KEY in workload:
+            sampled += 1
+
+    assert sampled == expected
+
+
+def test_sampler_ignores_non_dict_workloads():
+    sampler = LatencySampler(1)
+    workload = [b"CLOSE_FILE", b"test.tif"]
+
+    sampler.start(workload)
+
+    assert workload == [b"CLOSE_FILE", b"test.tif"]
+
+
+def test_mark():
+    metadata = {"filename": "test.tif"}
+    mark(metadata, "queued")
+    assert get_trace(metadata) is None
+
+    metadata[TRACE_KEY] = {"detected": 1}
+    mark(metadata, "queued")
+    assert set(get_trace(metadata)) == {"detected", "queued"}
+
+    # e.g. CLOSE_FILE messages
+    mark([b"CLOSE_FILE"], "queued")
+
+
+def test_get_latencies():
+    trace = {
+        "detected": 1.0,
+        "requests_resolved": 1.5,
+        "queued": 2.0,
+        "dispatched": 4.0,
+        # no data was sent
+        "metadata": 4.5,
+        "confirmed": 6.0,
+        "removed": 6.25,
+    }
+
+    assert get_latencies(trace) == {
+        "requests_resolved": 0.5,
+        "queued": 0.5,
+        "dispatched": 2.0,
+        "metadata": 0.5,
+        "confirmed": 1.5,
+        "removed": 0.25,
+    }
+    assert get_latencies(trace, stages=["confirmed", "removed"]) == {
+        "confirmed": 1.5,
+        "removed": 0.25,
+    }
+
+
+def test_histogram_empty():
+    summary = LatencyHistogram().summary()
+
+    assert summary["count"] == 0
+    assert summary["p50"] is None
+
+
+def test_histogram_percentiles():
+    histogram = LatencyHistogram(growth=1.01)
+    for i in range(1, 1001):
+        histogram.add(i / 1000)
+
+    summary = histogram.summary()
+
+    assert summary["count"] == 1000
+    assert summary["min"] == 0.001
+    assert summary["max"] == 1
+    assert summary["mean"] == pytest.approx(0.5005)
+    assert summary["p50"] == pytest.approx(0.5, rel=0.01)
+    assert summary["p95"] == pytest.approx(0.95, rel=0.01)
+    assert summary["p99"] == pytest.approx(0.99, rel=0.01)
+
+
+def test_histogram_bounded_by_extrema():
+    histogram = LatencyHistogram()
+    histogram.add(0)
+    histogram.add(0.3)
+
+    assert histogram.percentile(50) <= histogram.min_value
+    assert histogram.percentile(99) == 0.3
+
+
+def test_stats():
+    stats = LatencyStats()
+    stats.add({"queued": 0.1, "dispatched": 0.2})
+    stats.add({"queued": 0.1})
+
+    summary = stats.summary()
+
+    assert set(summary) == {"queued", "dispatched"}
+    assert summary["queued"]["count"] == 2
+    assert summary["dispatched"]["count"] == 1
+
+
+def test_without_trace():
+    metadata = {"filename": "test.tif"}
+    assert without_trace(metadata) is metadata
+
+    traced = {"filename": "test.tif", TRACE_KEY: {"detected": 1.0}}
+    assert without_trace(traced) == {"filename": "test.tif"}
+    # the trace is kept on the sender side
+    assert traced[TRACE_KEY] == {"detected": 1.0}
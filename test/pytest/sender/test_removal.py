@@ -0,0 +1,120 @@
+import logging
+import threading
+import time
+
+import pytest
+
+import hidra  # noqa
+from removal import Remover
+
+log = logging.getLogger(__name__)
+
+
+@pytest.mark.parametrize("threads", [0, 3])
+def test_remover(threads):
+    removed = []
+
+    def remove(base_path, file_id):
+        removed.append((base_path, file_id))
+
+    remover = Remover(remove, log, threads=threads)
+
+    for i in range(10):
+        remover.submit("base", str(i), context=i)
+    remover.stop()
+
+    result = remover.get_removed()
+    assert sorted(result) == [(str(i), i, True) for i in range(10)]
+    assert sorted(removed) == [("base", str(i)) for i in range(10)]
+
+    stats = remover.get_stats()
+    assert stats["backlog"] == 0
+    assert stats["removed"] == 10
+    assert stats["latency"]["count"] == 10
+
+
+def test_remover_retry():
+    attempts = {}
+
+    def remove(base_path, file_id):
+        attempts[file_id] = attempts.get(file_id, 0) + 1
+        if file_id == "broken" or attempts[file_id] < 3:
+            raise IOError("failed")
+
+    remover = Remover(remove, log, threads=2, retries=2, retry_delay=0.01)
+
+    remover.submit("base", "flaky")
+    remover.submit("base", "broken")
+    remover.stop()
+
+    assert sorted(remover.get_removed()) == [("broken", None, False),
+                                             ("flaky", None, True)]
+    assert attempts == {"flaky": 3, "broken": 3}
+
+    stats = remover.get_stats()
+    assert stats["removed"] == 1
+    assert stats["failed"] == 1
+    assert stats["retries"] == 4
+
+
+def test_remover_backlog():
+    release = threading.Event()
+
+    def remove(base_path, file_id):
+        release.wait()
+
+    remover = Remover(remove, log, threads=1, max_backlog=2)
+
+    remover.submit("base", "a")
+    remover.submit("base", "b")
+    assert remover.backlog == 2
+
+    # blocks until a removal finished
+    timer = threading.Timer(0.2, release.set)
+    timer.start()
+    start = time.time()
+    remover.submit("base", "c")
+    assert time.time() - start >= 0.1
+
+    remover.stop()
+    assert len(remover.get_removed()) == 3
+    assert remover.backlog == 0
+
+
+def test_remover_cancel():
+    release = threading.Event()
+    attempts = []
+
+    def remove(base_path, file_id):
+        attempts.append(file_id)
+        release.wait()
+        raise IOError("failed")
+
+    remover = Remover(remove, log, threads=1, retries=3, retry_delay=0.01)
+
+    remover.submit("base", "a")
+    remover.submit("base", "b")
+    while not attempts:
+        time.sleep(0.01)
+
+    # b is not started yet, a is not retried
+    assert remover.cancel("b")
+    assert remover.cancel("a")
+    assert not remover.cancel("c")
+
+    release.set()
+    remover.stop()
+
+    assert sorted(remover.get_removed()) == [("a", None, None),
+                                             ("b", None, None)]
+    assert attempts == ["a"]
+    assert remover.get_stats()["cancelled"] == 2
+    assert remover.pending == {}
+
+
+def test_remover_cancel_finished():
+    remover = Remover(lambda base_path, file_id: None, log, threads=0)
+
+    remover.submit("base", "a")
+    assert not remover.cancel("a")
+    assert remover.get_removed() == [("a", None, True)]
@@ -55,6 +55,7 @@ from test_base import (TestBase,
                        MockZmqAuthenticator)
 import hidra
 import hidra.transfer as m_transfer
+import hidra.utils as utils
 
 __author__ = 'Manuela Kuhn <manuela.kuhn@desy.de>'
 
@@ -1787,6 +1788,58 @@ class TestTransfer(TestBase):
         # cleanup
         transfer = m_transfer.Transfer(**self.transfer_conf)
 
+        # --------------------------------------------------------------------
+        # data: batch of files
+        # --------------------------------------------------------------------
+
+        transfer.started_connections = {"STREAM": None}
+        transfer.data_socket = MockZmqSocket()
+        transfer.data_socket.recv_multipart.return_value = [
+            json.dumps({"filename": "foo"}).encode("utf-8"),
+            b"foo_data",
+            json.dumps({"filename": "bar"}).encode("utf-8"),
+            b"bar_data"
+        ]
+        transfer.poller = MockZmqPollerAllFake()
+        transfer.poller.poll.return_value = {
+            transfer.data_socket: zmq.POLLIN
+        }
+
+        ret_val = transfer.get_chunk()
+        self.assertEqual(ret_val, [{"filename": "foo"}, b"foo_data"])
+
+        # the second file is returned without receiving again
+        transfer.data_socket.recv_multipart.return_value = None
+        ret_val = transfer.get_chunk()
+        self.assertEqual(ret_val, [{"filename": "bar"}, b"bar_data"])
+        self.assertEqual(transfer.data_socket.recv_multipart.call_count, 1)
+
+        # cleanup
+        transfer = m_transfer.Transfer(**self.transfer_conf)
+
+        # --------------------------------------------------------------------
+        # data: compressed chunk
+        # --------------------------------------------------------------------
+
+        transfer.started_connections = {"STREAM": None}
+        transfer.data_socket = MockZmqSocket()
+        transfer.data_socket.recv_multipart.return_value = [
+            json.dumps({"filename": "foo",
+                        "compression": utils.ZLIB}).encode("utf-8"),
+            utils.compress(b"foo_data", utils.ZLIB)
+        ]
+        transfer.poller = MockZmqPollerAllFake()
+        transfer.poller.poll.return_value = {
+            transfer.data_socket: zmq.POLLIN
+        }
+
+        # the compression entry is removed because the data is uncompressed
+        ret_val = transfer.get_chunk()
+        self.assertEqual(ret_val, [{"filename": "foo"}, b"foo_data"])
+
+        # cleanup
+        transfer = m_transfer.Transfer(**self.transfer_conf)
+
         # --------------------------------------------------------------------
         # run in timeout
         # --------------------------------------------------------------------
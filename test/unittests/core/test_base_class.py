@@ -194,6 +194,16 @@ class TestBaseClass(TestBase):
             self.assertTrue(mock_stop.called)
             self.assertEqual(ret_val, expected_result)
 
+    def test_report_ready(self):
+        obj = Base()
+
+        # no queue to report to
+        obj.report_ready("test")
+
+        obj.ready_queue = mock.MagicMock()
+        obj.report_ready("test")
+        obj.ready_queue.put.assert_called_once_with("test")
+
     @mock.patch("base_class.Base._forward_control_signal")
     @mock.patch("base_class.Base._react_to_exit_signal")
     @mock.patch("base_class.Base._react_to_close_sockets_signal")
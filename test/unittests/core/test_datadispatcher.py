@@ -40,7 +40,7 @@ import time
 import zmq
 
 from test_base import TestBase, create_dir
-from datadispatcher import DataHandler, run_datahandler
+from datadispatcher import ByteBudget, DataHandler, run_datahandler
 
 import hidra.utils as utils
 
@@ -223,6 +223,42 @@ class TestDataDispatcher(TestBase):
                 self.stop_socket(name="receiving_socket{}".format(i),
                                  socket=sckt)
 
+    def test_byte_budget(self):
+        """Check that the bytes in flight are limited.
+        """
+
+        stop_request = threading.Event()
+        budget = ByteBudget(max_bytes=100)
+
+        # files larger than the budget are accepted if nothing is in flight
+        self.assertTrue(budget.acquire(200, stop_request))
+        budget.release(200)
+
+        self.assertTrue(budget.acquire(60, stop_request))
+        self.assertTrue(budget.acquire(40, stop_request))
+
+        acquired = []
+
+        def acquire():
+            acquired.append(budget.acquire(10, stop_request, timeout=0.1))
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        time.sleep(0.2)
+        # has to wait till budget is released
+        self.assertEqual(acquired, [])
+
+        budget.release(60)
+        thread.join(1)
+        self.assertEqual(acquired, [True])
+        self.assertEqual(budget.bytes_in_flight, 50)
+        self.assertEqual(budget.files_in_flight, 2)
+
+        # waiting is aborted if stopped
+        self.assertTrue(budget.acquire(50, stop_request))
+        stop_request.set()
+        self.assertFalse(budget.acquire(10, stop_request, timeout=0.1))
+
     def tearDown(self):
         self.context.destroy(0)
 
@@ -66,7 +66,7 @@ from signalhandler import (
     TargetProperties
 )
 import hidra.utils as utils
-from hidra import __version__, FormatError
+from hidra import __version__, FormatError, Transfer
 
 __author__ = 'Manuela Kuhn <manuela.kuhn@desy.de>'
 
@@ -321,6 +321,170 @@ class TestSignalHandler(TestBase):
             self.stop_socket(name="control_pub_socket",
                              socket=control_pub_socket)
 
+    def _receive_with_transfer(self, config_df, get_frames, n_files=1):
+        """Let a Transfer negotiate with the signal handler and get files.
+
+        Args:
+            config_df: The datafetcher config of the signal handler.
+            get_frames: Function building the frames to send from what the
+                signal handler told the data handlers, the target and the
+                metadata of the file.
+            n_files (optional): How many files the Transfer gets.
+
+        Returns:
+            A list of the metadata and data the Transfer received.
+        """
+
+        endpoints = self.config["endpoints"]
+
+        # control messages are not send over an forwarder, thus the
+        # control_sub endpoint is used directly
+        control_pub_socket = self.start_socket(
+            name="control_pub_socket",
+            sock_type=zmq.PUB,
+            sock_con="bind",
+            endpoint=endpoints.control_sub_bind
+        )
+
+        self.signalhandler_config["config"]["datafetcher"].update(config_df)
+        self.signalhandler_config["context"] = None
+        published = []
+
+        class RecordingSignalHandler(SignalHandler):
+            """Records what the signal handler tells the data handlers."""
+
+            def create_sockets(self):
+                super().create_sockets()
+                self.control_pub_socket.send_multipart = published.append
+
+        sighandler = RecordingSignalHandler(**self.signalhandler_config)
+        signalhandler_thr = threading.Thread(target=sighandler.run)
+        signalhandler_thr.start()
+
+        port = self.receiving_ports[0]
+        target = "{}:{}".format(self.con_ip, port)
+        transfer = Transfer("STREAM", signal_host=self.con_ip)
+        data_socket = None
+
+        metadata = {
+            "filename": "test.cbf",
+            "relative_path": "",
+            "chunk_number": 0,
+            "chunksize": 10485760,
+            "filesize": 400,
+            "file_mod_time": 1620136546.5,
+            "version": __version__
+        }
+
+        try:
+            transfer.initiate([self.con_ip, port, 1])
+            transfer.start([self.con_ip, port])
+
+            # send a chunk the way a data handler does
+            data_socket = self.start_socket(
+                name="data_socket",
+                sock_type=zmq.PUSH,
+                sock_con="connect",
+                endpoint="tcp://{}".format(target)
+            )
+            frames = get_frames(published, target, metadata)
+            data_socket.send_multipart(frames)
+
+            return [transfer.get(timeout=2000) for _ in range(n_files)]
+        finally:
+            transfer.stop()
+
+            control_pub_socket.send_multipart([b"control", b"EXIT"])
+            signalhandler_thr.join()
+
+            if data_socket is not None:
+                self.stop_socket(name="data_socket", socket=data_socket)
+            self.stop_socket(name="control_pub_socket",
+                             socket=control_pub_socket)
+
+    @mock.patch.object(utils, "get_logger", mock_get_logger)
+    def test_negotiate_metadata_format(self):
+        """Check that a Transfer of this version gets msgpack metadata.
+        """
+
+        if utils.MSGPACK not in utils.get_metadata_formats():
+            self.skipTest("msgpack is not installed")
+
+        def get_frames(published, target, metadata):
+            self.assertEqual(len(published), 1)
+            self.assertEqual(published[0][:2], [b"signal", b"METADATA_FORMAT"])
+            formats = dict(json.loads(published[0][2].decode("utf-8")))
+            self.assertEqual(formats[target], utils.MSGPACK)
+
+            frame = utils.serialize_metadata(metadata, utils.MSGPACK)
+            # msgpack maps do not start with a JSON brace
+            self.assertFalse(frame.startswith(b"{"))
+            return [frame, b"data" * 100]
+
+        [(metadata, data)] = self._receive_with_transfer(
+            config_df={"metadata_format": utils.MSGPACK},
+            get_frames=get_frames
+        )
+
+        self.assertEqual(metadata["filename"], "test.cbf")
+        self.assertEqual(data, b"data" * 100)
+
+    @mock.patch.object(utils, "get_logger", mock_get_logger)
+    def test_negotiate_compression(self):
+        """Check that a Transfer of this version decompresses the data.
+        """
+
+        def get_frames(published, target, metadata):
+            self.assertEqual(len(published), 1)
+            self.assertEqual(published[0][:2], [b"signal", b"COMPRESSION"])
+            codecs = dict(json.loads(published[0][2].decode("utf-8")))
+            self.assertEqual(codecs[target], utils.ZLIB)
+
+            metadata = dict(metadata, compression=utils.ZLIB)
+            return [utils.serialize_metadata(metadata),
+                    utils.compress(b"data" * 100, utils.ZLIB)]
+
+        [(metadata, data)] = self._receive_with_transfer(
+            config_df={"compression": utils.ZLIB},
+            get_frames=get_frames
+        )
+
+        self.assertNotIn("compression", metadata)
+        self.assertEqual(data, b"data" * 100)
+
+    @mock.patch.object(utils, "get_logger", mock_get_logger)
+    def test_negotiate_batching(self):
+        """Check that a Transfer of this version gets all files of a batch.
+        """
+
+        def get_frames(published, target, metadata):
+            self.assertEqual(published, [
+                [b"signal", b"BATCHING",
+                 json.dumps([target]).encode("utf-8")]
+            ])
+
+            # [<metadata>, <data>, <metadata>, <data>]
+            frames = []
+            for i in range(2):
+                file_metadata = dict(metadata, filename="{}.cbf".format(i))
+                frames += [utils.serialize_metadata(file_metadata),
+                           b"data" * (i + 1)]
+            return frames
+
+        received = self._receive_with_transfer(
+            config_df={
+                "type": "file_fetcher",
+                "file_fetcher": {"batch_files": True}
+            },
+            get_frames=get_frames,
+            n_files=2
+        )
+
+        self.assertEqual(
+            [(metadata["filename"], data) for metadata, data in received],
+            [("0.cbf", b"data"), ("1.cbf", b"datadata")]
+        )
+
     # mocking of stop has to be done for the whole function because otherwise
     # it is called in __del__
     @mock.patch("signalhandler.SignalHandler.stop")
@@ -740,6 +904,51 @@ class TestSignalHandler(TestBase):
         # reset
         reset(sighandler)
 
+        # --------------------------------------------------------------------
+        # request_fw_socket: batched requests
+        # --------------------------------------------------------------------
+        self.log.info("%s: REQUEST_FW_SOCKET: BATCHED REQUESTS",
+                      current_func_name)
+
+        signal = [b"GET_REQUESTS_BATCH",
+                  json.dumps(["file1.py", "file2.tif", "file3.py"])
+                  .encode("utf-8")]
+        init_sighandler(sighandler, sighandler.request_fw_socket, signal)
+        sighandler.request_fw_socket.send_string = mock.MagicMock()
+
+        targets = [
+            ["{}:{}".format(host, port), 0, re.compile(".*"), send_type],
+            ["{}:{}".format(host, port + 1), 0, re.compile(".*"), send_type]
+        ]
+        sighandler.registered_streams = [
+            TargetProperties(targets=targets,
+                             appid=None,
+                             time_registered=current_time)
+        ]
+        sighandler.vari_requests = [
+            [["{}:{}".format(host, port + 2), 0, re.compile(".*py$"),
+              send_type]]
+        ]
+        sighandler.perm_requests = [0]
+
+        sighandler._run()
+
+        expected = json.dumps([
+            [["{}:{}".format(host, port), 0, send_type],
+             ["{}:{}".format(host, port + 2), 0, send_type]],
+            [["{}:{}".format(host, port + 1), 0, send_type]],
+            [["{}:{}".format(host, port), 0, send_type]]
+        ])
+        (sighandler.request_fw_socket
+         .send_string
+         .assert_called_once_with(expected))
+
+        self.assertEqual(sighandler.vari_requests, [[]])
+        self.assertEqual(sighandler.perm_requests, [1])
+
+        # reset
+        reset(sighandler)
+
         # --------------------------------------------------------------------
         # com_socket: signal ok
         # --------------------------------------------------------------------
@@ -966,6 +1175,104 @@ class TestSignalHandler(TestBase):
         # reset
         reset(sighandler)
 
+    def test_routing_table(self):
+        """Check the routing table and the consumption of leased requests.
+        """
+
+        sighandler = SignalHandler(**self.signalhandler_config)
+        sighandler.log = MockLogging()
+        sighandler.control_pub_socket = mock.MagicMock()
+        sighandler.use_local_routing = True
+
+        host = self.con_ip
+        port = 1234
+        send_type = "data"
+        current_time = datetime.datetime.now().isoformat()
+        socket_id = "{}:{}".format(host, port)
+        socket_id2 = "{}:{}".format(host, port + 1)
+
+        targets = [[socket_id, 0, re.compile(".*"), send_type]]
+        sighandler.registered_streams = [
+            TargetProperties(targets=targets,
+                             appid="stream_app",
+                             time_registered=current_time)
+        ]
+        sighandler.perm_requests = [0]
+
+        query_targets = [[socket_id, 0, re.compile(".*"), send_type],
+                         [socket_id2, 0, re.compile(".*"), send_type],
+                         [socket_id2, 0, re.compile(".*.tif"), send_type]]
+        sighandler.registered_queries = [
+            TargetProperties(targets=query_targets,
+                             appid="query_app",
+                             time_registered=current_time)
+        ]
+        sighandler.vari_requests = [
+            [query_targets[0], query_targets[1], query_targets[0],
+             query_targets[2]]
+        ]
+
+        # --------------------------------------------------------------------
+        # publish
+        # --------------------------------------------------------------------
+        sighandler._publish_routing_table()
+
+        expected = {
+            "version": 1,
+            "streams": [{
+                "key": ["stream_app", current_time],
+                "targets": [[socket_id, 0, ".*", send_type]],
+                "next": 0
+            }],
+            "queries": [{
+                "key": ["query_app", current_time],
+                "requests": [[socket_id, 0, ".*", send_type],
+                             [socket_id2, 0, ".*", send_type],
+                             [socket_id, 0, ".*", send_type],
+                             [socket_id2, 0, ".*.tif", send_type]]
+            }]
+        }
+        (sighandler.control_pub_socket
+         .send_multipart
+         .assert_called_once_with(
+             [b"routing", json.dumps(expected).encode("utf-8")]
+         ))
+
+        # unchanged table is not published again
+        sighandler.control_pub_socket.reset_mock()
+        sighandler._publish_routing_table()
+
+        self.assertFalse(sighandler.control_pub_socket.send_multipart.called)
+        self.assertEqual(sighandler.routing_version, 1)
+
+        # --------------------------------------------------------------------
+        # consume
+        # --------------------------------------------------------------------
+        sighandler._consume_requests([
+            # only the request matching completely is consumed
+            [["query_app", current_time],
+             [socket_id2, 0, ".*.tif", send_type]],
+            # query not registered (anymore)
+            [["other_app", current_time], [socket_id, 0, ".*", send_type]],
+        ])
+
+        self.assertEqual(sighandler.vari_requests,
+                         [[query_targets[0], query_targets[1],
+                           query_targets[0]]])
+
+        sighandler._publish_routing_table()
+
+        self.assertEqual(sighandler.routing_version, 2)
+        self.assertTrue(sighandler.control_pub_socket.send_multipart.called)
+
+        # disabled
+        sighandler.control_pub_socket.reset_mock()
+        sighandler.use_local_routing = False
+
+        sighandler._publish_routing_table()
+
+        self.assertFalse(sighandler.control_pub_socket.send_multipart.called)
+
     def test_check_signal(self):
         current_func_name = inspect.currentframe().f_code.co_name
 
@@ -1844,7 +2151,8 @@ class TestSignalHandler(TestBase):
 
         sighandler.react_to_signal(unpacked_message)
 
-        expected_args = [signal, version]
+        expected_args = [signal, version, b"SET_METADATA_FORMAT",
+                         b"SET_COMPRESSION", b"SET_BATCHING"]
         sighandler.send_response.assert_called_once_with(expected_args)
 
         sighandler.send_response.reset_mock()
@@ -2135,6 +2443,98 @@ class TestSignalHandler(TestBase):
         sighandler._start_signal.reset_mock()
         sighandler._stop_signal.reset_mock()
 
+        # --------------------------------------------------------------------
+        # check SET_METADATA_FORMAT
+        # --------------------------------------------------------------------
+        self.log.info("%s: CHECK SET_METADATA_FORMAT", current_func_name)
+
+        signal = b"SET_METADATA_FORMAT"
+        unpacked_message_dict["signal"] = signal
+        unpacked_message_dict["targets"] = [
+            ["my_host:1234", 1, ".*", [utils.JSON, utils.MSGPACK]],
+            ["my_host:5678", 1, ".*"]
+        ]
+        unpacked_message = UnpackedMessage(**unpacked_message_dict)
+        sighandler.metadata_format = utils.MSGPACK
+        sighandler.control_pub_socket = mock.MagicMock()
+
+        # independent of msgpack being installed
+        patch_formats = mock.patch(
+            "hidra.utils.utils_serialization.get_metadata_formats",
+            return_value=[utils.JSON, utils.MSGPACK]
+        )
+        with patch_formats:
+            sighandler.react_to_signal(unpacked_message)
+
+        sighandler.send_response.assert_called_once_with([signal])
+        sighandler.control_pub_socket.send_multipart.assert_called_once_with(
+            [b"signal",
+             b"METADATA_FORMAT",
+             json.dumps([["my_host:1234", utils.MSGPACK],
+                         ["my_host:5678", utils.JSON]]).encode("utf-8")]
+        )
+
+        unpacked_message_dict["targets"] = None
+        sighandler.send_response.reset_mock()
+        sighandler._start_signal.reset_mock()
+        sighandler._stop_signal.reset_mock()
+
+        # --------------------------------------------------------------------
+        # check SET_COMPRESSION
+        # --------------------------------------------------------------------
+        self.log.info("%s: CHECK SET_COMPRESSION", current_func_name)
+
+        signal = b"SET_COMPRESSION"
+        unpacked_message_dict["signal"] = signal
+        unpacked_message_dict["targets"] = [
+            ["my_host:1234", 1, ".*", [utils.ZLIB]],
+            ["my_host:5678", 1, ".*", []]
+        ]
+        unpacked_message = UnpackedMessage(**unpacked_message_dict)
+        sighandler.compression = utils.ZLIB
+        sighandler.control_pub_socket = mock.MagicMock()
+
+        sighandler.react_to_signal(unpacked_message)
+
+        sighandler.send_response.assert_called_once_with([signal])
+        sighandler.control_pub_socket.send_multipart.assert_called_once_with(
+            [b"signal",
+             b"COMPRESSION",
+             json.dumps([["my_host:1234", utils.ZLIB],
+                         ["my_host:5678", None]]).encode("utf-8")]
+        )
+
+        unpacked_message_dict["targets"] = None
+        sighandler.send_response.reset_mock()
+        sighandler._start_signal.reset_mock()
+        sighandler._stop_signal.reset_mock()
+
+        # --------------------------------------------------------------------
+        # check SET_BATCHING
+        # --------------------------------------------------------------------
+        self.log.info("%s: CHECK SET_BATCHING", current_func_name)
+
+        signal = b"SET_BATCHING"
+        unpacked_message_dict["signal"] = signal
+        unpacked_message_dict["targets"] = [["my_host:1234", 1, ".*"]]
+        unpacked_message = UnpackedMessage(**unpacked_message_dict)
+        sighandler.batch_files = True
+        sighandler.control_pub_socket = mock.MagicMock()
+
+        sighandler.react_to_signal(unpacked_message)
+
+        sighandler.send_response.assert_called_once_with([signal])
+        sighandler.control_pub_socket.send_multipart.assert_called_once_with(
+            [b"signal",
+             b"BATCHING",
+             json.dumps(["my_host:1234"]).encode("utf-8")]
+        )
+
+        unpacked_message_dict["targets"] = None
+        sighandler.send_response.reset_mock()
+        sighandler._start_signal.reset_mock()
+        sighandler._stop_signal.reset_mock()
+
         # --------------------------------------------------------------------
         # check NO_VALID_SIGNAL
         # --------------------------------------------------------------------
@@ -128,6 +128,40 @@ class TestStatServer(TestBase):
         endpt = utils.Endpoints(*answer["network"]["endpoints"])
         self.log.debug("com_con=%s", endpt.com_con)
 
+    def test_statserver_latency(self):
+        """Check that latencies are aggregated and exposed.
+        """
+
+        stats_collect_socket = self.start_socket(
+            name="stats_collect_socket",
+            sock_type=zmq.PUSH,
+            sock_con="connect",
+            endpoint=self.endpoints.stats_collect_con
+        )
+
+        stats_expose_socket = self.start_socket(
+            name="stats_expose_socket",
+            sock_type=zmq.REQ,
+            sock_con="connect",
+            endpoint=self.endpoints.stats_expose_con
+        )
+
+        for latency in [0.1, 0.2, 0.3]:
+            msg = json.dumps(["latency", {"queued": latency}]).encode()
+            stats_collect_socket.send(msg)
+        time.sleep(0.1)
+
+        stats_expose_socket.send(json.dumps("latency").encode())
+
+        answer = json.loads(stats_expose_socket.recv().decode())
+        self.log.debug("answer=%s", answer)
+
+        self.assertEqual(list(answer.keys()), ["queued"])
+        self.assertEqual(answer["queued"]["count"], 3)
+        self.assertEqual(answer["queued"]["max"], 0.3)
+        for key in ["p50", "p95", "p99"]:
+            self.assertIn(key, answer["queued"])
+
     def tearDown(self):
         if self.control_socket is not None:
             self.log.info("Sending 'Exit' signal")
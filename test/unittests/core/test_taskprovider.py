@@ -30,6 +30,7 @@ from __future__ import unicode_literals
 # requires dependency on future
 from builtins import super  # pylint: disable=redefined-builtin
 
+import copy
 import json
 from multiprocessing import Process, freeze_support, Event
 import os
@@ -49,6 +50,7 @@ except ImportError:
     import pathlib2 as pathlib
 
 from test_base import TestBase, create_dir, MockZmqSocket, MockLogging
+from dispatch_scheduler import DispatchScheduler
 from taskprovider import TaskProvider, run_taskprovider
 import hidra.utils as utils
 
@@ -93,7 +95,10 @@ class RequestResponder(threading.Thread):
                 request = self.request_fw_socket.recv_multipart()
                 self.log.debug("Received request: %s", request)
 
-                message = json.dumps(open_requests).encode("utf-8")
+                filenames = json.loads(request[1].decode("utf-8"))
+                message = json.dumps(
+                    [open_requests for _ in filenames]
+                ).encode("utf-8")
                 self.request_fw_socket.send(message)
                 self.log.debug("Answer: %s", open_requests)
             except zmq.ContextTerminated:
@@ -371,6 +376,373 @@ class TestTaskProvider(TestBase):
             self.log.debug(taskprovider.log.error.call_args[0][0])
             self.assertNotIn("failed", taskprovider.log.error.call_args[0][0])
 
+    def test_event_polling(self):
+        """Check that a pollable event detector is only asked for events
+        when it has some.
+        """
+
+        stop_request = Event()
+        endpoints = self.config["endpoints"]
+
+        kwargs = dict(
+            config=self.taskprovider_config,
+            endpoints=endpoints,
+            log_queue=self.log_queue,
+            log_level="debug",
+            stop_request=stop_request
+        )
+        taskprovider = TaskProvider(**kwargs)
+
+        taskprovider.log = MockLogging()
+        taskprovider.use_credit_dispatch = False
+        taskprovider.control_socket = mock.MagicMock()
+        taskprovider.eventdetector = mock.MagicMock()
+        taskprovider.eventdetector.get_new_event.return_value = []
+        taskprovider.eventdetector.has_pending_events.return_value = False
+        taskprovider.eventdetector.pop_stats.return_value = []
+        taskprovider._check_control_socket = mock.MagicMock(
+            return_value=False
+        )
+        taskprovider.check_control_signal = mock.MagicMock(return_value=True)
+
+        fd = 5
+        taskprovider.eventdetector_fd = fd
+        taskprovider.event_poller = mock.MagicMock()
+        taskprovider.event_poller.poll.side_effect = [
+            # timeout
+            [],
+            # new events
+            [(fd, zmq.POLLIN)],
+            # exit signal
+            [(taskprovider.control_socket, zmq.POLLIN)]
+        ]
+
+        taskprovider._run()
+
+        self.assertEqual(
+            taskprovider.eventdetector.get_new_event.call_count, 1
+        )
+        taskprovider.check_control_signal.assert_called_once_with()
+
+    def test_event_polling_pending(self):
+        """Check that events held back by the event detector are fetched
+        after a poll timeout.
+        """
+
+        stop_request = Event()
+        endpoints = self.config["endpoints"]
+
+        kwargs = dict(
+            config=self.taskprovider_config,
+            endpoints=endpoints,
+            log_queue=self.log_queue,
+            log_level="debug",
+            stop_request=stop_request
+        )
+        taskprovider = TaskProvider(**kwargs)
+
+        taskprovider.log = MockLogging()
+        taskprovider.use_credit_dispatch = False
+        taskprovider.control_socket = mock.MagicMock()
+        taskprovider.eventdetector = mock.MagicMock()
+        taskprovider.eventdetector.get_new_event.return_value = []
+        taskprovider.eventdetector.has_pending_events.side_effect = [
+            True, False
+        ]
+        taskprovider.eventdetector.pop_stats.return_value = []
+        taskprovider._check_control_socket = mock.MagicMock(
+            return_value=False
+        )
+        taskprovider.check_control_signal = mock.MagicMock(return_value=True)
+
+        fd = 5
+        taskprovider.eventdetector_fd = fd
+        taskprovider.event_poller = mock.MagicMock()
+        taskprovider.event_poller.poll.side_effect = [
+            # timeout with pending events
+            [],
+            # timeout without
+            [],
+            # exit signal
+            [(taskprovider.control_socket, zmq.POLLIN)]
+        ]
+
+        taskprovider._run()
+
+        self.assertEqual(
+            taskprovider.eventdetector.get_new_event.call_count, 1
+        )
+
+    def test_get_requests(self):
+        """Check that requests are gotten for all events at once.
+        """
+
+        stop_request = Event()
+        endpoints = self.config["endpoints"]
+
+        kwargs = dict(
+            config=self.taskprovider_config,
+            endpoints=endpoints,
+            log_queue=self.log_queue,
+            log_level="debug",
+            stop_request=stop_request
+        )
+        taskprovider = TaskProvider(**kwargs)
+
+        taskprovider.log = MockLogging()
+        taskprovider.request_fw_socket = mock.MagicMock()
+
+        requests = [["my_host:6003", 1, "data"]]
+        taskprovider.request_fw_socket.recv_string.return_value = (
+            json.dumps([requests, ["None"]])
+        )
+
+        workload_list = [
+            {
+                "filename": "1.tif",
+                "source_path": "/my_dir",
+                "relative_path": "local"
+            },
+            "CLOSE_FILE",
+            {
+                "filename": "2.tif",
+                "source_path": "/my_dir",
+                "relative_path": "local"
+            }
+        ]
+
+        ret_val = taskprovider._get_requests(workload_list)
+
+        (taskprovider.request_fw_socket
+         .send_multipart
+         .assert_called_once_with(
+             [b"GET_REQUESTS_BATCH",
+              json.dumps(["1.tif", "2.tif"]).encode("utf-8")]
+         ))
+        self.assertEqual(ret_val, [requests, ["None"], ["None"]])
+
+        # no events -> no round trip needed
+        taskprovider.request_fw_socket.reset_mock()
+
+        ret_val = taskprovider._get_requests([])
+
+        self.assertFalse(taskprovider.request_fw_socket.send_multipart.called)
+        self.assertEqual(ret_val, [])
+
+    def test_get_requests_local(self):
+        """Check that the requests are determined with the routing table.
+        """
+
+        stop_request = Event()
+        endpoints = self.config["endpoints"]
+
+        kwargs = dict(
+            config=self.taskprovider_config,
+            endpoints=endpoints,
+            log_queue=self.log_queue,
+            log_level="debug",
+            stop_request=stop_request
+        )
+        taskprovider = TaskProvider(**kwargs)
+
+        taskprovider.log = MockLogging()
+        taskprovider.request_fw_socket = mock.MagicMock()
+        taskprovider.routing_socket = mock.MagicMock()
+        taskprovider.routing_socket.recv_multipart.side_effect = zmq.Again()
+        taskprovider.use_local_routing = True
+
+        stream_key = ["stream_app", "time"]
+        query_key = ["query_app", "time"]
+        table = {
+            "version": 1,
+            "streams": [{
+                "key": stream_key,
+                "targets": [["host:6003", 1, ".*", "data"],
+                            ["host:6004", 1, ".*", "data"]],
+                "next": 0
+            }],
+            "queries": [{
+                "key": query_key,
+                "requests": [["host:6005", 0, ".*.tif", "metadata"]]
+            }]
+        }
+        table_consumed = copy.deepcopy(table)
+        table_consumed["version"] = 2
+        table_consumed["queries"][0]["requests"] = []
+        # the signal handler does not know about locally routed files
+        table_consumed["streams"][0]["next"] = 0
+
+        taskprovider.request_fw_socket.recv_string.side_effect = [
+            json.dumps(table),
+            json.dumps(table_consumed)
+        ]
+
+        workload_list = [
+            {"filename": "1.cbf", "source_path": "/my_dir",
+             "relative_path": "local"},
+            {"filename": "2.tif", "source_path": "/my_dir",
+             "relative_path": "local"},
+            {"filename": "3.tif", "source_path": "/my_dir",
+             "relative_path": "local"}
+        ]
+
+        ret_val = taskprovider._get_requests(workload_list)
+
+        expected = [
+            [["host:6003", 1, "data"]],
+            [["host:6004", 1, "data"], ["host:6005", 0, "metadata"]],
+            [["host:6003", 1, "data"]]
+        ]
+        self.assertEqual(ret_val, expected)
+
+        calls = taskprovider.request_fw_socket.send_multipart.call_args_list
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(calls[0][0][0][0], b"GET_ROUTING_TABLE")
+        self.assertEqual(
+            calls[1][0][0],
+            [b"CONSUME_REQUESTS",
+             json.dumps(
+                 [[query_key, ["host:6005", 0, ".*.tif", "metadata"]]]
+             ).encode("utf-8")]
+        )
+
+        self.assertEqual(taskprovider.routing_table["version"], 2)
+        # round-robin position was kept
+        self.assertEqual(taskprovider.routing_table["streams"][0]["next"], 1)
+
+        # no further round trip needed
+        taskprovider.request_fw_socket.reset_mock()
+
+        ret_val = taskprovider._get_requests(workload_list[:1])
+
+        self.assertEqual(ret_val, [[["host:6004", 1, "data"]]])
+        self.assertFalse(taskprovider.request_fw_socket.send_multipart.called)
+
+    def test_dispatch_jobs(self):
+        """Check that jobs are only sent to dispatchers with free capacity.
+        """
+
+        stop_request = Event()
+        endpoints = self.config["endpoints"]
+
+        kwargs = dict(
+            config=self.taskprovider_config,
+            endpoints=endpoints,
+            log_queue=self.log_queue,
+            log_level="debug",
+            stop_request=stop_request
+        )
+        taskprovider = TaskProvider(**kwargs)
+
+        taskprovider.log = MockLogging()
+        taskprovider.scheduler = DispatchScheduler()
+        taskprovider.router_socket = mock.MagicMock()
+        taskprovider.poller = mock.MagicMock()
+        taskprovider.poller.poll.return_value = []
+
+        capacity = json.dumps({"bytes": 100, "jobs": 1}).encode("utf-8")
+        taskprovider.router_socket.recv_multipart.side_effect = [
+            [b"dispatcher1", b"READY", capacity],
+            zmq.Again(),
+            [b"dispatcher1", b"DONE", b"0"],
+            zmq.Again(),
+        ]
+
+        taskprovider.scheduler.add_job([b"job1"], 10)
+        taskprovider.scheduler.add_job([b"job2"], 10)
+
+        taskprovider._dispatch_jobs()
+
+        calls = taskprovider.router_socket.send_multipart.call_args_list
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(calls[0][0][0], [b"dispatcher1", b"0", b"job1"])
+        self.assertEqual(calls[1][0][0], [b"dispatcher1", b"1", b"job2"])
+        self.assertFalse(taskprovider.scheduler.has_jobs())
+
+    def test_dispatch_jobs_failed(self):
+        """Check that jobs which could not be sent are requeued in order.
+        """
+
+        stop_request = Event()
+        endpoints = self.config["endpoints"]
+
+        kwargs = dict(
+            config=self.taskprovider_config,
+            endpoints=endpoints,
+            log_queue=self.log_queue,
+            log_level="debug",
+            stop_request=stop_request
+        )
+        taskprovider = TaskProvider(**kwargs)
+
+        taskprovider.log = MockLogging()
+        taskprovider.scheduler = DispatchScheduler()
+        taskprovider.router_socket = mock.MagicMock()
+        taskprovider.router_socket.recv_multipart.side_effect = zmq.Again()
+        taskprovider.poller = mock.MagicMock()
+        taskprovider.poller.poll.return_value = []
+
+        taskprovider.scheduler.register(b"dispatcher1", 100, 2)
+        for i in range(3):
+            taskprovider.scheduler.add_job([b"job" + str(i).encode()], 10)
+
+        def send(message):
+            if message[0] == b"dispatcher1":
+                raise zmq.error.ZMQError()
+
+        taskprovider.router_socket.send_multipart.side_effect = send
+
+        # stop waiting for a free dispatcher
+        taskprovider.check_control_signal = mock.MagicMock(return_value=True)
+        taskprovider.poller.poll.return_value = [
+            (taskprovider.control_socket, zmq.POLLIN)
+        ]
+
+        taskprovider._dispatch_jobs()
+
+        # only one attempt for the failed dispatcher
+        calls = taskprovider.router_socket.send_multipart.call_args_list
+        self.assertEqual(len(calls), 1)
+
+        taskprovider.scheduler.register(b"dispatcher2", 100, 3)
+        self.assertEqual(
+            [a[2] for a in taskprovider.scheduler.get_assignments()],
+            [[b"job0"], [b"job1"], [b"job2"]]
+        )
+
+    def test_react_to_drain_signal(self):
+        """Check that only the data handlers of a drained dispatcher stop.
+        """
+
+        stop_request = Event()
+        endpoints = self.config["endpoints"]
+
+        kwargs = dict(
+            config=self.taskprovider_config,
+            endpoints=endpoints,
+            log_queue=self.log_queue,
+            log_level="debug",
+            stop_request=stop_request
+        )
+        taskprovider = TaskProvider(**kwargs)
+
+        taskprovider.log = MockLogging()
+        taskprovider.use_credit_dispatch = True
+        taskprovider.scheduler = DispatchScheduler()
+        taskprovider.router_socket = mock.MagicMock()
+
+        for identity in [b"1/2-0", b"1/2-1", b"2/2-0"]:
+            taskprovider.scheduler.register(identity, 100, 1)
+
+        taskprovider._react_to_drain_signal([b"DRAIN", b"2/2"])
+
+        taskprovider.router_socket.send_multipart.assert_called_once_with(
+            [b"2/2-0", b"STOP"]
+        )
+        self.assertEqual(taskprovider.scheduler.dispatcher_order,
+                         [b"1/2-0", b"1/2-1"])
+        self.assertFalse(stop_request.is_set())
+
     def tearDown(self):
         self.context.destroy(0)
 
@@ -38,7 +38,7 @@ import time
 import shutil
 import zmq
 
-from datafetchers.cleanerbase import CleanerBase
+from datafetchers.cleanerbase import CleanerBase, ConfirmationTracking
 import hidra.utils as utils
 from .datafetcher_test_base import DataFetcherTestBase
 
@@ -179,3 +179,83 @@ class TestDataFetcher(DataFetcherTestBase):
                                                    socket=confirmation_socket)
             control_pub_socket = self.stop_socket(name="control_pub_socket",
                                                   socket=control_pub_socket)
+
+    def test_confirmation_tracking(self):
+        """Simulate jobs and confirmations arriving in any order.
+        """
+
+        tracker = ConfirmationTracking(log_queue=self.log_queue,
+                                       log_level="debug")
+
+        # job first
+        self.assertIsNone(tracker.process_job("base", "file1", 3))
+        self.assertIsNone(tracker.process_confirmation("file1", 0))
+        self.assertIsNone(tracker.process_confirmation("file1", 2))
+        # duplicates do not count
+        self.assertIsNone(tracker.process_confirmation("file1", 2))
+        self.assertEqual(tracker.process_confirmation("file1", 1), "base")
+
+        # confirmations first, including one not belonging to the file
+        self.assertIsNone(tracker.process_confirmation("file2", 0))
+        self.assertIsNone(tracker.process_confirmation("file2", 9))
+        self.assertIsNone(tracker.process_job("base", "file2", 2))
+        self.assertEqual(tracker.process_confirmation("file2", 1), "base")
+
+        # restarted transfer
+        self.assertIsNone(tracker.process_confirmation("file3", 0))
+        self.assertIsNone(tracker.process_confirmation("file3", 0))
+        self.assertIsNone(tracker.process_job("base", "file3", 2))
+        self.assertIsNone(tracker.process_confirmation("file3", 0))
+        self.assertEqual(tracker.process_confirmation("file3", 1), "base")
+
+        # backward compatibility with versions <= 4.0.7
+        self.assertIsNone(tracker.process_confirmation("file4", None))
+        self.assertTrue(tracker.process_job("base", "file4", 5))
+
+        self.assertEqual(tracker.get_stats()["pending"], 4)
+        for file_id in ["file1", "file2", "file3", "file4"]:
+            tracker.remove_entry(file_id)
+        self.assertEqual(tracker.entries, {})
+        self.assertEqual(tracker.get_stats()["pending"], 0)
+
+    def test_confirmation_tracking_eviction(self):
+        """Stale and surplus entries are evicted.
+        """
+
+        tracker = ConfirmationTracking(log_queue=self.log_queue,
+                                       log_level="debug",
+                                       max_age=0.2,
+                                       max_entries=3)
+
+        tracker.process_job("base", "job", 2)
+        tracker.process_confirmation("job", 0)
+        tracker.process_confirmation("orphan", 0)
+
+        self.assertEqual(tracker.get_stats(), {
+            "pending": 1,
+            "orphaned": 1,
+            "evicted_jobs": 0,
+            "evicted_confirmations": 0,
+        })
+
+        time.sleep(0.1)
+        # updating keeps the entry
+        tracker.process_confirmation("orphan", 1)
+        time.sleep(0.15)
+        tracker.remove_stale()
+
+        self.assertEqual(list(tracker.entries), ["orphan"])
+        self.assertEqual(tracker.get_stats()["evicted_jobs"], 1)
+
+        # the oldest entry is evicted when the limit is reached
+        tracker.process_confirmation("new1", 0)
+        tracker.process_confirmation("new2", 0)
+        tracker.process_confirmation("new3", 0)
+
+        self.assertEqual(list(tracker.entries), ["new1", "new2", "new3"])
+        self.assertEqual(tracker.get_stats(), {
+            "pending": 0,
+            "orphaned": 3,
+            "evicted_jobs": 1,
+            "evicted_confirmations": 1,
+        })
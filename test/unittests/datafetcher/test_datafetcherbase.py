@@ -31,6 +31,7 @@ from __future__ import unicode_literals
 from builtins import super  # pylint: disable=redefined-builtin
 
 import os
+import zmq
 
 try:
     import unittest.mock as mock
@@ -41,6 +42,7 @@ except ImportError:
 import hidra.utils as utils
 
 from datafetchers.datafetcherbase import DataFetcherBase
+import latency_tracing
 from .datafetcher_test_base import DataFetcherTestBase
 
 
@@ -142,3 +144,177 @@ class TestDataFetcher(DataFetcherTestBase):
 
         self.log.debug("open_connections after function call: %s",
                        open_connections)
+
+    def test_send_to_targets_metadata_format(self):
+        """Check that each target gets the metadata in its format"""
+
+        if utils.MSGPACK not in utils.get_metadata_formats():
+            self.skipTest("msgpack is not installed")
+
+        self.datafetcher = DataFetcher(self.df_base_config)
+
+        metadata = {
+            "filename": "100.cbf",
+            "chunk_number": 0
+        }
+        payload = [metadata, b"data"]
+
+        targets = [
+            ["{}:6005".format(self.con_ip), 1, "data"],
+            ["{}:6006".format(self.con_ip), 1, "data"]
+        ]
+        self.datafetcher.metadata_formats = {targets[1][0]: utils.MSGPACK}
+
+        open_connections = {
+            targets[0][0]: mock.MagicMock(),
+            targets[1][0]: mock.MagicMock()
+        }
+
+        self.datafetcher.send_to_targets(
+            targets=targets,
+            open_connections=open_connections,
+            metadata=None,
+            payload=payload,
+            chunk_number=0
+        )
+
+        for target, metadata_format in [[targets[0][0], utils.JSON],
+                                        [targets[1][0], utils.MSGPACK]]:
+            connection = open_connections[target]
+            message = connection.send_multipart.call_args[0][0]
+
+            self.assertEqual(
+                message,
+                [utils.serialize_metadata(metadata, metadata_format), b"data"]
+            )
+            self.assertEqual(utils.deserialize_metadata(message[0]),
+                             metadata)
+
+    def test_send_to_targets_without_trace(self):
+        """Check that the latency trace is not sent to the targets"""
+
+        self.datafetcher = DataFetcher(self.df_base_config)
+
+        metadata = {
+            "filename": "100.cbf",
+            "chunk_number": 0,
+            latency_tracing.TRACE_KEY: {"detected": 1.0}
+        }
+        payload = [metadata, b"data"]
+
+        targets = [["{}:6005".format(self.con_ip), 1, "data"]]
+        open_connections = {targets[0][0]: mock.MagicMock()}
+
+        self.datafetcher.send_to_targets(
+            targets=targets,
+            open_connections=open_connections,
+            metadata=None,
+            payload=payload,
+            chunk_number=0
+        )
+
+        connection = open_connections[targets[0][0]]
+        message = connection.send_multipart.call_args[0][0]
+        self.assertEqual(utils.deserialize_metadata(message[0]),
+                         {"filename": "100.cbf", "chunk_number": 0})
+        # the trace is kept on the sender side
+        self.assertIn(latency_tracing.TRACE_KEY, metadata)
+
+    def test_drain(self):
+        """Check that draining does not stop the rest of the sender"""
+
+        self.datafetcher = DataFetcher(self.df_base_config)
+
+        self.datafetcher.drain()
+        self.datafetcher.stop_base()
+        self.assertFalse(self.stop_request.is_set())
+
+        self.datafetcher = DataFetcher(self.df_base_config)
+        self.datafetcher.stop_base()
+        self.assertTrue(self.stop_request.is_set())
+
+    def test_send_to_targets_in_flight(self):
+        """Check that priority 0 targets only wait if the window is full"""
+
+        self.df_base_config["config"]["datafetcher"]["chunks_in_flight"] = 2
+        self.datafetcher = DataFetcher(self.df_base_config)
+
+        target = ["{}:6005".format(self.con_ip), 0, "data"]
+        connection = mock.MagicMock()
+        open_connections = {target[0]: connection}
+
+        trackers = []
+
+        def send_multipart(*args, **kwargs):
+            tracker = mock.MagicMock()
+            tracker.done = False
+
+            def wait(timeout):
+                tracker.done = True
+
+            tracker.wait.side_effect = wait
+            trackers.append(tracker)
+            return tracker
+
+        connection.send_multipart.side_effect = send_multipart
+
+        for chunk_number in range(3):
+            self.datafetcher.send_to_targets(
+                targets=[target],
+                open_connections=open_connections,
+                metadata=None,
+                payload=[{"chunk_number": chunk_number}, b"data"],
+                chunk_number=chunk_number
+            )
+
+        # the oldest messages are waited for if the window is full
+        self.assertEqual(len(trackers), 3)
+        self.assertEqual([t.wait.call_count for t in trackers], [1, 1, 0])
+        self.assertEqual(len(self.datafetcher.in_flight[target[0]]), 1)
+
+        self.datafetcher.wait_for_in_flight()
+        self.assertTrue(trackers[2].done)
+        self.assertEqual(self.datafetcher.in_flight, {})
+
+    def test_send_to_targets_in_flight_retry(self):
+        """Check that messages not sent yet are resent after sleeping"""
+
+        self.df_base_config["config"]["datafetcher"]["chunks_in_flight"] = 3
+        self.datafetcher = DataFetcher(self.df_base_config)
+
+        target = ["{}:6005".format(self.con_ip), 0, "data"]
+        connection = mock.MagicMock()
+        open_connections = {target[0]: connection}
+
+        tracker = mock.MagicMock()
+        tracker.done = False
+        tracker.wait.side_effect = zmq.error.NotDone
+        connection.send_multipart.return_value = tracker
+
+        new_tracker = mock.MagicMock()
+        new_tracker.done = True
+
+        for chunk_number in range(2):
+            self.datafetcher.send_to_targets(
+                targets=[target],
+                open_connections=open_connections,
+                metadata=None,
+                payload=[{"chunk_number": chunk_number}, b"data"],
+                chunk_number=chunk_number
+            )
+            connection.send_multipart.return_value = new_tracker
+            self.assertEqual(connection.send_multipart.call_count,
+                             chunk_number + 1)
+
+        # simulate a wakeup while waiting
+        with mock.patch.object(DataFetcher, "_check_control_signal") as m_sig:
+            m_sig.return_value = True
+            self.datafetcher.wait_for_in_flight()
+
+        # the first message was sent again
+        self.assertEqual(connection.send_multipart.call_count, 3)
+        self.assertEqual(
+            connection.send_multipart.call_args_list[2],
+            connection.send_multipart.call_args_list[0]
+        )
+        self.assertEqual(self.datafetcher.in_flight, {})
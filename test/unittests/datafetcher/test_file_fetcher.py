@@ -37,6 +37,14 @@ from shutil import copyfile
 import time
 import zmq
 
+try:
+    import unittest.mock as mock
+except ImportError:
+    # for python2
+    import mock
+
+import hidra.utils as utils
+from chunk_reader import ChunkReader
 from datafetchers.file_fetcher import DataFetcher, Cleaner
 from .datafetcher_test_base import DataFetcherTestBase
 
@@ -253,6 +261,287 @@ class TestDataFetcher(DataFetcherTestBase):
         self.stop_socket(name="confirmation_socket",
                          socket=confirmation_socket)
 
+    def _send_small_files(self, batching):
+        """Send two small files with batching enabled.
+
+        Args:
+            batching: The indices of the targets announcing to support
+                batches.
+
+        Returns:
+            The messages received by each target.
+        """
+
+        self.df_base_config["config"]["datafetcher"][self.module_name].update({
+            "batch_files": True,
+            "batch_max_files": 2
+        })
+        self.datafetcher = DataFetcher(self.df_base_config)
+
+        # Set up receiver simulator
+        self.receiving_sockets = []
+        for port in self.receiving_ports:
+            self.receiving_sockets.append(self.set_up_recv_socket(port))
+
+        source_dir = os.path.join(self.base_dir, "data", "source")
+        prework_source_file = os.path.join(self.base_dir,
+                                           "test",
+                                           "test_files",
+                                           "test_file.cbf")
+
+        targets = [
+            ["{}:{}".format(self.con_ip, self.receiving_ports[0]), 1, "data"],
+            ["{}:{}".format(self.con_ip, self.receiving_ports[1]), 0, "data"]
+        ]
+        # as done for the BATCHING signal
+        self.datafetcher.batching.update(targets[i][0] for i in batching)
+
+        open_connections = dict()
+
+        for filename in ["100.cbf", "101.cbf"]:
+            copyfile(prework_source_file,
+                     os.path.join(source_dir, "local", filename))
+
+            metadata = {
+                "source_path": source_dir,
+                "relative_path": os.sep + "local",
+                "filename": filename
+            }
+
+            self.datafetcher.get_metadata(targets, metadata)
+            self.datafetcher.send_data(targets, metadata, open_connections)
+            self.datafetcher.finish(targets, metadata, open_connections)
+
+        received = []
+        for sckt in self.receiving_sockets:
+            messages = []
+            while sckt.poll(500):
+                messages.append(sckt.recv_multipart())
+            received.append(messages)
+
+        return received
+
+    def test_batch(self):
+        """Simulate sending small files in one batch.
+        """
+
+        received = self._send_small_files(batching=[0, 1])
+
+        for messages in received:
+            self.assertEqual(len(messages), 1)
+
+            # [<metadata>, <data>, <metadata>, <data>]
+            recv_message = messages[0]
+            self.assertEqual(len(recv_message), 4)
+            recv_filenames = [
+                json.loads(recv_message[i].decode("utf-8"))["filename"]
+                for i in [0, 2]
+            ]
+            self.assertEqual(recv_filenames, ["100.cbf", "101.cbf"])
+
+    def test_batch_not_negotiated(self):
+        """Simulate a target not announcing to support batches.
+        """
+
+        received = self._send_small_files(batching=[0])
+
+        # each file is sent on its own to all targets
+        for messages in received:
+            recv_filenames = [
+                json.loads(recv_message[0].decode("utf-8"))["filename"]
+                for recv_message in messages
+            ]
+            self.assertEqual([len(m) for m in messages], [2, 2])
+            self.assertEqual(recv_filenames, ["100.cbf", "101.cbf"])
+
+    def test_compression(self):
+        """Simulate sending compressed chunks to one of the targets.
+        """
+
+        self.df_base_config["config"]["datafetcher"].update({
+            "chunksize": 1000,
+            "compression": utils.ZLIB
+        })
+        self.datafetcher = DataFetcher(self.df_base_config)
+
+        # Set up receiver simulator
+        self.receiving_sockets = []
+        for port in self.receiving_ports:
+            self.receiving_sockets.append(self.set_up_recv_socket(port))
+
+        source_dir = os.path.join(self.base_dir, "data", "source")
+
+        targets = [
+            ["{}:{}".format(self.con_ip, self.receiving_ports[0]), 1, "data"],
+            ["{}:{}".format(self.con_ip, self.receiving_ports[1]), 0, "data"]
+        ]
+        # only the first target negotiated the compression
+        self.datafetcher.compression[targets[0][0]] = utils.ZLIB
+
+        open_connections = dict()
+
+        # cbf files are not compressed, even if the data would shrink
+        content = b"0123456789" * 250
+        for filename in ["100.tif", "101.cbf"]:
+            with open(os.path.join(source_dir, "local", filename), "wb") as f:
+                f.write(content)
+
+            metadata = {
+                "source_path": source_dir,
+                "relative_path": os.sep + "local",
+                "filename": filename
+            }
+
+            self.datafetcher.get_metadata(targets, metadata)
+            self.datafetcher.send_data(targets, metadata, open_connections)
+            self.datafetcher.finish(targets, metadata, open_connections)
+
+            for i, sckt in enumerate(self.receiving_sockets):
+                data = b""
+                for chunk_number in range(3):
+                    self.assertTrue(sckt.poll(2000))
+                    recv_metadata, payload = sckt.recv_multipart()
+                    recv_metadata = json.loads(recv_metadata.decode("utf-8"))
+
+                    self.assertEqual(recv_metadata["chunk_number"],
+                                     chunk_number)
+
+                    if i == 0 and filename.endswith(".tif"):
+                        self.assertEqual(recv_metadata["compression"],
+                                         utils.ZLIB)
+                        self.assertLess(len(payload), 1000)
+                        payload = utils.decompress(payload, utils.ZLIB)
+                    else:
+                        self.assertNotIn("compression", recv_metadata)
+
+                    data += payload
+
+                self.assertEqual(data, content)
+
+    def test_adaptive_chunksize(self):
+        """Simulate choosing the chunk size per file.
+        """
+
+        self.df_base_config["config"]["datafetcher"][self.module_name].update({
+            "adaptive_chunksize": True,
+            "min_chunksize": 1024,
+            "max_chunksize": 4096
+        })
+        self.datafetcher = DataFetcher(self.df_base_config)
+
+        # Set up receiver simulator
+        self.receiving_sockets = [
+            self.set_up_recv_socket(self.receiving_ports[0])
+        ]
+
+        source_dir = os.path.join(self.base_dir, "data", "source")
+
+        targets = [
+            ["{}:{}".format(self.con_ip, self.receiving_ports[0]), 1, "data"]
+        ]
+
+        open_connections = dict()
+
+        # (<file size>, <expected chunk size>, <expected number of chunks>)
+        # without a throughput estimate the configured chunksize is used,
+        # limited to max_chunksize
+        files = [("100.tif", 1500, 2048, 1),
+                 ("101.tif", 10000, 4096, 3)]
+        for filename, filesize, chunksize, n_chunks in files:
+            with open(os.path.join(source_dir, "local", filename), "wb") as f:
+                f.write(os.urandom(filesize))
+
+            metadata = {
+                "source_path": source_dir,
+                "relative_path": os.sep + "local",
+                "filename": filename
+            }
+
+            self.datafetcher.get_metadata(targets, metadata)
+            self.assertEqual(metadata["chunksize"], chunksize)
+
+            self.datafetcher.send_data(targets, metadata, open_connections)
+            self.datafetcher.finish(targets, metadata, open_connections)
+
+            for chunk_number in range(n_chunks):
+                self.assertTrue(self.receiving_sockets[0].poll(2000))
+                recv_metadata, _ = self.receiving_sockets[0].recv_multipart()
+                recv_metadata = json.loads(recv_metadata.decode("utf-8"))
+
+                self.assertEqual(recv_metadata["chunksize"], chunksize)
+                self.assertEqual(recv_metadata["chunk_number"], chunk_number)
+
+        self.assertEqual(self.datafetcher.pop_stats(),
+                         [("chunksize", [2048, 1500]),
+                          ("chunksize", [4096, 10000])])
+        self.assertEqual(self.datafetcher.pop_stats(), [])
+
+    def _send_chunks(self, config):
+        """Send a file of three chunks and check that it arrives complete.
+        """
+
+        self.df_base_config["config"]["datafetcher"]["chunksize"] = 1024
+        self.df_base_config["config"]["datafetcher"][self.module_name].update(
+            config
+        )
+        self.datafetcher = DataFetcher(self.df_base_config)
+
+        # Set up receiver simulator
+        self.receiving_sockets = [
+            self.set_up_recv_socket(self.receiving_ports[0])
+        ]
+
+        source_dir = os.path.join(self.base_dir, "data", "source")
+        filename = "100.tif"
+        content = os.urandom(3000)
+        with open(os.path.join(source_dir, "local", filename), "wb") as f:
+            f.write(content)
+
+        metadata = {
+            "source_path": source_dir,
+            "relative_path": os.sep + "local",
+            "filename": filename
+        }
+        targets = [
+            ["{}:{}".format(self.con_ip, self.receiving_ports[0]), 1, "data"]
+        ]
+        open_connections = dict()
+
+        self.datafetcher.get_metadata(targets, metadata)
+        self.datafetcher.send_data(targets, metadata, open_connections)
+        self.datafetcher.finish(targets, metadata, open_connections)
+
+        data = b""
+        for chunk_number in range(3):
+            self.assertTrue(self.receiving_sockets[0].poll(2000))
+            recv_metadata, payload = (
+                self.receiving_sockets[0].recv_multipart()
+            )
+            recv_metadata = json.loads(recv_metadata.decode("utf-8"))
+            self.assertEqual(recv_metadata["chunk_number"], chunk_number)
+            data += payload
+
+        self.assertEqual(data, content)
+
+    def test_zero_copy(self):
+        """Simulate sending the chunks from recycled buffers.
+        """
+
+        self._send_chunks({"use_zero_copy": True})
+
+        # the chunks were read into the buffers of the pool
+        self.assertGreater(self.datafetcher.buffer_pool.n_allocated, 0)
+
+    def test_read_ahead(self):
+        """Simulate reading the next chunks in the background.
+        """
+
+        with mock.patch("datafetchers.file_fetcher.ChunkReader",
+                        wraps=ChunkReader) as mocked_reader:
+            self._send_chunks({"read_ahead": 2})
+
+        self.assertEqual(mocked_reader.call_args[1]["read_ahead"], 2)
+
     def tearDown(self):
         if self.control_pub_socket is not None:
             self.log.debug("Sending control signal: EXIT")
@@ -30,9 +30,13 @@ from __future__ import unicode_literals
 # requires dependency on future
 from builtins import super  # pylint: disable=redefined-builtin
 
+from http.server import BaseHTTPRequestHandler, HTTPServer
 import json
 import os
+from socketserver import ThreadingMixIn
 import subprocess
+import threading
+import time
 
 from datafetchers.http_fetcher import DataFetcher
 from .datafetcher_test_base import DataFetcherTestBase
@@ -40,6 +44,92 @@ from .datafetcher_test_base import DataFetcherTestBase
 __author__ = 'Manuela Kuhn <manuela.kuhn@desy.de>'
 
 
+class MockDetector(ThreadingMixIn, HTTPServer):
+    """Serves one file like the http interface of a detector.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, content, serve_ranges=True, content_range=True):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), MockDetectorHandler)
+
+        self.content = content
+        self.serve_ranges = serve_ranges
+        self.content_range = content_range
+
+        self.lock = threading.Lock()
+        self.n_requests = 0
+        self.n_running = 0
+        self.max_running = 0
+
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get_url(self):
+        """The url of the directory the file is in.
+        """
+        return "http://{}:{}/data".format(*self.server_address)
+
+    def stop(self):
+        """Stop serving.
+        """
+        self.shutdown()
+        self.server_close()
+
+
+class MockDetectorHandler(BaseHTTPRequestHandler):
+    """Answers (range) requests for the file of the mock detector.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Send the file or the requested range of it.
+        """
+
+        server = self.server
+        with server.lock:
+            server.n_requests += 1
+            server.n_running += 1
+            server.max_running = max(server.max_running, server.n_running)
+
+        # keeps the requests running at the same time
+        time.sleep(0.01)
+
+        content = server.content
+        range_header = self.headers.get("Range")
+        if server.serve_ranges and range_header is not None:
+            start, end = range_header.split("=")[1].split("-")
+            start, end = int(start), min(int(end), len(content) - 1)
+
+            if start >= len(content):
+                self.send_response(416)
+                self.send_header("Content-Range",
+                                 "bytes */{}".format(len(content)))
+                content = b""
+            else:
+                self.send_response(206)
+                if server.content_range:
+                    self.send_header("Content-Range", "bytes {}-{}/{}".format(
+                        start, end, len(content)
+                    ))
+                content = content[start:end + 1]
+        else:
+            self.send_response(200)
+
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+
+        with server.lock:
+            server.n_running -= 1
+
+        self.wfile.write(content)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
 class TestDataFetcher(DataFetcherTestBase):
     """Specification of tests to be performed for the loaded DataFetcher.
     """
@@ -57,6 +147,7 @@ class TestDataFetcher(DataFetcherTestBase):
                 "ipc_dir": self.config["ipc_dir"],
                 "main_pid": self.config["main_pid"],
                 "endpoints": self.config["endpoints"],
+                "session": None,
             },
             "datafetcher": {
                 "store_data": True,
@@ -64,6 +155,7 @@ class TestDataFetcher(DataFetcherTestBase):
                 "chunksize": 10485760,  # = 1024*1024*10 = 10 MiB
                 "local_target": os.path.join(self.base_dir, "data", "target"),
                 "type": self.module_name,
+                "use_cleaner": False,
                 self.module_name: {
                     "session": None,
                     "fix_subdirs": ["commissioning", "current", "local"],
@@ -148,3 +240,90 @@ class TestDataFetcher(DataFetcherTestBase):
         """Simulate file fetching while taking care of confirmation signals.
         """
         pass
+
+    def _download(self, serve_ranges, content_range=True, filesize=10500):
+        self.df_base_config["config"]["datafetcher"].update({
+            "store_data": False,
+            "chunksize": 1000
+        })
+        self.df_base_config["config"]["datafetcher"][self.module_name].update({
+            "parallel_downloads": 4,
+            "max_downloads": 2
+        })
+        datafetcher = DataFetcher(self.df_base_config)
+
+        content = os.urandom(filesize)
+        detector = MockDetector(content,
+                                serve_ranges=serve_ranges,
+                                content_range=content_range)
+
+        receiving_socket = self.set_up_recv_socket(self.receiving_ports[0])
+
+        metadata = {
+            "source_path": detector.get_url(),
+            "relative_path": "local",
+            "filename": "test01.cbf"
+        }
+        targets = [
+            ["{}:{}".format(self.con_ip, self.receiving_ports[0]), 1, "data"]
+        ]
+        open_connections = dict()
+
+        try:
+            datafetcher.get_metadata(targets, metadata)
+            datafetcher.send_data(targets, metadata, open_connections)
+
+            chunks = []
+            while receiving_socket.poll(2000):
+                recv_message = receiving_socket.recv_multipart()
+                recv_metadata = json.loads(recv_message[0].decode("utf-8"))
+                self.assertEqual(recv_metadata["chunk_number"], len(chunks))
+                chunks.append(recv_message[1])
+
+                if sum(len(chunk) for chunk in chunks) >= len(content):
+                    break
+
+            self.assertEqual(b"".join(chunks), content)
+        finally:
+            receiving_socket.close(0)
+            detector.stop()
+            datafetcher.stop()
+
+        return detector, datafetcher
+
+    def test_parallel_download(self):
+        """Simulate downloading a file with parallel range requests.
+        """
+
+        detector, _ = self._download(serve_ranges=True)
+
+        # one request per chunk
+        self.assertEqual(detector.n_requests, 11)
+        self.assertLessEqual(detector.max_running, 2)
+
+    def test_parallel_download_no_ranges(self):
+        """Simulate a detector not serving range requests.
+        """
+
+        detector, _ = self._download(serve_ranges=False)
+
+        self.assertEqual(detector.n_requests, 1)
+
+    def test_parallel_download_no_content_range(self):
+        """Simulate a detector serving ranges without the file size.
+        """
+
+        detector, _ = self._download(serve_ranges=True,
+                                     content_range=False)
+
+        # the whole file is requested again
+        self.assertEqual(detector.n_requests, 2)
+
+    def test_parallel_download_empty_file(self):
+        """Simulate downloading an empty file with range requests.
+        """
+
+        detector, datafetcher = self._download(serve_ranges=True, filesize=0)
+
+        self.assertEqual(detector.n_requests, 1)
+        self.assertTrue(datafetcher.config["remove_flag"])
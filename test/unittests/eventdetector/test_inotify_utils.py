@@ -31,8 +31,13 @@ from __future__ import unicode_literals
 from builtins import super  # pylint: disable=redefined-builtin
 
 import os
+import re
+import shutil
+import tempfile
+import threading
+import time
 
-from eventdetectors.inotify_utils import get_event_message
+from eventdetectors.inotify_utils import get_event_message, CleanUp
 from .eventdetector_test_base import EventDetectorTestBase
 
 __author__ = 'Manuela Kuhn <manuela.kuhn@desy.de>'
@@ -127,3 +132,83 @@ class TestInotifyUtils(EventDetectorTestBase):
 
         with self.assertRaises(Exception):
             get_event_message(abs_file_path, filename, paths)
+
+    def test_cleanup_traverse(self):
+        """Simulate passes of the clean up with unchanged directories.
+        """
+
+        source_path = tempfile.mkdtemp()
+        old = time.time() - 100
+
+        def create_file(relative_path, mtime):
+            path = os.path.join(source_path, relative_path)
+            with open(path, "w"):
+                pass
+            os.utime(path, (mtime, mtime))
+
+        def set_dirs_old(mtime):
+            # otherwise they are too recent to be taken from the cache
+            for root, dirs, _ in os.walk(source_path):
+                for dirname in dirs:
+                    os.utime(os.path.join(root, dirname), (mtime, mtime))
+
+        def get_files(events):
+            return sorted(os.path.join(event["relative_path"],
+                                       event["filename"])
+                          for event in events)
+
+        try:
+            for dirname in ["local/sub", "current"]:
+                os.makedirs(os.path.join(source_path, dirname))
+            create_file("local/a.cbf", old)
+            create_file("local/sub/b.cbf", old)
+            create_file("local/sub/c.tif", old)
+            create_file("current/d.cbf", time.time())
+            set_dirs_old(old)
+
+            cleanup = CleanUp(paths=[source_path],
+                              mon_subdirs=["local", "current"],
+                              mon_regex=re.compile(r".*\.cbf$"),
+                              cleanup_time=10,
+                              action_time=1,
+                              lock=threading.Lock(),
+                              log_queue=self.log_queue,
+                              threads=2)
+            dirs = [os.path.join(source_path, dirname)
+                    for dirname in ["local", "current"]]
+
+            events = cleanup.traverse_directories(dirs)
+            self.assertEqual(get_files(events), ["local/a.cbf",
+                                                 "local/sub/b.cbf"])
+            stats = cleanup.pop_stats()
+            self.assertEqual(stats["dirs_listed"], 3)
+            self.assertEqual(stats["dirs_cached"], 0)
+            self.assertIsNone(cleanup.pop_stats())
+
+            # the young file got old without changing the directory
+            os.utime(os.path.join(source_path, "current/d.cbf"), (old, old))
+
+            events = cleanup.traverse_directories(dirs)
+            self.assertEqual(get_files(events), ["current/d.cbf",
+                                                 "local/a.cbf",
+                                                 "local/sub/b.cbf"])
+            stats = cleanup.pop_stats()
+            self.assertEqual(stats["dirs_listed"], 0)
+            self.assertEqual(stats["dirs_cached"], 3)
+
+            # new files are found in changed directories
+            os.remove(os.path.join(source_path, "local/a.cbf"))
+            create_file("local/sub/e.cbf", old)
+            os.utime(os.path.join(source_path, "local"), (old + 1, old + 1))
+            os.utime(os.path.join(source_path, "local/sub"),
+                     (old + 1, old + 1))
+
+            events = cleanup.traverse_directories(dirs)
+            self.assertEqual(get_files(events), ["current/d.cbf",
+                                                 "local/sub/b.cbf",
+                                                 "local/sub/e.cbf"])
+            stats = cleanup.pop_stats()
+            self.assertEqual(stats["dirs_listed"], 2)
+            self.assertEqual(stats["dirs_cached"], 1)
+        finally:
+            shutil.rmtree(source_path)